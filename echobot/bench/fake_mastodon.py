@@ -0,0 +1,357 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+from threading import Thread, Lock
+import random
+import json
+import time
+import pytz
+import re
+
+
+class FakeMastodonServer:
+    '''
+    A local HTTP server that fakes the Mastodon API endpoints used by the bot
+
+    It supports configurable latency, a rate of injected errors and the
+    rate limit headers, so publishing and rate limit behaviour can be
+    exercised without a real instance.
+    '''
+
+    VERSION = "4.1.0"
+    BOT_ACCOUNT_ID = 1
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit: int = 300,
+        rate_limit_window: int = 300,
+        statuses_per_account: int = 20,
+        seed: int = 42
+    ) -> None:
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.statuses_per_account = statuses_per_account
+
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self._next_id = 1000
+        self._accounts = {}
+        self._rate_limit_remaining = rate_limit
+        self._rate_limit_reset = time.time() + rate_limit_window
+
+        self.statuses = []
+        self.reblogs = []
+        self.media = {}
+        self.follows = []
+        self.requests = []
+
+        self._httpd = ThreadingHTTPServer((host, port), self._get_handler_class())
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        self._thread = Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            by_endpoint = {}
+            for request in self.requests:
+                by_endpoint[request["endpoint"]] = by_endpoint.get(request["endpoint"], 0) + 1
+            return {
+                "requests": len(self.requests),
+                "requests_by_endpoint": by_endpoint,
+                "errors_injected": len([r for r in self.requests if r["status"] >= 500]),
+                "rate_limited": len([r for r in self.requests if r["status"] == 429]),
+                "statuses": len(self.statuses),
+                "reblogs": len(self.reblogs),
+                "media": len(self.media),
+                "follows": len(self.follows),
+            }
+
+    def _new_id(self) -> int:
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    def _account(self, account_id: int, acct: str = None) -> dict:
+        if account_id not in self._accounts:
+            acct = acct if acct is not None else f"user{account_id}@fake.local"
+            self._accounts[account_id] = {
+                "id": str(account_id),
+                "username": acct.split("@")[0],
+                "acct": acct,
+                "display_name": acct,
+                "locked": False,
+                "bot": account_id == self.BOT_ACCOUNT_ID,
+                "created_at": "2023-01-01T00:00:00.000Z",
+                "note": "",
+                "url": f"{self.base_url}/@{acct}",
+                "avatar": "",
+                "header": "",
+                "followers_count": 0,
+                "following_count": 0,
+                "statuses_count": self.statuses_per_account,
+                "emojis": [],
+                "fields": []
+            }
+        return self._accounts[account_id]
+
+    def _status(
+        self,
+        status_id: int,
+        account_id: int,
+        content: str,
+        created_at: datetime = None,
+        reblog: dict = None,
+        media_ids: list = None
+    ) -> dict:
+        created_at = created_at if created_at is not None else datetime.now(tz=pytz.UTC)
+        return {
+            "id": str(status_id),
+            "uri": f"{self.base_url}/statuses/{status_id}",
+            "url": f"{self.base_url}/statuses/{status_id}",
+            "created_at": created_at.isoformat().replace("+00:00", "Z"),
+            "account": self._account(account_id),
+            "content": content,
+            "visibility": "public",
+            "sensitive": False,
+            "spoiler_text": "",
+            "language": "ca",
+            "in_reply_to_id": None,
+            "in_reply_to_account_id": None,
+            "reblog": reblog,
+            "media_attachments": [
+                self.media[str(m)] for m in media_ids or [] if str(m) in self.media
+            ],
+            "mentions": [],
+            "tags": [],
+            "emojis": [],
+            "reblogs_count": 0,
+            "favourites_count": 0,
+            "replies_count": 0
+        }
+
+    def _account_statuses(self, account_id: int, since_id: int = None) -> list:
+        # Deterministic statuses per account: the newest comes first, as in the real API
+        statuses = []
+        now = datetime.now(tz=pytz.UTC).replace(microsecond=0)
+        base_id = account_id * 100000
+        for index in range(self.statuses_per_account, 0, -1):
+            status_id = base_id + index
+            if since_id is not None and status_id <= since_id:
+                continue
+            original = self._status(
+                status_id + 50000, account_id + 1, f"<p>Original {status_id} talamanca</p>"
+            )
+            statuses.append(
+                self._status(
+                    status_id,
+                    account_id,
+                    f"<p>Status {status_id} talamanca</p>",
+                    created_at=now - timedelta(minutes=index),
+                    reblog=original if index % 2 == 0 else None
+                )
+            )
+        return statuses
+
+    def _check_rate_limit(self) -> bool:
+        with self._lock:
+            now = time.time()
+            if now >= self._rate_limit_reset:
+                self._rate_limit_remaining = self.rate_limit
+                self._rate_limit_reset = now + self.rate_limit_window
+            if self._rate_limit_remaining <= 0:
+                return False
+            self._rate_limit_remaining -= 1
+            return True
+
+    def _rate_limit_headers(self) -> dict:
+        with self._lock:
+            reset = datetime.fromtimestamp(self._rate_limit_reset, tz=pytz.UTC)
+            return {
+                "X-RateLimit-Limit": str(self.rate_limit),
+                "X-RateLimit-Remaining": str(max(self._rate_limit_remaining, 0)),
+                "X-RateLimit-Reset": reset.isoformat()
+            }
+
+    def handle(self, method: str, path: str, query: dict, form: dict) -> tuple:
+        """
+        Routes a request. Returns the HTTP status code and the JSON body.
+        """
+        if method == "GET" and path == "/api/v1/instance":
+            return 200, {
+                "uri": urlparse(self.base_url).netloc,
+                "title": "Fake Mastodon",
+                "version": self.VERSION,
+                "configuration": {
+                    "statuses": {
+                        "max_characters": 500
+                    }
+                }
+            }
+        if path in ["/api/v1/apps", "/oauth/token"]:
+            return 200, {
+                "client_id": "fake",
+                "client_secret": "fake",
+                "access_token": "fake",
+                "scope": "read write",
+                "token_type": "Bearer",
+                "created_at": int(time.time())
+            }
+        if method == "GET" and path == "/api/v1/accounts/verify_credentials":
+            return 200, self._account(self.BOT_ACCOUNT_ID, "echobot@fake.local")
+        if method == "GET" and path == "/api/v1/accounts/search":
+            acct = query.get("q", ["someone@fake.local"])[0].lstrip("@")
+            account_id = 10 + sum([ord(char) for char in acct]) % 10000
+            return 200, [self._account(account_id, acct)]
+        if method == "GET" and path == "/api/v2/search":
+            acct = query.get("q", ["someone@fake.local"])[0].lstrip("@")
+            account_id = 10 + sum([ord(char) for char in acct]) % 10000
+            return 200, {
+                "accounts": [self._account(account_id, acct)], "statuses": [], "hashtags": []
+            }
+
+        match = re.match(r"^/api/v1/accounts/(\d+)/(statuses|following|follow)$", path)
+        if match:
+            account_id, action = int(match.group(1)), match.group(2)
+            if action == "statuses" and method == "GET":
+                since_id = int(query["since_id"][0]) if "since_id" in query else None
+                return 200, self._account_statuses(account_id, since_id)
+            if action == "following" and method == "GET":
+                return 200, [self._account(f) for f in self.follows]
+            if action == "follow" and method == "POST":
+                with self._lock:
+                    self.follows.append(account_id)
+                return 200, {"id": str(account_id), "following": True, "showing_reblogs": True}
+
+        if method == "POST" and path in ["/api/v1/media", "/api/v2/media"]:
+            media_id = str(self._new_id())
+            media = {
+                "id": media_id,
+                "type": "image",
+                "url": f"{self.base_url}/media/{media_id}.jpg",
+                "preview_url": f"{self.base_url}/media/{media_id}_small.jpg",
+                "description": form.get("description", None),
+                "blurhash": None
+            }
+            with self._lock:
+                self.media[media_id] = media
+            return 200, media
+        match = re.match(r"^/api/v1/media/(\d+)$", path)
+        if match and method == "GET":
+            media_id = match.group(1)
+            return (200, self.media[media_id]) if media_id in self.media\
+                else (404, {"error": "Record not found"})
+
+        if method == "POST" and path == "/api/v1/statuses":
+            status = self._status(
+                self._new_id(),
+                self.BOT_ACCOUNT_ID,
+                form.get("status", ""),
+                media_ids=form.get("media_ids", [])
+            )
+            with self._lock:
+                self.statuses.append(status)
+            return 200, status
+        match = re.match(r"^/api/v1/statuses/(\d+)/reblog$", path)
+        if match and method == "POST":
+            original = self._status(int(match.group(1)), 2, "<p>Reblogged</p>")
+            status = self._status(self._new_id(), self.BOT_ACCOUNT_ID, "", reblog=original)
+            with self._lock:
+                self.reblogs.append(status)
+            return 200, status
+
+        return 404, {"error": "Record not found"}
+
+    def _get_handler_class(self) -> type:
+        server = self
+
+        class FakeMastodonHandler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                # Keep the benchmarks output clean
+                pass
+
+            def _parse_form(self) -> dict:
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length > 0 else b""
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("application/json"):
+                    return json.loads(body or b"{}")
+                if content_type.startswith("application/x-www-form-urlencoded"):
+                    form = {}
+                    for key, values in parse_qs(body.decode()).items():
+                        if key.endswith("[]"):
+                            form[key[:-2]] = values
+                        else:
+                            form[key] = values[0]
+                    return form
+                # Multipart uploads: only the description is interesting
+                match = re.search(rb'name="description"\r\n\r\n(.*?)\r\n', body)
+                return {"description": match.group(1).decode() if match else None}
+
+            def _serve(self, method: str):
+                started = time.perf_counter()
+                parsed = urlparse(self.path)
+                query = parse_qs(parsed.query)
+                form = self._parse_form() if method == "POST" else {}
+                for key, values in list(query.items()):
+                    if key.endswith("[]"):
+                        form[key[:-2]] = values
+
+                if server.latency > 0 or server.latency_jitter > 0:
+                    time.sleep(
+                        server.latency + server._random.uniform(0, server.latency_jitter)
+                    )
+
+                if not server._check_rate_limit():
+                    status_code, body = 429, {"error": "Too many requests"}
+                elif server.error_rate > 0 and server._random.random() < server.error_rate:
+                    status_code, body = 503, {"error": "Injected error"}
+                else:
+                    status_code, body = server.handle(method, parsed.path, query, form)
+
+                payload = json.dumps(body).encode()
+                self.send_response(status_code)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(payload)))
+                for header, value in server._rate_limit_headers().items():
+                    self.send_header(header, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+                with server._lock:
+                    server.requests.append(
+                        {
+                            "method": method,
+                            "endpoint": re.sub(r"/\d+", "/:id", parsed.path),
+                            "status": status_code,
+                            "seconds": time.perf_counter() - started
+                        }
+                    )
+
+            def do_GET(self):
+                self._serve("GET")
+
+            def do_POST(self):
+                self._serve("POST")
+
+        return FakeMastodonHandler
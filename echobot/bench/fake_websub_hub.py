@@ -0,0 +1,154 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+from threading import Thread, Lock
+import requests
+import secrets
+import hmac
+import time
+
+
+class FakeWebSubHub:
+    '''
+    A local WebSub hub to exercise the subscriber without a real one
+
+    Subscription requests are accepted right away and verified asynchronously
+    against the callback, as a real hub does. Publishing a topic delivers the
+    given content, signed with the secret of every verified subscription.
+    '''
+
+    SIGNATURE_METHOD = "sha256"
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, timeout: int = 10) -> None:
+        self.timeout = timeout
+        self._lock = Lock()
+
+        self.subscriptions = {}
+        self.verifications = []
+        self.deliveries = []
+
+        self._httpd = ThreadingHTTPServer((host, port), self._get_handler_class())
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        self._thread = Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def wait_for_subscriptions(self, amount: int, timeout: float = 5.0) -> int:
+        """
+        Waits until the given amount of subscriptions are verified.
+            Returns the amount of verified subscriptions.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._lock:
+                verified = len(self.subscriptions)
+            if verified >= amount:
+                break
+            time.sleep(0.01)
+        return verified
+
+    def publish(self, topic: str, content: bytes, content_type: str = "application/rss+xml"):
+        """
+        Delivers the content to all subscribers of the topic.
+            Returns the status codes of the deliveries.
+        """
+        with self._lock:
+            subscriptions = [s for s in self.subscriptions.values() if s["topic"] == topic]
+
+        status_codes = []
+        for subscription in subscriptions:
+            signature = hmac.new(
+                subscription["secret"].encode(), content, self.SIGNATURE_METHOD
+            ).hexdigest()
+            response = requests.post(
+                subscription["callback"],
+                data=content,
+                headers={
+                    "Content-Type": content_type,
+                    "X-Hub-Signature": f"{self.SIGNATURE_METHOD}={signature}"
+                },
+                timeout=self.timeout
+            )
+            status_codes.append(response.status_code)
+            with self._lock:
+                self.deliveries.append(
+                    {
+                        "topic": topic,
+                        "callback": subscription["callback"],
+                        "status": response.status_code
+                    }
+                )
+
+        return status_codes
+
+    def _verify(self, form: dict) -> None:
+        challenge = secrets.token_hex(16)
+        query = urlencode(
+            {
+                "hub.mode": form["hub.mode"],
+                "hub.topic": form["hub.topic"],
+                "hub.challenge": challenge,
+                "hub.lease_seconds": form.get("hub.lease_seconds", 86400)
+            }
+        )
+        separator = "&" if "?" in form["hub.callback"] else "?"
+        try:
+            response = requests.get(
+                f"{form['hub.callback']}{separator}{query}", timeout=self.timeout
+            )
+            is_verified = response.status_code == 200 and response.text == challenge
+        except requests.RequestException:
+            is_verified = False
+
+        with self._lock:
+            self.verifications.append({"callback": form["hub.callback"], "ok": is_verified})
+            if not is_verified:
+                return
+            if form["hub.mode"] == "subscribe":
+                self.subscriptions[form["hub.callback"]] = {
+                    "topic": form["hub.topic"],
+                    "callback": form["hub.callback"],
+                    "secret": form.get("hub.secret", ""),
+                }
+            else:
+                self.subscriptions.pop(form["hub.callback"], None)
+
+    def _get_handler_class(self) -> type:
+        hub = self
+
+        class FakeWebSubHubHandler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                # Keep the benchmarks output clean
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode() if length > 0 else ""
+                form = {key: values[0] for key, values in parse_qs(body).items()}
+
+                if urlparse(self.path).path not in ["", "/"]\
+                   or form.get("hub.mode", None) not in ["subscribe", "unsubscribe"]\
+                   or not form.get("hub.topic", None) or not form.get("hub.callback", None):
+                    self.send_response(400)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                # Verification of intent happens after accepting the request
+                Thread(target=hub._verify, args=(form, ), daemon=True).start()
+                self.send_response(202)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        return FakeWebSubHubHandler
@@ -0,0 +1,144 @@
+from datetime import datetime, timedelta
+from email.utils import format_datetime
+from types import SimpleNamespace
+from xml.sax.saxutils import escape
+import random
+import pytz
+
+
+class FixtureGenerator:
+    '''
+    Generates synthetic but reproducible data to feed the benchmarks
+
+    The same seed always generates the same content. Only the dates move,
+    as they are relative to now so that the parsers do not discard them as too old.
+    '''
+
+    WORDS = [
+        "talamanca",
+        "mura",
+        "rocafort",
+        "navarcles",
+        "montcau",
+        "ajuntament",
+        "carretera",
+        "festa",
+        "major",
+        "concert",
+        "mercat",
+        "escola",
+        "biblioteca",
+        "bombers",
+        "pluja",
+        "incendi",
+        "bosc",
+        "riu",
+        "pont",
+        "veins",
+        "plaça",
+        "esglesia",
+        "museu",
+        "teatre",
+        "cultura",
+        "esport",
+        "futbol",
+        "bicicleta",
+        "excursio",
+        "muntanya",
+        "parc",
+        "natural"
+    ]
+
+    def __init__(self, seed: int = 42) -> None:
+        self._random = random.Random(seed)
+        self._now = datetime.now(tz=pytz.UTC).replace(microsecond=0)
+
+    def text(self, num_words: int) -> str:
+        return " ".join([self._random.choice(self.WORDS) for _ in range(num_words)])
+
+    def html(self, size: int) -> str:
+        """
+        An HTML chunk of about the given size in characters, with paragraphs and an image
+        """
+        paragraphs = []
+        length = 0
+        while length < size:
+            paragraph = f"<p>{self.text(30)} <a href=\"https://example.cat/{length}\">" +\
+                f"{self.text(3)}</a> <b>{self.text(2)}</b></p>"
+            paragraphs.append(paragraph)
+            length += len(paragraph)
+        image_id = self._random.randint(1, 10**6)
+        image = f"<img src=\"https://example.cat/images/{image_id}.jpg\"" +\
+            f" alt=\"{self.text(4)}\"/>"
+
+        return image + "".join(paragraphs)
+
+    def feed(self, num_entries: int, summary_size: int = 500) -> str:
+        """
+        An RSS 2.0 document with the given amount of entries, newest first
+        """
+        items = []
+        for index in range(num_entries):
+            published = self._now - timedelta(minutes=index * 10)
+            link = f"https://example.cat/news/{index}-{self._random.randint(1, 10**9)}"
+            items.append(
+                "<item>" + f"<title>{escape(self.text(8))}</title>" + f"<link>{link}</link>" +
+                f"<description>{escape(self.html(summary_size))}</description>" +
+                f"<pubDate>{format_datetime(published)}</pubDate>" +
+                f"<guid>https://example.cat/news/{index}</guid>" + "</item>"
+            )
+
+        return "<?xml version=\"1.0\" encoding=\"UTF-8\"?>" +\
+            "<rss version=\"2.0\"><channel>" +\
+            "<title>Benchmark feed</title><link>https://example.cat</link>" +\
+            "<description>Synthetic feed</description><language>ca</language>" +\
+            "".join(items) + "</channel></rss>"
+
+    def keywords(self, num_terms: int) -> list:
+        """
+        A list of lowercase keywords. Only a few of them will ever match the texts.
+        """
+        keywords = self._random.sample(self.WORDS, 3)
+        while len(keywords) < num_terms:
+            keywords.append(
+                "".join([self._random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(8)])
+            )
+
+        return keywords
+
+    def telegram_messages(self, num_messages: int) -> list:
+        """
+        Objects that quack like Telethon Messages, in chronological order.
+        Most messages bring text, and some come as a burst of media-only messages.
+        """
+        messages = []
+        date = self._now - timedelta(days=1)
+        for index in range(num_messages):
+            has_text = self._random.random() > 0.4
+            date += timedelta(seconds=self._random.choice([5, 20, 120, 600]))
+            messages.append(
+                SimpleNamespace(
+                    id=index + 1, date=date, text=self.text(40) if has_text else "", file=None
+                )
+            )
+
+        return messages
+
+    def queue_items(self, num_items: int) -> list:
+        """
+        Queue items as the parsers would generate, unsorted and with some duplicates
+        """
+        items = []
+        for index in range(num_items):
+            items.append(
+                {
+                    "status": self.text(50) if self._random.random() > 0.05 else "duplicated",
+                    "media": None,
+                    "language": "ca_ES",
+                    "published_at": self._now -
+                    timedelta(minutes=self._random.randint(0, 60 * 24 * 30)),
+                    "action": "new"
+                }
+            )
+
+        return items
@@ -0,0 +1,140 @@
+from definitions import ROOT_DIR
+from datetime import datetime
+import subprocess
+import tracemalloc
+import json
+import time
+import os
+
+
+class Measure:
+    '''
+    Measures the time and the peak of memory of a callable
+    '''
+
+    @staticmethod
+    def run(name: str, prepare: callable, num_items: int) -> dict:
+        """
+        The prepare callable returns a fresh function to measure, as stages
+            may keep state. Time and memory are measured in separate passes,
+            because tracing the allocations slows down the execution a lot.
+        """
+        function = prepare()
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+
+        function = prepare()
+        # Do not disturb a trace that is already running, like the one from --trace-malloc
+        was_tracing = tracemalloc.is_tracing()
+        if was_tracing:
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+        try:
+            function()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            if not was_tracing:
+                tracemalloc.stop()
+
+        return {
+            "name": name,
+            "items": num_items,
+            "seconds": round(seconds, 6),
+            "items_per_second": round(num_items / seconds, 2) if seconds > 0 else None,
+            "peak_memory_bytes": peak
+        }
+
+    @staticmethod
+    def percentile(values: list, percent: float) -> float:
+        """
+        Nearest-rank percentile of a list of values
+        """
+        if not values:
+            return None
+        ordered = sorted(values)
+        rank = max(0, min(len(ordered) - 1, int(round(percent / 100 * len(ordered))) - 1))
+        return ordered[rank]
+
+
+class BenchResults:
+    '''
+    Stores the results of a benchmark run and compares them with a baseline
+    '''
+
+    def __init__(self, results: list = None, metadata: dict = None) -> None:
+        self.results = results if results is not None else []
+        self.metadata = metadata if metadata is not None else BenchResults.get_metadata()
+
+    @staticmethod
+    def get_metadata() -> dict:
+        try:
+            commit = subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=ROOT_DIR,
+                capture_output=True,
+                text=True,
+                check=True
+            ).stdout.strip()
+        except Exception:
+            commit = None
+
+        return {"commit": commit, "date": datetime.now().isoformat(timespec="seconds")}
+
+    def append(self, result: dict) -> None:
+        self.results.append(result)
+
+    def save(self, filename: str) -> None:
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(filename, "w") as handle:
+            json.dump({"metadata": self.metadata, "results": self.results}, handle, indent=2)
+
+    @staticmethod
+    def load(filename: str) -> "BenchResults":
+        if not os.path.exists(filename):
+            return None
+        with open(filename, "r") as handle:
+            content = json.load(handle)
+
+        return BenchResults(results=content["results"], metadata=content["metadata"])
+
+    def compare(
+        self,
+        baseline: "BenchResults",
+        threshold: float,
+        min_seconds: float = 0,
+        min_bytes: int = 0
+    ) -> list:
+        """
+        Returns the comparison of every result that exists also in the baseline.
+        A result is a regression if it takes more than threshold times the baseline.
+            The time or the memory must also grow more than min_seconds or
+            min_bytes, as the ratios of the smallest stages are mostly noise.
+        """
+        baseline_by_name = {result["name"]: result for result in baseline.results}
+        comparison = []
+        for result in self.results:
+            if result["name"] not in baseline_by_name:
+                continue
+            reference = baseline_by_name[result["name"]]
+            time_ratio = result["seconds"] / reference["seconds"]\
+                if reference["seconds"] > 0 else None
+            time_regressed = time_ratio is not None and time_ratio > threshold\
+                and result["seconds"] - reference["seconds"] > min_seconds
+            memory_ratio = result["peak_memory_bytes"] / reference["peak_memory_bytes"]\
+                if reference["peak_memory_bytes"] > 0 else None
+            memory_regressed = memory_ratio is not None and memory_ratio > threshold\
+                and result["peak_memory_bytes"] - reference["peak_memory_bytes"] > min_bytes
+            comparison.append(
+                {
+                    "name": result["name"],
+                    "time_ratio": time_ratio,
+                    "memory_ratio": memory_ratio,
+                    "is_regression": time_regressed or memory_regressed
+                }
+            )
+
+        return comparison
@@ -0,0 +1,132 @@
+from pyxavi.config import Config
+from datetime import datetime, timedelta
+from threading import Thread
+import logging
+import pytz
+
+
+class SourceTimeoutException(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    '''
+    Keeps a broken source from delaying the rest in every run
+
+    Every source keeps a small breaker state in its own storage. It is closed
+    while the source works. After failure_threshold failures in a row it opens
+    and the source is skipped for the cooldown. Then it is half open: the
+    next fetch is a try, a success closes it and a failure opens it again
+    for twice the previous cooldown, up to max_cooldown.
+    Every fetch also gets a hard timeout, so a hung source fails as well.
+    '''
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    DEFAULT_FAILURE_THRESHOLD = 3
+    DEFAULT_COOLDOWN = 900
+    DEFAULT_MAX_COOLDOWN = 86400
+    DEFAULT_FETCH_TIMEOUT = 120
+    MAX_ERROR_LENGTH = 200
+
+    def __init__(self, config: Config) -> None:
+        self._logger = logging.getLogger(config.get("logger.name"))
+        self._is_active = config.get("circuit_breaker.active", False)
+        self._failure_threshold = config.get(
+            "circuit_breaker.failure_threshold", self.DEFAULT_FAILURE_THRESHOLD
+        )
+        self._cooldown = config.get("circuit_breaker.cooldown", self.DEFAULT_COOLDOWN)
+        self._max_cooldown = config.get(
+            "circuit_breaker.max_cooldown", self.DEFAULT_MAX_COOLDOWN
+        )
+        self._fetch_timeout = config.get(
+            "circuit_breaker.fetch_timeout", self.DEFAULT_FETCH_TIMEOUT
+        )
+
+    def get_state(self, state: dict, now: datetime = None) -> str:
+        if not state or state.get("state", self.CLOSED) == self.CLOSED:
+            return self.CLOSED
+
+        now = now if now is not None else datetime.now(tz=pytz.UTC)
+        return self.OPEN if now < self._as_utc(state["open_until"]) else self.HALF_OPEN
+
+    def is_allowed(self, state: dict, now: datetime = None) -> bool:
+        if not self._is_active:
+            return True
+        return self.get_state(state, now) != self.OPEN
+
+    def describe(self, state: dict) -> str:
+        return f"Circuit open until {state['open_until']} after {state['failures']}" +\
+            f" failures, the last one: {state.get('last_error', None)}"
+
+    def record_success(self, state: dict) -> dict:
+        if state and self.get_state(state) != self.CLOSED:
+            self._logger.info("The source works again, closing its circuit")
+        return {"state": self.CLOSED, "failures": 0}
+
+    def record_failure(self, state: dict, error: Exception, now: datetime = None) -> dict:
+        """
+        Returns the new breaker state after a failed fetch
+        """
+        state = dict(state) if state else {}
+        now = now if now is not None else datetime.now(tz=pytz.UTC)
+        was_half_open = self.get_state(state, now) == self.HALF_OPEN
+        failures = state.get("failures", 0) + 1
+        state.update(
+            {
+                "failures": failures,
+                "last_error": str(error)[:self.MAX_ERROR_LENGTH],
+                "last_failure_at": now
+            }
+        )
+
+        if self._is_active and (was_half_open or failures >= self._failure_threshold):
+            # A source that fails again right after its cooldown waits longer every time
+            cooldown = min(state.get("cooldown", self._cooldown) * 2, self._max_cooldown)\
+                if was_half_open else self._cooldown
+            state.update(
+                {
+                    "state": self.OPEN,
+                    "cooldown": cooldown,
+                    "open_until": now + timedelta(seconds=cooldown)
+                }
+            )
+            self._logger.debug("Circuit opened for %d seconds", cooldown)
+        else:
+            state["state"] = self.CLOSED
+
+        return state
+
+    def call(self, function: callable, source_params: dict = None) -> any:
+        """
+        Runs the fetch with the hard timeout, that a source can override with fetch_timeout
+
+        Python can't stop a thread, so a hung fetch is left behind in a daemon
+            thread and the run goes on without it.
+        """
+        timeout = self.get_fetch_timeout(source_params)
+        result = {}
+
+        def target() -> None:
+            try:
+                result["value"] = function()
+            except Exception as e:
+                result["error"] = e
+
+        thread = Thread(target=target, name="fetch", daemon=True)
+        thread.start()
+        thread.join(timeout)
+        if thread.is_alive():
+            raise SourceTimeoutException(f"The fetch did not finish in {timeout} seconds")
+        if "error" in result:
+            raise result["error"]
+        return result.get("value", None)
+
+    def get_fetch_timeout(self, source_params: dict = None) -> float:
+        source_params = source_params if source_params is not None else {}
+        return source_params.get("fetch_timeout", self._fetch_timeout)
+
+    def _as_utc(self, date: datetime) -> datetime:
+        return date.replace(tzinfo=pytz.UTC) if date.tzinfo is None\
+            else date.astimezone(pytz.UTC)
@@ -0,0 +1,92 @@
+from pyxavi.config import Config
+from echobot.lib.serializer import Serializer
+from hashlib import sha256
+import logging
+import glob
+import os
+
+
+class ConfigSnapshot:
+    '''
+    Keeps the merged config, so the YAML files are not parsed and merged every run
+
+    The config files are merged in the given order, as always, and the result
+    is kept as a JSON snapshot next to the storage. The next runs load it
+    directly while the files are the same ones with the same modification
+    times and sizes, otherwise the snapshot is built again. It holds the
+    credentials of the config, so only the owner can read it, and the ones
+    left behind when the list of files changes are removed.
+    '''
+
+    SNAPSHOT_VERSION = 1
+    SNAPSHOT_DIRECTORY = "storage"
+
+    def __init__(self, files: list, base_path: str = None) -> None:
+        self._files = files
+        # Every config directory, like the ones of the bots in multi, has its own snapshot
+        owner = sha256(os.path.dirname(os.path.abspath(files[0])).encode()).hexdigest()[:12]
+        digest = sha256("\n".join([os.path.abspath(file) for file in files]).encode())
+        directory = os.path.join(
+            base_path if base_path is not None else "", self.SNAPSHOT_DIRECTORY
+        )
+        self._snapshot_file = os.path.join(
+            directory, f"config_snapshot.{owner}.{digest.hexdigest()[:12]}.json"
+        )
+        self._snapshot_pattern = os.path.join(directory, f"config_snapshot.{owner}.*.json")
+        self._serializer = Serializer("json")
+
+    def load(self) -> Config:
+        signature = self._get_signature()
+        snapshot = self._read_snapshot()
+        if snapshot is not None and snapshot.get("signature", None) == signature:
+            return Config(params=snapshot["content"])
+
+        config = Config(filename=self._files[0])
+        for file in self._files[1:]:
+            config.merge_from_file(filename=file)
+        self._write_snapshot(signature, config)
+        return config
+
+    def _get_signature(self) -> list:
+        signature = [self.SNAPSHOT_VERSION]
+        for file in self._files:
+            if not os.path.exists(file):
+                # The same error that the Config gives
+                raise RuntimeError(f"Config file [{file}] not found")
+            stat = os.stat(file)
+            signature.append([os.path.abspath(file), stat.st_mtime_ns, stat.st_size])
+        return signature
+
+    def _read_snapshot(self) -> dict:
+        try:
+            return self._serializer.load_file(self._snapshot_file)
+        except Exception:
+            # A broken snapshot is just built again
+            return None
+
+    def _write_snapshot(self, signature: list, config: Config) -> None:
+        if not os.path.isdir(os.path.dirname(self._snapshot_file) or "."):
+            return
+        # The credentials are never readable by others, not even for a moment
+        temporary_file = f"{self._snapshot_file}.{os.getpid()}.tmp"
+        try:
+            data = self._serializer.dumps({"signature": signature, "content": config.get_all()})
+            descriptor = os.open(temporary_file, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+            # The mode is only applied on creation, a leftover file may have another one
+            os.fchmod(descriptor, 0o600)
+            with os.fdopen(descriptor, "wb") as stream:
+                stream.write(data)
+            os.replace(temporary_file, self._snapshot_file)
+            self._remove_superseded()
+        except Exception as e:
+            # Without a snapshot the config is merged every run, as before
+            logger = logging.getLogger(config.get("logger.name"))
+            logger.debug("Could not write the config snapshot %s: %s", self._snapshot_file, e)
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+
+    def _remove_superseded(self) -> None:
+        # Built for another list of files of the same directory, never loaded again
+        for snapshot_file in glob.glob(self._snapshot_pattern):
+            if snapshot_file != self._snapshot_file:
+                os.remove(snapshot_file)
@@ -0,0 +1,163 @@
+from pyxavi.config import Config
+from pyxavi.mastodon_publisher import MastodonPublisherException
+from echobot.lib.queue_item import QueueItem
+from echobot.lib.locked_storage import LockedQueue, get_storage_params
+from mastodon.errors import MastodonAPIError, MastodonServerError
+from mastodon.errors import MastodonUnauthorizedError, MastodonIllegalArgumentError
+from datetime import datetime, timedelta
+import logging
+import pytz
+import os
+
+
+class UnavailableMediaException(RuntimeError):
+    '''
+    The media of a post is gone, retrying the post won't bring it back
+    '''
+    pass
+
+
+class ExpiredStreamedMediaException(RuntimeError):
+    '''
+    The streamed media of a post expired, it can be published once the
+    Telegram parser downloads it again
+    '''
+    pass
+
+
+class DeadLetterQueue:
+    '''
+    Keeps the posts that can't be published out of the way of the rest
+
+    A failed post is not retried in the same run. When the failure looks
+    transient (network, rate limit, server errors) the post stays in the
+    queue with a retry.not_before that doubles every attempt, up to
+    max_delay, and the posts behind it are published meanwhile. When it
+    is permanent (the API rejects it, the post to reblog or its media is
+    gone) or it ran out of attempts, it is moved to the dead letter file,
+    from where it can be inspected and requeued.
+    '''
+
+    DEFAULT_FILE = "storage/dead_letter.yaml"
+    DEFAULT_BASE_DELAY = 300
+    DEFAULT_MAX_DELAY = 21600
+    DEFAULT_MAX_ATTEMPTS = 8
+    MAX_ERROR_LENGTH = 200
+
+    def __init__(self, config: Config, base_path: str = None) -> None:
+        self._logger = logging.getLogger(config.get("logger.name"))
+        self._base_delay = config.get("publisher.retry.base_delay", self.DEFAULT_BASE_DELAY)
+        self._max_delay = config.get("publisher.retry.max_delay", self.DEFAULT_MAX_DELAY)
+        self._max_attempts = config.get(
+            "publisher.retry.max_attempts", self.DEFAULT_MAX_ATTEMPTS
+        )
+        filename = config.get("publisher.dead_letter_file", self.DEFAULT_FILE)
+        if base_path is not None and not os.path.isabs(filename):
+            filename = os.path.join(base_path, filename)
+        self._queue = LockedQueue(
+            logger=self._logger,
+            storage_file=filename,
+            queue_item_object=QueueItem,
+            **get_storage_params(config)
+        )
+
+    @staticmethod
+    def is_transient(error: BaseException) -> bool:
+        """
+        Whether the same post may work later. Errors that we don't know are
+            taken as transient, the max attempts keeps them from looping forever.
+        """
+        # pyxavi gives up publishing with its own exception, raised from the real one
+        if isinstance(error, MastodonPublisherException) and error.__context__ is not None:
+            error = error.__context__
+
+        if isinstance(error, UnavailableMediaException):
+            return False
+        # Wrong credentials would send every post here, better retry them
+        if isinstance(error, (MastodonServerError, MastodonUnauthorizedError)):
+            return True
+        # The rest of the API errors are the 4xx: not found, gone, unprocessable...
+        if isinstance(error, (MastodonAPIError, MastodonIllegalArgumentError)):
+            return False
+        return True
+
+    def is_due(self, item: dict, now: datetime = None) -> bool:
+        if not item.get("retry", None) or not item["retry"].get("not_before", None):
+            return True
+
+        now = now if now is not None else datetime.now(tz=pytz.UTC)
+        not_before = item["retry"]["not_before"]
+        if not_before.tzinfo is None:
+            not_before = not_before.replace(tzinfo=pytz.UTC)
+        return now >= not_before
+
+    def schedule_retry(self, item: dict, error: BaseException, now: datetime = None) -> bool:
+        """
+        Sets the retry state in the item. Returns False when it should be
+            dead lettered instead.
+        """
+        attempts = (item.get("retry", None) or {}).get("attempts", 0) + 1
+        if not self.is_transient(error) or attempts >= self._max_attempts:
+            return False
+
+        now = now if now is not None else datetime.now(tz=pytz.UTC)
+        delay = min(self._base_delay * 2**(attempts - 1), self._max_delay)
+        item["retry"] = {
+            "attempts": attempts,
+            "not_before": now + timedelta(seconds=delay),
+            "last_error": str(error)[:self.MAX_ERROR_LENGTH]
+        }
+        self._logger.debug("Retrying the post in %d seconds, attempt %d", delay, attempts)
+        return True
+
+    def add(self, items: list, error: BaseException) -> None:
+        """
+        Moves the given items, taken out of the queue already, to the dead letter file
+        """
+        with self._queue.locked():
+            for item in items:
+                item["dead_letter"] = {
+                    "at": datetime.now(tz=pytz.UTC),
+                    "attempts": (item.pop("retry", None) or {}).get("attempts", 0) + 1,
+                    "error": f"{type(error).__name__}: {str(error)[:self.MAX_ERROR_LENGTH]}"
+                }
+                self._queue.append(QueueItem(item))
+            self._queue.save()
+
+    def get_all(self) -> list:
+        return [item.to_dict() for item in self._queue.get_all()]
+
+    def length(self) -> int:
+        return self._queue.length()
+
+    def requeue(self, queue: LockedQueue, positions: list = None) -> int:
+        """
+        Moves the dead letters back to the given queue, all or the ones in
+            the given 1-based positions. Returns how many were moved.
+        """
+        with self._queue.locked():
+            if positions is None:
+                positions = range(1, self._queue.length() + 1)
+            wrong = [position for position in positions if not 1 <= position <= self.length()]
+            if wrong:
+                raise RuntimeError(f"There is no dead letter at position {wrong[0]}")
+
+            dead_letters = self._queue.get_all()
+            to_requeue = [dead_letters[position - 1] for position in positions]
+            with queue.locked():
+                for queue_item in to_requeue:
+                    item = dict(queue_item.to_dict())
+                    item.pop("dead_letter", None)
+                    item.pop("retry", None)
+                    queue.append(QueueItem(item))
+                queue.deduplicate()
+                queue.sort(param="published_at")
+                queue.save()
+
+            # Only once they are safe in the queue
+            self._queue.clean()
+            for queue_item in dead_letters:
+                if queue_item not in to_requeue:
+                    self._queue.append(queue_item)
+            self._queue.save()
+        return len(to_requeue)
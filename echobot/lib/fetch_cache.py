@@ -0,0 +1,49 @@
+from threading import Lock
+
+
+class FetchCache:
+    '''
+    Keeps what was fetched during a cycle, to share it between bots
+
+    When several bots run in the same process and watch the same sources,
+    the first one fetches and parses every source and the rest reuse it.
+    Failures are kept too, so a source that is down is not retried by every
+    bot in the same cycle. Clear it between cycles.
+    '''
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, producer: callable) -> any:
+        """
+        Returns the cached value for the key, or the one that the producer returns
+        """
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                value, error = self._entries[key]
+                if error is not None:
+                    raise error
+                return value
+            self.misses += 1
+
+        try:
+            value = producer()
+        except Exception as e:
+            with self._lock:
+                self._entries[key] = (None, e)
+            raise
+        with self._lock:
+            self._entries[key] = (value, None)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries = {}
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
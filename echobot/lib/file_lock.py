@@ -0,0 +1,135 @@
+from pyxavi.config import Config
+from echobot.lib.shard import Shard
+from datetime import datetime, timedelta
+import fcntl
+import json
+import time
+import os
+
+
+class LockTimeoutException(RuntimeError):
+    pass
+
+
+class FileLock:
+    '''
+    Advisory lock over a file, based on fcntl
+
+    The lock lives in an open file description, so the operating system
+    releases it when the holder dies. The holder writes its pid, when it got
+    the lock and until when it expects to hold it, its lease, so that whoever
+    waits can tell who holds it and whether it looks stuck.
+    '''
+
+    DEFAULT_TIMEOUT = 60
+    DEFAULT_LEASE = 300
+    DEFAULT_RUN_LOCK_FILE = "storage/run.lock"
+    DEFAULT_RUN_TIMEOUT = 0
+    DEFAULT_RUN_LEASE = 3600
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, path: str, timeout: float = None, lease: int = None) -> None:
+        self.path = path
+        self._timeout = timeout if timeout is not None else self.DEFAULT_TIMEOUT
+        self._lease = lease if lease is not None else self.DEFAULT_LEASE
+        self._handle = None
+
+    @staticmethod
+    def get_params(config: Config) -> dict:
+        """
+        The timeout and the lease for the storage and queue locks
+        """
+        return {
+            "timeout": config.get("locks.timeout", FileLock.DEFAULT_TIMEOUT),
+            "lease": config.get("locks.lease", FileLock.DEFAULT_LEASE)
+        }
+
+    @staticmethod
+    def for_run(config: Config, base_path: str = None, shard: Shard = None):
+        """
+        The lock that only one run that publishes can hold at a time.
+            The shards that don't publish get one of their own.
+        """
+        path = config.get("locks.run_lock_file", FileLock.DEFAULT_RUN_LOCK_FILE)
+        if base_path is not None:
+            path = os.path.join(base_path, path)
+        if shard is not None and not shard.is_publisher:
+            path = shard.get_partition_file(path)
+        return FileLock(
+            path,
+            timeout=config.get("locks.run_timeout", FileLock.DEFAULT_RUN_TIMEOUT),
+            lease=config.get("locks.run_lease", FileLock.DEFAULT_RUN_LEASE)
+        )
+
+    def acquire(self) -> None:
+        """
+        Waits for the lock up to the timeout, then raises a LockTimeoutException
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        handle = open(self.path, "a+")
+        deadline = time.monotonic() + self._timeout
+        while True:
+            try:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    handle.close()
+                    raise LockTimeoutException(
+                        f"{self.path} is locked by {self.describe_holder()}"
+                    )
+                time.sleep(self.POLL_INTERVAL)
+
+        now = datetime.now()
+        handle.seek(0)
+        handle.truncate()
+        handle.write(
+            json.dumps(
+                {
+                    "pid": os.getpid(),
+                    "acquired_at": now.isoformat(timespec="seconds"),
+                    "lease_until": (now + timedelta(seconds=self._lease)).isoformat(
+                        timespec="seconds"
+                    )
+                }
+            )
+        )
+        handle.flush()
+        self._handle = handle
+
+    def release(self) -> None:
+        if self._handle is None:
+            return
+
+        self._handle.seek(0)
+        self._handle.truncate()
+        fcntl.flock(self._handle.fileno(), fcntl.LOCK_UN)
+        self._handle.close()
+        self._handle = None
+
+    def get_holder(self) -> dict:
+        try:
+            with open(self.path, "r") as handle:
+                return json.loads(handle.read() or "{}")
+        except (OSError, ValueError):
+            return {}
+
+    def describe_holder(self) -> str:
+        holder = self.get_holder()
+        if not holder:
+            return "another process"
+
+        description = f"pid {holder['pid']} since {holder['acquired_at']}"
+        if datetime.fromisoformat(holder["lease_until"]) < datetime.now():
+            description += f", its lease expired at {holder['lease_until']} so it may be stuck"
+        return description
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.release()
@@ -0,0 +1,150 @@
+from pyxavi.config import Config
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+import requests
+import logging
+
+
+class HttpClient:
+    '''
+    A shared HTTP session to fetch content
+
+    Keeps the connections alive in a pool, so that fetching several resources
+    from the same host reuses them instead of handshaking again, and asks for
+    compressed bodies: gzip and deflate, plus brotli when it is installed.
+    Local files are also accepted, to make testing and benchmarking easier.
+    '''
+
+    DEFAULT_POOL_CONNECTIONS = 10
+    DEFAULT_POOL_MAXSIZE = 10
+    DEFAULT_TIMEOUT = 30
+    DEFAULT_MAX_SIZE_KB = 10240
+    DEFAULT_USER_AGENT = "EchoBot"
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, config: Config) -> None:
+        self._logger = logging.getLogger(config.get("logger.name"))
+        self._timeout = config.get("http_client.timeout", self.DEFAULT_TIMEOUT)
+        self._max_bytes = config.get("http_client.max_size_kb", self.DEFAULT_MAX_SIZE_KB) * 1024
+
+        adapter = HTTPAdapter(
+            pool_connections=config.get(
+                "http_client.pool_connections", self.DEFAULT_POOL_CONNECTIONS
+            ),
+            pool_maxsize=config.get("http_client.pool_maxsize", self.DEFAULT_POOL_MAXSIZE)
+        )
+        self._session = requests.Session()
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._session.headers.update(
+            {
+                # Includes "br" only when a brotli decoder is available
+                "Accept-Encoding": make_headers(accept_encoding=True)["accept-encoding"],
+                "User-Agent": config.get("http_client.user_agent", self.DEFAULT_USER_AGENT)
+            }
+        )
+
+    @staticmethod
+    def is_remote(url: str) -> bool:
+        return url.startswith("http://") or url.startswith("https://")
+
+    def stream(
+        self,
+        url: str,
+        timeout: int = None,
+        max_bytes: int = None,
+        chunk_size: int = None,
+        headers: dict = None,
+        response_headers: dict = None
+    ):
+        """
+        Yields the decompressed body in chunks.
+            Raises a RuntimeError once the body goes over max_bytes.
+            Without max_bytes, the http_client.max_size_kb applies to remote
+            URLs only: local files are ours already, like the bench fixtures.
+
+        When a response_headers dict is given, it is filled with the
+            lowercased headers of the response.
+        """
+        if max_bytes is None and self.is_remote(url):
+            max_bytes = self._max_bytes
+        chunk_size = chunk_size if chunk_size is not None else self.CHUNK_SIZE
+        received_bytes = 0
+
+        for chunk in self._get_chunks(url, timeout, chunk_size, headers, response_headers):
+            received_bytes += len(chunk)
+            if max_bytes and received_bytes > max_bytes:
+                raise RuntimeError(f"The response from {url} is bigger than {max_bytes} bytes")
+            yield chunk
+
+    def get(
+        self,
+        url: str,
+        timeout: int = None,
+        max_bytes: int = None,
+        headers: dict = None
+    ) -> dict:
+        """
+        Returns the whole body as bytes, with the response headers
+        """
+        response_headers = {}
+        content = b"".join(
+            self.stream(
+                url,
+                timeout=timeout,
+                max_bytes=max_bytes,
+                headers=headers,
+                response_headers=response_headers
+            )
+        )
+
+        return {"content": content, "headers": response_headers}
+
+    def post(self, url: str, data: dict, timeout: int = None) -> int:
+        """
+        Posts a form and returns the status code of the response
+        """
+        timeout = timeout if timeout is not None else self._timeout
+        with self._session.post(url, data=data, timeout=timeout) as response:
+            self._logger.debug("Posted to %s with status %d", url, response.status_code)
+            return response.status_code
+
+    def _get_chunks(
+        self,
+        url: str,
+        timeout: int,
+        chunk_size: int,
+        headers: dict = None,
+        response_headers: dict = None
+    ):
+        if not self.is_remote(url):
+            with open(url, "rb") as handle:
+                while True:
+                    chunk = handle.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            return
+
+        timeout = timeout if timeout is not None else self._timeout
+        with self._session.get(url, stream=True, timeout=timeout, headers=headers) as response:
+            response.raise_for_status()
+            if response_headers is not None:
+                response_headers.update(
+                    {
+                        **{key.lower(): value
+                           for key, value in response.headers.items()},
+                        "content-location": response.url
+                    }
+                )
+            self._logger.debug(
+                "Fetched %s with status %d, encoding %s",
+                url,
+                response.status_code,
+                response.headers.get("Content-Encoding", "identity")
+            )
+            for chunk in response.iter_content(chunk_size):
+                yield chunk
+
+    def close(self) -> None:
+        self._session.close()
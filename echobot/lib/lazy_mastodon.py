@@ -0,0 +1,110 @@
+from pyxavi.config import Config
+from pyxavi.mastodon_helper import MastodonHelper, MastodonConnectionParams
+from echobot.lib.locked_storage import LockedStorage, get_storage_params
+from datetime import datetime, timedelta
+from threading import Lock
+import logging
+import pytz
+import os
+
+
+class LazyMastodon:
+    '''
+    Stands for the Mastodon API client, connecting it only on first use
+
+    Setting up the client already talks to the server, so a run with nothing
+    to publish would pay for it anyway. The bot account returned by me(),
+    that also verifies the token, and the API base URL are cached in a small
+    storage for the identity_ttl, so the parsers can ask for them with no
+    round trip. Anything else connects the client and goes to it.
+    '''
+
+    DEFAULT_IDENTITY_TTL = 86400
+    DEFAULT_IDENTITY_FILE = "storage/identity.yaml"
+    # What is kept from the bot account
+    IDENTITY_FIELDS = ["id", "username", "acct", "url"]
+
+    def __init__(
+        self,
+        config: Config,
+        connection_params: MastodonConnectionParams,
+        base_path: str = None
+    ) -> None:
+        self._logger = logging.getLogger(config.get("logger.name"))
+        self._connection_params = connection_params
+        self._base_path = base_path
+        self._identity_ttl = config.get("publisher.identity_ttl", self.DEFAULT_IDENTITY_TTL)
+        identity_file = config.get("publisher.identity_file", self.DEFAULT_IDENTITY_FILE)
+        if base_path is not None and not os.path.isabs(identity_file):
+            identity_file = os.path.join(base_path, identity_file)
+        self._identity_storage = LockedStorage(identity_file, **get_storage_params(config))
+        # Several bots may share the file, every account keeps its own entry
+        self._identity_key = f"{connection_params.api_base_url}#" +\
+            f"{connection_params.credentials.user_file}"
+        self._lock = Lock()
+        self._instance = None
+
+    def get_instance(self):
+        with self._lock:
+            if self._instance is None:
+                self._logger.debug("Connecting to the Mastodon API on first use")
+                self._instance = MastodonHelper.get_instance(
+                    connection_params=self._connection_params,
+                    logger=self._logger,
+                    base_path=self._base_path
+                )
+            return self._instance
+
+    def is_connected(self) -> bool:
+        return self._instance is not None
+
+    def me(self) -> dict:
+        """
+        The bot account, verifying the token at most once every identity_ttl.
+            Only the IDENTITY_FIELDS are returned, cached or not, so callers
+            get the same shape either way.
+        """
+        identity = self._get_fresh_identity()
+        if identity is not None:
+            return identity["account"]
+
+        instance = self.get_instance()
+        account = instance.me()
+        kept_account = {}
+        for field in self.IDENTITY_FIELDS:
+            kept_account[field] = account.get(field, None)
+        self._identity_storage.set_hashed(
+            self._identity_key,
+            {
+                "account": kept_account,
+                "api_base_url": instance.api_base_url,
+                "verified_at": datetime.now(tz=pytz.UTC)
+            }
+        )
+        self._identity_storage.write_file()
+        return kept_account
+
+    @property
+    def api_base_url(self) -> str:
+        identity = self._get_fresh_identity()
+        if identity is not None:
+            return identity["api_base_url"]
+        return self.get_instance().api_base_url
+
+    def _get_fresh_identity(self) -> dict:
+        identity = self._identity_storage.get_hashed(self._identity_key, None)
+        if not identity or not identity.get("verified_at", None):
+            return None
+
+        verified_at = identity["verified_at"]
+        if verified_at.tzinfo is None:
+            verified_at = verified_at.replace(tzinfo=pytz.UTC)
+        if verified_at + timedelta(seconds=self._identity_ttl) < datetime.now(tz=pytz.UTC):
+            return None
+        return identity
+
+    def __getattr__(self, name: str) -> any:
+        # Only reached for what is not defined here, the API methods
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.get_instance(), name)
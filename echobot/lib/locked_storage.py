@@ -0,0 +1,268 @@
+from pyxavi.config import Config
+from pyxavi.storage import Storage
+from pyxavi.queue_stack import Queue, QueueItemProtocol
+from echobot.lib.file_lock import FileLock
+from echobot.lib.queue_item import QueueItem
+from echobot.lib.shard import Shard
+from echobot.lib.serializer import Serializer
+from contextlib import contextmanager
+from pathlib import Path
+import logging
+import glob
+import os
+
+
+def get_storage_params(config: Config) -> dict:
+    """
+    The lock timeout and lease, and the serializer, for the storage and queue files
+    """
+    return {**FileLock.get_params(config), "serializer": Serializer.from_config(config)}
+
+
+def get_storage_files(filename: str) -> list:
+    """
+    The storage file and the partitions that the shards made of it
+    """
+    root, extension = os.path.splitext(filename)
+    return [filename] + sorted(glob.glob(f"{root}.shard-*{extension}"))
+
+
+class LockedStorage(Storage):
+    '''
+    A Storage that can be shared by processes running at the same time
+
+    Writing takes the file lock, reads what is on disk and applies over it
+    only the keys that were set here, so the keys written by others are kept.
+    For a whole load-modify-save cycle over the same keys use locked().
+    '''
+
+    def __init__(
+        self,
+        filename: str,
+        timeout: float = None,
+        lease: int = None,
+        serializer: Serializer = None
+    ) -> None:
+        self._lock = FileLock(f"{filename}.lock", timeout=timeout, lease=lease)
+        self._serializer = serializer if serializer is not None else Serializer()
+        self._is_locked = False
+        self._changed_keys = set()
+        super().__init__(filename=filename)
+
+    def read_file(self) -> None:
+        if os.path.exists(self._filename):
+            self._content = self._serializer.load_file(self._filename) or {}
+        else:
+            Path(self._filename).touch()
+            self._content = {}
+        self._changed_keys = set()
+
+    def set(self, param_name: str, value: any = None) -> None:
+        super().set(param_name, value)
+        self._changed_keys.add(param_name.split(self._separator)[0])
+
+    def write_file(self) -> None:
+        if self._is_locked:
+            self._serializer.write_file(self._filename, self._content)
+            self._changed_keys = set()
+            return
+
+        with self._lock:
+            changes = {
+                key: self._content[key]
+                for key in self._changed_keys if key in self._content
+            }
+            self.read_file()
+            self._content.update(changes)
+            self._serializer.write_file(self._filename, self._content)
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds the lock and works over a fresh copy of the file
+        """
+        with self._lock:
+            self._is_locked = True
+            try:
+                self.read_file()
+                yield self
+            finally:
+                self._is_locked = False
+
+
+class ShardedStorage(LockedStorage):
+    '''
+    The partition of a storage file that belongs to a shard
+
+    When a source comes to this shard, because the amount of shards changed,
+    its state is moved here from the partition that had it, or from the
+    storage used before sharding, so it is not parsed again from scratch.
+    '''
+
+    def __init__(
+        self,
+        filename: str,
+        shard: Shard,
+        timeout: float = None,
+        lease: int = None,
+        serializer: Serializer = None
+    ) -> None:
+        self._base_filename = filename
+        self._storage_params = {"timeout": timeout, "lease": lease, "serializer": serializer}
+        self._searched_keys = set()
+        super().__init__(
+            shard.get_partition_file(filename),
+            timeout=timeout,
+            lease=lease,
+            serializer=serializer
+        )
+
+    def get(self, param_name: str = "", default_value: any = None) -> any:
+        key = param_name.split(self._separator)[0]
+        if key and key not in self._content and key not in self._searched_keys:
+            self._searched_keys.add(key)
+            self._adopt(key)
+        return super().get(param_name, default_value)
+
+    def _adopt(self, key: str) -> None:
+        for candidate in get_storage_files(self._base_filename):
+            # Files are replaced atomically, so looking without the lock is safe
+            if candidate == self._filename\
+                    or key not in (self._serializer.load_file(candidate) or {}):
+                continue
+
+            other = LockedStorage(candidate, **self._storage_params)
+            with other.locked():
+                value = other.get(key, None)
+                if value is None:
+                    continue
+                # Keep it here before removing it from there, never lose it
+                self.set(key, value)
+                self.write_file()
+                del other._content[key]
+                other.write_file()
+            return
+
+
+def get_storage(filename: str, shard: Shard = None, **storage_params) -> LockedStorage:
+    """
+    The storage for the given file, or its partition when running as a shard
+    """
+    if shard is None:
+        return LockedStorage(filename, **storage_params)
+    return ShardedStorage(filename, shard, **storage_params)
+
+
+class LockedQueue(Queue):
+    '''
+    A Queue that can be shared by processes running at the same time
+
+    For a whole load-modify-save cycle use locked(): the queue is loaded
+    again while holding the file lock, keeping the items appended here
+    meanwhile, and saved without anybody writing in between. This is how
+    the parsers and the dead letters add to it.
+
+    Saving out of locked() takes the file lock and merges with what is on
+    disk: the items that others added since it was loaded are kept, the ones
+    removed here or by the others stay removed and the ones changed here keep
+    the changes. The Publisher saves this way, as it can't hold the lock while
+    publishing, and it is the only one removing: one run publishes at a time.
+    '''
+
+    def __init__(
+        self,
+        logger: logging.Logger = None,
+        storage_file: str = None,
+        queue_item_object: QueueItemProtocol = QueueItem,
+        timeout: float = None,
+        lease: int = None,
+        serializer: Serializer = None
+    ) -> None:
+        self._storage_file = storage_file
+        self._lock = FileLock(f"{storage_file}.lock", timeout=timeout, lease=lease)\
+            if storage_file is not None else None
+        self._serializer = serializer if serializer is not None else Serializer()
+        self._loaded_identities = set()
+        self._is_locked = False
+        super().__init__(
+            logger=logger, storage_file=storage_file, queue_item_object=queue_item_object
+        )
+
+    def load(self) -> int:
+        if self._storage_file is None:
+            super().load()
+        else:
+            self._queue = self._read_items()
+        self._loaded_identities = set([self._identity(item) for item in self._queue])
+        return self.length()
+
+    def _read_items(self) -> list:
+        content = self._serializer.load_file(self._storage_file) or {}
+        return [
+            self._queue_item_object.from_dict(item) for item in content.get("queue", None) or []
+        ]
+
+    def save(self) -> None:
+        if self._lock is None:
+            return super().save()
+
+        if self._is_locked:
+            self._write_items()
+            return
+
+        with self._lock:
+            local_items = self._queue
+            local_identities = set([self._identity(item) for item in local_items])
+            self._queue = self._read_items()
+            disk_identities = set([self._identity(item) for item in self._queue])
+            # Loaded here but gone from the disk: others published them already
+            removed_by_others = self._loaded_identities - disk_identities
+            foreign_items = [
+                item for item in self._queue
+                if self._identity(item) not in self._loaded_identities and
+                self._identity(item) not in local_identities
+            ]
+            self._queue = [
+                item for item in local_items if self._identity(item) not in removed_by_others
+            ] + foreign_items
+            if foreign_items:
+                self._logger.debug("Merging %d items queued by others", len(foreign_items))
+                self.sort(param="published_at")
+
+            self._write_items()
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds the lock and works over a fresh copy of the file, plus the items
+            appended here since the last load
+        """
+        if self._lock is None:
+            yield self
+            return
+
+        with self._lock:
+            appended = [
+                item for item in self._queue
+                if self._identity(item) not in self._loaded_identities
+            ]
+            self.load()
+            for item in appended:
+                if self._identity(item) not in self._loaded_identities:
+                    self._queue.append(item)
+            self._is_locked = True
+            try:
+                yield self
+            finally:
+                self._is_locked = False
+
+    def _write_items(self) -> None:
+        self._logger.debug("Saving the queue")
+        self._serializer.write_file(
+            self._storage_file, {"queue": [item.to_dict() for item in self._queue]}
+        )
+        self._loaded_identities = set([self._identity(item) for item in self._queue])
+
+    def _identity(self, item: QueueItemProtocol) -> str:
+        # Without a param the QueueItem identifies itself by its own kind
+        return str(item.unique_value())
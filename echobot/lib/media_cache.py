@@ -0,0 +1,145 @@
+from pyxavi.config import Config
+from echobot.lib.locked_storage import LockedQueue, get_storage_params
+from datetime import datetime, timedelta
+import logging
+import time
+import os
+
+
+class MediaCache:
+    '''
+    Keeps the media storage directory within a size and age budget
+
+    Files are evicted the least recently used first. Files that are still
+    referenced by the items in the queue or in the dead letters, that may
+    be requeued, are never evicted.
+    '''
+
+    DEFAULT_MEDIA_STORAGE = "storage/media/"
+    DEFAULT_QUEUE_FILE = "storage/queue.yaml"
+    DEFAULT_DEAD_LETTER_FILE = "storage/dead_letter.yaml"
+    DEFAULT_MAX_SIZE_MB = 500
+    DEFAULT_MAX_AGE_DAYS = 30
+    IGNORED_FILES = [".keep"]
+
+    def __init__(self, config: Config, base_path: str = None) -> None:
+        self._config = config
+        self._logger = logging.getLogger(config.get("logger.name"))
+        self._base_path = base_path
+        self._directory = self._get_path(
+            config.get("publisher.media_storage", self.DEFAULT_MEDIA_STORAGE)
+        )
+        self._queue_file = self._get_path(
+            config.get("toots_queue_storage.file", self.DEFAULT_QUEUE_FILE)
+        )
+        self._dead_letter_file = self._get_path(
+            config.get("publisher.dead_letter_file", self.DEFAULT_DEAD_LETTER_FILE)
+        )
+        self._max_size = config.get(
+            "media_cache.max_size_mb", self.DEFAULT_MAX_SIZE_MB
+        ) * 1024 * 1024
+        self._max_age = timedelta(
+            days=config.get("media_cache.max_age_days", self.DEFAULT_MAX_AGE_DAYS)
+        )
+
+    def _get_path(self, path: str) -> str:
+        if self._base_path is not None and not os.path.isabs(path):
+            path = os.path.join(self._base_path, path)
+        return os.path.realpath(path)
+
+    def contains(self, path: str) -> bool:
+        return os.path.dirname(self._get_path(path)) == self._directory
+
+    def touch(self, path: str) -> None:
+        """
+        Marks the file as recently used, so it goes to the end of the eviction list
+        """
+        if isinstance(path, str) and self.contains(path) and os.path.exists(path):
+            os.utime(path)
+
+    def get_reference_counts(self) -> dict:
+        """
+        Counts how many queued and dead lettered items reference each media file
+        """
+        references = {}
+        for storage_file in [self._queue_file, self._dead_letter_file]:
+            queue = LockedQueue(
+                logger=self._logger,
+                storage_file=storage_file,
+                **get_storage_params(self._config)
+            )
+            for queued_item in queue.get_all():
+                item = queued_item.to_dict()
+                if "media" not in item or not item["media"]:
+                    continue
+                for media in item["media"]:
+                    if "path" in media and media["path"]:
+                        path = self._get_path(media["path"])
+                        references[path] = references.get(path, 0) + 1
+
+        return references
+
+    def get_files(self) -> list:
+        """
+        Returns the files in the cache, sorted from the least to the most recently used
+        """
+        files = []
+        with os.scandir(self._directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name in self.IGNORED_FILES:
+                    continue
+                stat = entry.stat()
+                files.append(
+                    {
+                        "path": os.path.realpath(entry.path),
+                        "size": stat.st_size,
+                        "last_used": max(stat.st_atime, stat.st_mtime)
+                    }
+                )
+
+        return sorted(files, key=lambda x: x["last_used"])
+
+    def vacuum(self) -> dict:
+        """
+        Removes the files that are too old, and then the least recently used ones
+            until the cache fits into the size budget.
+
+        Returns a summary of the work done.
+        """
+        references = self.get_reference_counts()
+        files = self.get_files()
+        size_before = sum([file["size"] for file in files])
+        oldest_allowed = time.mktime((datetime.now() - self._max_age).timetuple())
+
+        current_size = size_before
+        removed_files = 0
+        kept_by_reference = 0
+        for file in files:
+            too_old = file["last_used"] < oldest_allowed
+            too_big = current_size > self._max_size
+            if not too_old and not too_big:
+                # The files are sorted by usage, so the rest are fine too.
+                break
+
+            if references.get(file["path"], 0) > 0:
+                self._logger.debug(
+                    "Keeping %s, it is referenced %d times in the queue or the dead letters",
+                    file["path"],
+                    references[file["path"]]
+                )
+                kept_by_reference += 1
+                continue
+
+            self._logger.debug("Evicting %s (%d bytes)", file["path"], file["size"])
+            os.remove(file["path"])
+            current_size -= file["size"]
+            removed_files += 1
+
+        return {
+            "files_before": len(files),
+            "files_removed": removed_files,
+            "files_kept_by_reference": kept_by_reference,
+            "bytes_before": size_before,
+            "bytes_after": current_size,
+            "bytes_reclaimed": size_before - current_size,
+        }
@@ -0,0 +1,193 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from echobot.lib.publisher import Publisher
+from echobot.lib.run_metrics import RunMetrics
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from hashlib import sha1
+from urllib.parse import urlparse
+import mimetypes
+import requests
+import logging
+import pytz
+import time
+import os
+
+
+class MediaPrefetcher:
+    '''
+    Prepares the media of the queued posts that are about to be published
+
+    It downloads, validates and uploads the media of the next items in the queue
+    and stores the resulting media IDs into the queue item itself,
+    so that the publishing only needs the status call.
+    '''
+
+    DEFAULT_LOOKAHEAD = 5
+    DEFAULT_WORKERS = 4
+    DEFAULT_MAX_SIZE_MB = 40
+    DEFAULT_DOWNLOAD_TIMEOUT = 30
+    DEFAULT_DOWNLOAD_DEADLINE = 120
+    DEFAULT_MEDIA_STORAGE = "storage/media/"
+    ACCEPTED_MIME_TYPES = ["image/", "video/", "audio/"]
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(
+        self,
+        config: Config,
+        publisher: Publisher,
+        metrics: RunMetrics = None,
+        base_path: str = None
+    ) -> None:
+        self._config = config
+        self._logger = logging.getLogger(config.get("logger.name"))
+        self._publisher = publisher
+        self._metrics = metrics if metrics is not None else RunMetrics(config)
+        self._lookahead = config.get(
+            "publisher.media_prefetch.lookahead", self.DEFAULT_LOOKAHEAD
+        )
+        self._workers = config.get("publisher.media_prefetch.workers", self.DEFAULT_WORKERS)
+        self._max_size = config.get(
+            "publisher.media_prefetch.max_size_mb", self.DEFAULT_MAX_SIZE_MB
+        ) * 1024 * 1024
+        self._timeout = config.get(
+            "publisher.media_prefetch.download_timeout", self.DEFAULT_DOWNLOAD_TIMEOUT
+        )
+        # The timeout applies to every read, a server sending drop by drop needs a deadline
+        self._deadline = config.get(
+            "publisher.media_prefetch.download_deadline", self.DEFAULT_DOWNLOAD_DEADLINE
+        )
+        self._media_storage = config.get("publisher.media_storage", self.DEFAULT_MEDIA_STORAGE)
+        if base_path is not None and not os.path.isabs(self._media_storage):
+            self._media_storage = os.path.join(base_path, self._media_storage)
+
+    def prefetch(self) -> int:
+        """
+        Prefetches the media for the upcoming queue items.
+
+        Returns the amount of queue items that got their media ready.
+        """
+        if self._config.get("publisher.dry_run", False):
+            self._logger.debug("It's a Dry Run, not prefetching media.")
+            return 0
+
+        upcoming = self._get_upcoming_items()
+        if not upcoming:
+            self._logger.debug("No upcoming queue items need media, skipping prefetch")
+            return 0
+
+        self._logger.info(
+            f"{TerminalColor.CYAN}Prefetching media for {len(upcoming)}" +
+            f" queue items{TerminalColor.END}"
+        )
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            prefetched = sum(executor.map(self._prefetch_item, upcoming))
+
+        if prefetched > 0:
+            with self._metrics.stage("queue.save"):
+                self._publisher._queue.save()
+        self._logger.info(f"Media is ready for {prefetched} of {len(upcoming)} queue items")
+        self._publisher.log_media_savings()
+
+        return prefetched
+
+    def _get_upcoming_items(self) -> list:
+        """
+        The items that are going to be published soon are the first ones in the queue.
+        We only care about new posts with media that are not already prepared.
+        """
+        upcoming = []
+        for queued_item in self._publisher._queue.get_all()[:self._lookahead]:
+            item = queued_item.to_dict()
+            if item.get("action", None) != "new" or not item.get("media", None):
+                continue
+            if self._publisher.get_prefetched_media_ids(item) is not None:
+                continue
+            upcoming.append(item)
+
+        return upcoming
+
+    def _prefetch_item(self, item: dict) -> bool:
+        # The item is the same dict object that lives in the queue,
+        #   so updating it here updates the queue.
+        media_ids = []
+        for media in item["media"]:
+            try:
+                local_file = self._get_local_file(media)
+                uploaded = self._publisher.upload_media_file(
+                    media_file=local_file["file"],
+                    mime_type=local_file["mime_type"],
+                    description=media.get("alt_text", None)
+                )
+                media_ids.append(uploaded["id"])
+            except Exception as e:
+                # Leave the item untouched, the publishing will try again the usual way
+                self._logger.warning(
+                    f"{TerminalColor.RED}Could not prefetch media " +
+                    f"{media.get('url', media.get('path', None))}: {e}{TerminalColor.END}"
+                )
+                return False
+
+        item["media_ids"] = media_ids
+        item["media_uploaded_at"] = datetime.now(tz=pytz.UTC)
+        return True
+
+    def _get_local_file(self, media: dict) -> dict:
+        if "path" in media and media["path"] is not None:
+            return self._validate_file(media["path"], media.get("mime_type", None))
+        elif "url" in media and media["url"] is not None:
+            with self._metrics.stage("media.download"):
+                return self._download(media["url"])
+        else:
+            raise RuntimeError("The media does not have an URL or a PATH")
+
+    def _download(self, url: str) -> dict:
+        # Name the file after the URL, as different sites tend to reuse file names
+        extension = os.path.splitext(urlparse(url).path)[1]
+        filename = os.path.join(self._media_storage, sha1(url.encode()).hexdigest() + extension)
+
+        deadline = time.monotonic() + self._deadline
+        response = requests.get(url, stream=True, allow_redirects=True, timeout=self._timeout)
+        with response:
+            if not response.ok:
+                raise RuntimeError(f"Download failed with status {response.status_code}")
+
+            mime_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+            if not mime_type:
+                mime_type = mimetypes.guess_type(url)[0]
+            self._validate_mime_type(mime_type)
+
+            downloaded_bytes = 0
+            error = None
+            with open(filename, "wb") as handle:
+                for block in response.iter_content(self.CHUNK_SIZE):
+                    downloaded_bytes += len(block)
+                    if downloaded_bytes > self._max_size:
+                        error = f"Media is bigger than the allowed {self._max_size} bytes"
+                        break
+                    if time.monotonic() > deadline:
+                        error = f"Download did not finish in {self._deadline} seconds"
+                        break
+                    handle.write(block)
+
+        if error is not None:
+            os.remove(filename)
+            raise RuntimeError(error)
+
+        return {"file": filename, "mime_type": mime_type}
+
+    def _validate_file(self, path: str, mime_type: str = None) -> dict:
+        if not os.path.exists(path):
+            raise RuntimeError(f"File {path} does not exist")
+        if os.path.getsize(path) > self._max_size:
+            raise RuntimeError(f"File {path} is bigger than the allowed {self._max_size} bytes")
+
+        mime_type = mime_type if mime_type else mimetypes.guess_type(path)[0]
+        self._validate_mime_type(mime_type)
+
+        return {"file": path, "mime_type": mime_type}
+
+    def _validate_mime_type(self, mime_type: str) -> None:
+        if mime_type is None or \
+           not any([mime_type.startswith(accepted) for accepted in self.ACCEPTED_MIME_TYPES]):
+            raise RuntimeError(f"Mime type [{mime_type}] is not accepted as media")
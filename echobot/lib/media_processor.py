@@ -0,0 +1,157 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from hashlib import sha256
+from threading import Lock
+import logging
+import os
+
+# Pillow is optional. Without it the media is uploaded untouched.
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+
+class MediaProcessor:
+    '''
+    Downscales and recompresses the images before they get uploaded
+
+    The processed output is cached in the media storage by the hash of
+    the original content, and the original is used whenever the processing
+    fails or does not make the file smaller.
+    '''
+
+    DEFAULT_MEDIA_STORAGE = "storage/media/"
+    DEFAULT_MAX_DIMENSION = 1920
+    DEFAULT_QUALITY = 85
+    DEFAULT_MIN_QUALITY = 50
+    DEFAULT_MAX_SIZE_KB = None
+    QUALITY_STEP = 10
+    PROCESSABLE_MIME_TYPES = ["image/jpeg", "image/png", "image/webp"]
+    CACHED_FILE_PREFIX = "processed-"
+    HASH_BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, config: Config, base_path: str = None) -> None:
+        self._config = config
+        self._logger = logging.getLogger(config.get("logger.name"))
+        self._is_active = config.get("publisher.media_processing.active", False)
+        self._max_dimension = config.get(
+            "publisher.media_processing.max_dimension", self.DEFAULT_MAX_DIMENSION
+        )
+        self._quality = config.get("publisher.media_processing.quality", self.DEFAULT_QUALITY)
+        self._min_quality = config.get(
+            "publisher.media_processing.min_quality", self.DEFAULT_MIN_QUALITY
+        )
+        max_size_kb = config.get(
+            "publisher.media_processing.max_size_kb", self.DEFAULT_MAX_SIZE_KB
+        )
+        self._max_size = max_size_kb * 1024 if max_size_kb else None
+        self._directory = config.get("publisher.media_storage", self.DEFAULT_MEDIA_STORAGE)
+        if base_path is not None and not os.path.isabs(self._directory):
+            self._directory = os.path.join(base_path, self._directory)
+
+        self._lock = Lock()
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+        if self._is_active and Image is None:
+            self._logger.warning(
+                "Media processing is active but Pillow is not installed. Skipping it."
+            )
+            self._is_active = False
+
+    def get_bytes_saved(self) -> int:
+        return self.bytes_before - self.bytes_after
+
+    def process(self, media_file: str, mime_type: str = None) -> dict:
+        """
+        Returns the file to upload, the processed one or the original.
+        """
+        original = {"file": media_file, "mime_type": mime_type}
+        if not self._is_active or not isinstance(media_file, str) \
+           or mime_type not in self.PROCESSABLE_MIME_TYPES:
+            return original
+
+        try:
+            original_size = os.path.getsize(media_file)
+            content_hash = self._hash_file(media_file)
+            processed = self._get_cached(content_hash)
+            if processed is None:
+                processed = self._process_image(media_file, content_hash)
+        except Exception as e:
+            self._logger.warning(
+                f"{TerminalColor.RED}Could not process {media_file}, " +
+                f"using the original: {e}{TerminalColor.END}"
+            )
+            return original
+
+        if processed is None:
+            self._logger.debug("%s is animated, using the original", media_file)
+            return original
+
+        processed_size = os.path.getsize(processed["file"])
+        if processed_size >= original_size:
+            self._logger.debug("Processing does not reduce %s, using the original", media_file)
+            return original
+
+        with self._lock:
+            self.bytes_before += original_size
+            self.bytes_after += processed_size
+        self._logger.debug(
+            "Processed %s: %d -> %d bytes", media_file, original_size, processed_size
+        )
+        return processed
+
+    def _hash_file(self, media_file: str) -> str:
+        # The settings are part of the hash, so changing them invalidates the cache
+        settings = f"{self._max_dimension}:{self._quality}:{self._min_quality}:{self._max_size}"
+        content_hash = sha256(settings.encode())
+        with open(media_file, "rb") as handle:
+            for block in iter(lambda: handle.read(self.HASH_BLOCK_SIZE), b""):
+                content_hash.update(block)
+        return content_hash.hexdigest()
+
+    def _get_cached_filename(self, content_hash: str, extension: str) -> str:
+        return os.path.join(
+            self._directory, f"{self.CACHED_FILE_PREFIX}{content_hash}{extension}"
+        )
+
+    def _get_cached(self, content_hash: str) -> dict:
+        for extension, mime_type in [(".jpg", "image/jpeg"), (".png", "image/png")]:
+            filename = self._get_cached_filename(content_hash, extension)
+            if os.path.exists(filename):
+                self._logger.debug("Reusing the processed file %s", filename)
+                return {"file": filename, "mime_type": mime_type}
+        return None
+
+    def _process_image(self, media_file: str, content_hash: str) -> dict:
+        """
+        Returns None for the animated images, that would be left with the first frame
+        """
+        with Image.open(media_file) as image:
+            if getattr(image, "is_animated", False):
+                return None
+
+            # Respect the orientation, as the EXIF data is lost when re-encoding
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((self._max_dimension, self._max_dimension))
+
+            # Keep the transparency when there is some, otherwise JPEG is smaller
+            if image.mode in ("RGBA", "LA") or \
+               (image.mode == "P" and "transparency" in image.info):
+                filename = self._get_cached_filename(content_hash, ".png")
+                image.save(filename, format="PNG", optimize=True)
+                return {"file": filename, "mime_type": "image/png"}
+
+            filename = self._get_cached_filename(content_hash, ".jpg")
+            image = image.convert("RGB")
+            quality = self._quality
+            while True:
+                image.save(filename, format="JPEG", quality=quality, optimize=True)
+                if self._max_size is None or os.path.getsize(filename) <= self._max_size\
+                   or quality - self.QUALITY_STEP < self._min_quality:
+                    break
+                quality -= self.QUALITY_STEP
+
+            return {"file": filename, "mime_type": "image/jpeg"}
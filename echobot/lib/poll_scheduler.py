@@ -0,0 +1,92 @@
+from pyxavi.config import Config
+from datetime import datetime, timedelta
+import logging
+import pytz
+
+
+class PollScheduler:
+    '''
+    Decides when a source needs to be polled again
+
+    Every source keeps a small polling state in its own storage: the dates
+    of its most recent posts, the current interval and the next due date.
+    The interval follows the observed publishing rate, polling a few times
+    between posts, and backs off while nothing new appears. Both ends are
+    bounded by min_interval and max_interval, which a source can override.
+    '''
+
+    DEFAULT_MIN_INTERVAL = 600
+    DEFAULT_MAX_INTERVAL = 86400
+    DEFAULT_BACKOFF_FACTOR = 1.5
+    DEFAULT_POLLS_PER_POST = 2
+    DEFAULT_HISTORY_LENGTH = 10
+
+    def __init__(self, config: Config) -> None:
+        self._logger = logging.getLogger(config.get("logger.name"))
+        self._is_active = config.get("polling.active", False)
+        self._min_interval = config.get("polling.min_interval", self.DEFAULT_MIN_INTERVAL)
+        self._max_interval = config.get("polling.max_interval", self.DEFAULT_MAX_INTERVAL)
+        self._backoff_factor = config.get("polling.backoff_factor", self.DEFAULT_BACKOFF_FACTOR)
+        self._polls_per_post = config.get("polling.polls_per_post", self.DEFAULT_POLLS_PER_POST)
+        self._history_length = config.get("polling.history_length", self.DEFAULT_HISTORY_LENGTH)
+
+    def is_due(self, state: dict, now: datetime = None, enforce: bool = False) -> bool:
+        """
+        With enforce the due date is respected even if the adaptive polling
+            is not active, for sources that get their updates in another way.
+        """
+        if not (self._is_active or enforce) or not state or not state.get("next_due_at", None):
+            return True
+
+        now = now if now is not None else datetime.now(tz=pytz.UTC)
+        return now >= self._as_utc(state["next_due_at"])
+
+    def schedule(
+        self,
+        state: dict,
+        published_dates: list,
+        source_params: dict = None,
+        now: datetime = None
+    ) -> dict:
+        """
+        Returns the new polling state after a poll that found
+            new posts published at the given dates.
+        """
+        state = dict(state) if state else {}
+        source_params = source_params if source_params is not None else {}
+        now = now if now is not None else datetime.now(tz=pytz.UTC)
+        min_interval = source_params.get("min_interval", self._min_interval)
+        max_interval = source_params.get("max_interval", self._max_interval)
+
+        recent = [self._as_utc(date) for date in state.get("recent_published_at", [])]
+        recent += [self._as_utc(date) for date in published_dates if date is not None]
+        recent = sorted(set(recent))[-self._history_length:]
+
+        # The average time between posts, the inverse of the publishing rate
+        average_gap = (recent[-1] - recent[0]).total_seconds() / (len(recent) - 1)\
+            if len(recent) >= 2 else None
+        interval = average_gap / self._polls_per_post if average_gap else min_interval
+        if not published_dates and state.get("interval", None):
+            # Nothing new, back off but never below what the rate tells
+            interval = max(interval, state["interval"] * self._backoff_factor)
+        interval = int(min(max(interval, min_interval), max_interval))
+
+        state.update(
+            {
+                "recent_published_at": recent,
+                "average_gap": round(average_gap) if average_gap else None,
+                "interval": interval,
+                "last_polled_at": now,
+                "next_due_at": now + timedelta(seconds=interval)
+            }
+        )
+        self._logger.debug(
+            "Next poll in %d seconds, average gap between posts is %s seconds",
+            interval,
+            state["average_gap"]
+        )
+        return state
+
+    def _as_utc(self, date: datetime) -> datetime:
+        return date.replace(tzinfo=pytz.UTC) if date.tzinfo is None\
+            else date.astimezone(pytz.UTC)
@@ -0,0 +1,146 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from datetime import datetime
+from threading import Thread, Event, get_ident
+import tracemalloc
+import cProfile
+import logging
+import pstats
+import sys
+import io
+import os
+
+
+class Profiler:
+    '''
+    Wraps a callable to profile it
+
+    With profile it writes the cProfile stats and a collapsed stack file,
+    sampled from the running threads, ready for flamegraph tools.
+    With trace_malloc it writes the top allocations seen by tracemalloc.
+    Everything goes into a timestamped directory.
+    '''
+
+    DEFAULT_DIRECTORY = "storage/profiles"
+    DEFAULT_SAMPLE_INTERVAL_MS = 5
+    DEFAULT_TOP_N = 25
+    DEFAULT_TRACEBACK_FRAMES = 10
+    PROFILE_FILE = "profile.prof"
+    PROFILE_SUMMARY_FILE = "profile.txt"
+    COLLAPSED_STACKS_FILE = "stacks.collapsed"
+    TRACE_MALLOC_FILE = "tracemalloc.txt"
+
+    def __init__(
+        self,
+        config: Config,
+        name: str,
+        profile: bool = True,
+        trace_malloc: bool = False,
+        base_path: str = None
+    ) -> None:
+        self._logger = logging.getLogger(config.get("logger.name"))
+        self._profile = profile
+        self._trace_malloc = trace_malloc
+        self._sample_interval = config.get(
+            "profiler.sample_interval_ms", self.DEFAULT_SAMPLE_INTERVAL_MS
+        ) / 1000
+        self._top_n = config.get("profiler.top_n", self.DEFAULT_TOP_N)
+        self._traceback_frames = config.get(
+            "profiler.traceback_frames", self.DEFAULT_TRACEBACK_FRAMES
+        )
+        directory = config.get("profiler.directory", self.DEFAULT_DIRECTORY)
+        if base_path is not None:
+            directory = os.path.join(base_path, directory)
+        self.output_dir = os.path.join(
+            directory, datetime.now().strftime("%Y%m%d-%H%M%S") + f"-{name}"
+        )
+
+        self._samples = {}
+        self._stop_sampling = Event()
+
+    def run(self, function: callable) -> any:
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        if self._trace_malloc:
+            tracemalloc.start(self._traceback_frames)
+        if self._profile:
+            profiler = cProfile.Profile()
+            sampler = Thread(target=self._sample, daemon=True)
+            sampler.start()
+            profiler.enable()
+
+        try:
+            return function()
+        finally:
+            if self._profile:
+                profiler.disable()
+                self._stop_sampling.set()
+                sampler.join()
+                self._write_profile(profiler)
+                self._write_collapsed_stacks()
+            if self._trace_malloc and tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self._write_trace_malloc(snapshot, peak)
+            elif self._trace_malloc:
+                self._logger.warning("The memory tracing was stopped by the runner itself")
+
+            self._logger.info(
+                f"{TerminalColor.CYAN}Profiling results written into " +
+                f"{self.output_dir}{TerminalColor.END}"
+            )
+
+    def _sample(self) -> None:
+        sampler_thread_id = get_ident()
+        while not self._stop_sampling.wait(self._sample_interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_thread_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}" +
+                        f":{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                collapsed = ";".join(reversed(stack))
+                self._samples[collapsed] = self._samples.get(collapsed, 0) + 1
+
+    def _write_profile(self, profiler: cProfile.Profile) -> None:
+        profiler.dump_stats(os.path.join(self.output_dir, self.PROFILE_FILE))
+
+        summary = io.StringIO()
+        stats = pstats.Stats(profiler, stream=summary)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self._top_n)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(self._top_n)
+        with open(os.path.join(self.output_dir, self.PROFILE_SUMMARY_FILE), "w") as handle:
+            handle.write(summary.getvalue())
+
+    def _write_collapsed_stacks(self) -> None:
+        with open(os.path.join(self.output_dir, self.COLLAPSED_STACKS_FILE), "w") as handle:
+            for stack, count in sorted(self._samples.items()):
+                handle.write(f"{stack} {count}\n")
+
+    def _write_trace_malloc(self, snapshot: tracemalloc.Snapshot, peak: int) -> None:
+        snapshot = snapshot.filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            ]
+        )
+        statistics = snapshot.statistics("traceback")
+        total = sum([statistic.size for statistic in statistics])
+        with open(os.path.join(self.output_dir, self.TRACE_MALLOC_FILE), "w") as handle:
+            handle.write(f"Peak traced memory: {peak / 1024:.1f} KiB\n")
+            handle.write(f"Still allocated at the end: {total / 1024:.1f} KiB\n\n")
+            for index, statistic in enumerate(statistics[:self._top_n], start=1):
+                handle.write(
+                    f"#{index}: {statistic.size / 1024:.1f} KiB in {statistic.count} blocks\n"
+                )
+                for line in statistic.traceback.format(most_recent_first=True):
+                    handle.write(f"    {line}\n")
+                handle.write("\n")
@@ -1,10 +1,23 @@
 from pyxavi.config import Config
-from pyxavi.logger import Logger
 from pyxavi.terminal_color import TerminalColor
-from pyxavi.mastodon_publisher import MastodonPublisher
-from pyxavi.queue_stack import Queue
+from pyxavi.mastodon_publisher import MastodonPublisher, MastodonPublisherException
+from pyxavi.media import Media
 from pyxavi.mastodon_helper import MastodonConnectionParams,\
     StatusPost, StatusPostVisibility, StatusPostContentType
+from echobot.lib.media_cache import MediaCache
+from echobot.lib.media_processor import MediaProcessor
+from echobot.lib.dead_letter import (
+    DeadLetterQueue, UnavailableMediaException, ExpiredStreamedMediaException
+)
+from echobot.lib.lazy_mastodon import LazyMastodon
+from echobot.lib.queue_item import QueueItem
+from echobot.lib.run_metrics import RunMetrics
+from echobot.lib.locked_storage import LockedQueue, get_storage_params
+from datetime import datetime, timedelta
+from typing import IO
+from requests import Response
+import logging
+import pytz
 import os
 
 
@@ -24,21 +37,41 @@ class Publisher(MastodonPublisher):
         "username_to_dm": None
     }
     DEFAULT_QUEUE_FILE = "storage/queue.yaml"
+    # Unattached media is removed by the server after a while (24h in Mastodon)
+    DEFAULT_PREFETCHED_MEDIA_TTL = 43200
 
     def __init__(
-        self, config: Config, base_path: str = None, only_oldest: bool = False
+        self,
+        config: Config,
+        base_path: str = None,
+        only_oldest: bool = False,
+        metrics: RunMetrics = None
     ) -> None:
 
-        logger = Logger(config=config).get_logger()
+        # The Logger is set up already by the runner, a second one would duplicate handlers
+        logger = logging.getLogger(config.get("logger.name"))
 
         super().__init__(config=config, logger=logger, base_path=base_path)
 
         queue_storage_file = config.get("toots_queue_storage.file", self.DEFAULT_QUEUE_FILE)
         if base_path is not None:
             queue_storage_file = os.path.join(base_path, queue_storage_file)
-        self._queue = Queue(logger=logger, storage_file=queue_storage_file)
+        self._metrics = metrics if metrics is not None else RunMetrics(config)
+        with self._metrics.stage("queue.load"):
+            self._queue = LockedQueue(
+                logger=logger,
+                storage_file=queue_storage_file,
+                queue_item_object=QueueItem,
+                **get_storage_params(config)
+            )
         self._only_oldest = only_oldest if only_oldest is not None\
             else config.get("publisher.only_oldest_post_every_iteration", False)
+        self._media_cache = MediaCache(config=config, base_path=base_path)
+        self._media_processor = MediaProcessor(config=config, base_path=base_path)
+        self._prefetched_media_ttl = config.get(
+            "publisher.media_prefetch.uploads_ttl", self.DEFAULT_PREFETCHED_MEDIA_TTL
+        )
+        self._dead_letter = DeadLetterQueue(config=config, base_path=base_path)
 
     def _execute_action(self, toot: dict, previous_id: int = None) -> dict:
 
@@ -49,8 +82,11 @@ class Publisher(MastodonPublisher):
             elif toot["action"] == "new":
                 self._logger.debug("The Publisher._execute_action has a new post")
 
-                posted_media = []
-                if "media" in toot and toot["media"]:
+                posted_media = self.get_prefetched_media_ids(toot)
+                if posted_media is not None:
+                    self._logger.debug("Reusing %d prefetched media", len(posted_media))
+                elif "media" in toot and toot["media"]:
+                    self._check_media_can_be_uploaded(toot["media"])
                     posted_media = self.publish_media(media=toot["media"])
 
                 status_post = StatusPost(
@@ -71,6 +107,135 @@ class Publisher(MastodonPublisher):
                 toot["published_at"]
             )
 
+    def get_prefetched_media_ids(self, toot: dict) -> list:
+        """
+        Returns the media IDs already uploaded for this post,
+            or None if there are none or they may have been expired in the server.
+        """
+        if "media_ids" not in toot or not toot["media_ids"]\
+           or "media_uploaded_at" not in toot or not toot["media_uploaded_at"]:
+            return None
+
+        expires_at = toot["media_uploaded_at"] + timedelta(seconds=self._prefetched_media_ttl)
+        if expires_at < datetime.now(tz=pytz.UTC):
+            self._logger.debug("Prefetched media expired at %s, discarding them", expires_at)
+            return None
+
+        return toot["media_ids"]
+
+    def _check_media_can_be_uploaded(self, media: list) -> None:
+        """
+        Streamed media is uploaded while parsing and only its ID and its
+            Telegram message are kept. Once the ID expired the post waits for
+            the Telegram parser to download it again, it must not go out
+            without its media. If the message is gone too, so is the media.
+        """
+        expired = [
+            item for item in media if not item.get("url", None) and not item.get("path", None)
+        ]
+        if not expired:
+            return
+
+        gone = [item for item in expired if not self._can_be_downloaded_again(item)]
+        if gone:
+            raise UnavailableMediaException(
+                f"{len(gone)} media were uploaded while parsing, their IDs expired" +
+                " and they can't be downloaded again"
+            )
+        raise ExpiredStreamedMediaException(
+            f"{len(expired)} media were uploaded while parsing and their IDs expired," +
+            " waiting for the Telegram parser to download them again"
+        )
+
+    def _can_be_downloaded_again(self, media: dict) -> bool:
+        # Without the Telegram message there is nothing to download again
+        message = media.get("telegram_message", None)
+        return message is not None and not message.get("unavailable", False)
+
+    def upload_media_file(
+        self, media_file: str, mime_type: str = None, description: str = None
+    ) -> dict:
+        """
+        Uploads a local media file and returns the media object from the API
+        """
+        self._media_cache.touch(media_file)
+        to_upload = self._media_processor.process(media_file=media_file, mime_type=mime_type)
+        if to_upload["file"] != media_file:
+            self._media_cache.touch(to_upload["file"])
+
+        return self._mastodon.media_post(
+            to_upload["file"],
+            mime_type=to_upload["mime_type"],
+            description=description,
+            focus=(0, 1)
+        )
+
+    def upload_media_stream(
+        self,
+        stream: IO[bytes],
+        mime_type: str,
+        file_name: str,
+        description: str = None
+    ) -> dict:
+        """
+        Uploads the media from an open stream and returns the media object from the API
+
+        Nothing is written to disk, so the media processing is not applied.
+        """
+        return self._mastodon.media_post(
+            stream,
+            mime_type=mime_type,
+            description=description,
+            focus=(0, 1),
+            file_name=file_name
+        )
+
+    def log_media_savings(self) -> None:
+        bytes_saved = self._media_processor.get_bytes_saved()
+        if bytes_saved > 0:
+            self._logger.info(
+                f"{TerminalColor.GREEN}Media processing saved {bytes_saved} bytes of upload" +
+                f" ({self._media_processor.bytes_before} -> " +
+                f"{self._media_processor.bytes_after}){TerminalColor.END}"
+            )
+
+    def _do_media_publish(
+        self,
+        media_file: str,
+        download_file: bool,
+        description: str,
+        mime_type: str = None
+    ) -> dict:
+        """
+        Any error goes up, so the post is retried or moved to the dead letters
+            instead of being published without its media.
+        """
+        if download_file is True:
+            with self._metrics.stage("media.download"):
+                downloaded = self._download_media(media_file)
+        elif not os.path.exists(media_file):
+            raise UnavailableMediaException(f"The media file {media_file} does not exist")
+        else:
+            downloaded = {"file": media_file, "mime_type": mime_type}
+        return self.upload_media_file(
+            media_file=downloaded["file"],
+            mime_type=downloaded["mime_type"],
+            description=description
+        )
+
+    def _download_media(self, url: str) -> dict:
+        try:
+            return Media().download_from_url(url, self._media_storage)
+        except RuntimeError as e:
+            # pyxavi raises with the response when it is not OK
+            response = e.args[0] if e.args else None
+            if isinstance(response, Response) and 400 <= response.status_code < 500 and\
+               response.status_code not in [408, 429]:
+                raise UnavailableMediaException(
+                    f"The media {url} is not available, status {response.status_code}"
+                ) from e
+            raise
+
     def publish_all_from_queue(self) -> None:
         if self._queue.is_empty():
             self._logger.info(
@@ -78,40 +243,105 @@ class Publisher(MastodonPublisher):
             )
             return
 
-        should_continue = True
-        previous_id = None
         self._logger.debug("Queue is not empty, publishing from it")
-        while should_continue and not self._queue.is_empty():
-            # Get the first element from the queue
-            queued_post = self._queue.pop().to_dict()
-            # Publish it
-            result = self._execute_action(queued_post, previous_id=previous_id)
-            # Let's capture the ID in case we want to do a thread
-            if result is not None:
-                # If it's a dry-run, there won't be any result returned.
-                previous_id = result["id"]
-                self._logger.debug(f"Post was published with ID {previous_id}")
-
-            # Maybe we have several posts in a group that we need to post
-            #  all together, regardless of the rest of conditions
-            if previous_id is not None and "group_id" in queued_post and\
-               self.__next_in_queue_matches_group_id(queued_post["group_id"]):
-                self._logger.debug(
-                    "Post was published and there are more in this group. Continue"
-                )
-                should_continue = True
-            else:
-                # Do we want to publish only the oldest in every iteration?
-                #   This means that the queue gets empty one item every run
-                if self._only_oldest:
-                    self._logger.info(
-                        f"{TerminalColor.CYAN}We're meant to publish only the oldest." +
-                        f" Finishing.{TerminalColor.END}"
-                    )
-                    should_continue = False
+        self.publish_ready_from_queue()
+
+        self.log_media_savings()
 
         if not self._is_dry_run:
-            self._queue.save()
+            with self._metrics.stage("queue.save"):
+                self._queue.save()
+
+    def publish_ready_from_queue(self, is_ready: callable = None) -> bool:
+        """
+        Publishes from the head of the queue while is_ready() accepts the head.
+            The rest of a group follows its first post regardless.
+            The posts waiting to be retried are skipped and keep their place.
+
+        Returns False when no more should be published in this run.
+        """
+        previous_id = None
+        in_group = False
+        waiting = []
+        try:
+            while not self._queue.is_empty():
+                if is_ready is not None and not in_group and\
+                        not is_ready(self._queue.first()):
+                    return True
+                if not in_group and not self._dead_letter.is_due(self._queue.first().to_dict()):
+                    waiting.append(self._queue.pop())
+                    continue
+                # Get the first element from the queue
+                queued_post = self._queue.pop().to_dict()
+                # Publish it
+                try:
+                    result = self._execute_action(queued_post, previous_id=previous_id)
+                except (Exception, MastodonPublisherException) as e:
+                    # A post that fails must not keep the ones behind from being published
+                    waiting += self._handle_failure(queued_post, e)
+                    previous_id = None
+                    in_group = False
+                    continue
+                # Let's capture the ID in case we want to do a thread
+                if result is not None:
+                    # If it's a dry-run, there won't be any result returned.
+                    previous_id = result["id"]
+                    self._metrics.increment("published_items")
+                    self._logger.debug(f"Post was published with ID {previous_id}")
+
+                # Maybe we have several posts in a group that we need to post
+                #  all together, regardless of the rest of conditions
+                if previous_id is not None and "group_id" in queued_post and\
+                   self.__next_in_queue_matches_group_id(queued_post["group_id"]):
+                    self._logger.debug(
+                        "Post was published and there are more in this group. Continue"
+                    )
+                    in_group = True
+                else:
+                    in_group = False
+                    # Do we want to publish only the oldest in every iteration?
+                    #   This means that the queue gets empty one item every run
+                    if self._only_oldest:
+                        self._logger.info(
+                            f"{TerminalColor.CYAN}We're meant to publish only the oldest." +
+                            f" Finishing.{TerminalColor.END}"
+                        )
+                        return False
+        finally:
+            # Back to the head, where they were
+            for queue_item in reversed(waiting):
+                self._queue.unpop(queue_item)
+
+        return True
+
+    def _handle_failure(self, queued_post: dict, error: BaseException) -> list:
+        """
+        Schedules the retry of the failed post and the rest of its group, or
+            moves them to the dead letters. Returns the items to keep in the queue.
+        """
+        failed = [queued_post]
+        if "group_id" in queued_post:
+            while self.__next_in_queue_matches_group_id(queued_post["group_id"]):
+                failed.append(self._queue.pop().to_dict())
+
+        if self._dead_letter.schedule_retry(queued_post, error):
+            self._logger.warning(
+                f"{TerminalColor.YELLOW}Could not publish the post, retrying it after " +
+                f"{queued_post['retry']['not_before']}: {error}{TerminalColor.END}"
+            )
+            self._metrics.increment("publish_retries")
+            # The group is retried as a whole
+            for item in failed[1:]:
+                item["retry"] = queued_post["retry"]
+            return [QueueItem(item) for item in failed]
+
+        self._logger.error(
+            f"{TerminalColor.RED}Could not publish the post, moving it to the dead letters" +
+            f": {error}{TerminalColor.END}"
+        )
+        self._metrics.increment("dead_letters", len(failed))
+        self._dead_letter.add(failed, error)
+        return []
 
     def __next_in_queue_matches_group_id(self, group_id: str) -> bool:
         """
@@ -137,10 +367,19 @@ class Publisher(MastodonPublisher):
     def reload_queue(self) -> int:
         # Previous length
         previous = self._queue.length()
-        new = self._queue.load()
+        with self._metrics.stage("queue.load"):
+            new = self._queue.load()
 
         return new - previous
 
+    def load_mastodon_instance(self) -> None:
+        # Connected on first use, a run with nothing to publish does not need it
+        self._mastodon = LazyMastodon(
+            config=self._config,
+            connection_params=self._connection_params,
+            base_path=self._base_path
+        )
+
     def load_connection_params(self, named_account=None) -> None:
         # While we don't migrate this config section to a proper
         #   mastodon.named_account config parameterset,
@@ -0,0 +1,26 @@
+from __future__ import annotations
+from pyxavi.queue_stack import SimpleQueueItem, QueueItemProtocol
+
+
+class QueueItem(SimpleQueueItem):
+    '''
+    Queue item for a queue that mixes reblogs and new posts
+
+    Reblogs are identified by an "id" and new posts by their "status",
+    so when the requested param is not present we fall back to the identifier
+    of the item's own kind, instead of failing the deduplication.
+    '''
+
+    @staticmethod
+    def from_dict(dictionary: dict) -> QueueItemProtocol:
+        return QueueItem(item=dictionary)
+
+    def unique_value(self, param: str = None) -> any:
+        value = super().unique_value(param=param)
+        if value is not None:
+            return value
+
+        action = self.item.get("action", None)
+        if action == "reblog":
+            return f"reblog:{self.item.get('id', None)}"
+        return f"{action}:{self.item.get('status', None)}"
@@ -0,0 +1,145 @@
+from __future__ import annotations
+from pyxavi.config import Config
+from echobot.lib.run_metrics import RunMetrics
+from echobot.lib.locked_storage import LockedStorage, get_storage_params
+from echobot.lib.shard import Shard
+from threading import Lock
+import logging
+import time
+import os
+
+
+class RunBudget:
+    '''
+    Keeps a run within the given seconds, so it does not overlap the next one
+
+    No new source is started once the next one would not fit in the budget,
+    estimated from the average time of the sources parsed so far, and some
+    time is kept for the publishing. The sources are served round-robin:
+    a cursor per parser remembers the first source left out, and the next
+    run starts there, and with that parser, so every source gets its turn.
+    '''
+
+    DEFAULT_PUBLISH_RESERVE = 30
+    DEFAULT_CURSOR_FILE = "storage/cursor.yaml"
+    PARSER_ORDER_KEY = "parsers"
+
+    def __init__(
+        self,
+        config: Config,
+        seconds: float,
+        base_path: str = None,
+        shard: Shard = None,
+        metrics: RunMetrics = None
+    ) -> None:
+        self._logger = logging.getLogger(config.get("logger.name"))
+        self._metrics = metrics if metrics is not None else RunMetrics(config)
+        self._start = time.monotonic()
+        self._seconds = seconds
+        self._publish_reserve = config.get(
+            "budget.publish_reserve", self.DEFAULT_PUBLISH_RESERVE
+        )
+        cursor_file = config.get("budget.cursor_file", self.DEFAULT_CURSOR_FILE)
+        if base_path is not None and not os.path.isabs(cursor_file):
+            cursor_file = os.path.join(base_path, cursor_file)
+        # Every shard has its own sources, so its own cursor. Never adopted from others
+        if shard is not None:
+            cursor_file = shard.get_partition_file(cursor_file)
+        self._cursor = LockedStorage(cursor_file, **get_storage_params(config))
+        self._lock = Lock()
+        self._started_sources = 0
+        self._first_source_at = None
+        self._stopped_parser = None
+        self.is_exhausted = False
+
+    @staticmethod
+    def from_params(
+        config: Config,
+        params: dict,
+        base_path: str = None,
+        shard: Shard = None,
+        metrics: RunMetrics = None
+    ) -> RunBudget:
+        """
+        The budget given with --budget SECONDS, or None to run without limit
+        """
+        seconds = params.get("budget", None) if params else None
+        if seconds is None:
+            return None
+        if float(seconds) <= 0:
+            raise RuntimeError(f"I don't understand the budget [{seconds}], use seconds > 0")
+        return RunBudget(
+            config, float(seconds), base_path=base_path, shard=shard, metrics=metrics
+        )
+
+    def get_remaining(self) -> float:
+        return self._seconds - (time.monotonic() - self._start)
+
+    def allows_new_source(self) -> bool:
+        """
+        Called right before starting a source, counts it as started when allowed
+        """
+        with self._lock:
+            now = time.monotonic()
+            average = (now - self._first_source_at) / self._started_sources\
+                if self._started_sources else 0
+            if self.get_remaining() - self._publish_reserve < average:
+                self.is_exhausted = True
+                return False
+
+            if self._first_source_at is None:
+                self._first_source_at = now
+            self._started_sources += 1
+            return True
+
+    def allows_source(self, parser: str, sources: list, position: int, key: callable) -> bool:
+        """
+        Whether to start the source in the given position. If not, the next
+            run starts the parser from it.
+        """
+        if self.allows_new_source():
+            return True
+
+        self.stop_at(parser, key(sources[position]), len(sources) - position)
+        return False
+
+    def order(self, parser: str, sources: list, key: callable) -> list:
+        """
+        The sources starting at the one where the previous run stopped
+        """
+        cursor = self._cursor.get(parser, None)
+        keys = [str(key(source)) for source in sources]
+        if cursor is None or cursor not in keys:
+            return list(sources)
+
+        position = keys.index(cursor)
+        self._logger.debug("Resuming %s from source %d of %d", parser, position + 1, len(keys))
+        return sources[position:] + sources[:position]
+
+    def order_parsers(self, parsers: list) -> list:
+        return self.order(self.PARSER_ORDER_KEY, parsers, lambda parser: parser)
+
+    def stop_at(self, parser: str, source_key: any, pending: int) -> None:
+        """
+        The source where the parser stopped, the first one for the next run
+        """
+        self._logger.info(
+            f"Budget nearly spent, {pending} {parser} sources left for the next run"
+        )
+        self._metrics.increment("sources_over_budget", pending)
+        with self._lock:
+            self._cursor.set(parser, str(source_key))
+            # The parsers after the first one that stopped did not even start
+            if self._stopped_parser is None:
+                self._stopped_parser = parser
+                self._cursor.set(self.PARSER_ORDER_KEY, parser)
+            self._cursor.write_file()
+
+    def finish(self, parser: str) -> None:
+        """
+        The parser served all its sources, the next run starts from the beginning
+        """
+        with self._lock:
+            if self._cursor.get(parser, None) is not None:
+                self._cursor.set(parser, None)
+                self._cursor.write_file()
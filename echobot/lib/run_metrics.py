@@ -0,0 +1,272 @@
+from pyxavi.config import Config
+from echobot.lib.shard import Shard
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+import logging
+import json
+import time
+import pytz
+import os
+
+
+class RunMetrics:
+    '''
+    Collects timings and counters along a run of the bot
+
+    Every stage accumulates its time and number of calls, every source
+    keeps its own counts of fetched, discarded and queued items, and
+    some gauges describe the state at the end of the run.
+    At the end they are written as a Prometheus textfile collector file
+    and appended as a JSON summary to the history of runs.
+    '''
+
+    DEFAULT_DIRECTORY = "storage/metrics"
+    DEFAULT_TEXTFILE = "echobot.prom"
+    DEFAULT_HISTORY_FILE = "runs.json"
+    DEFAULT_HISTORY_LENGTH = 100
+    METRIC_PREFIX = "echobot"
+    SOURCE_COUNTERS = ["fetched", "discarded", "queued"]
+
+    def __init__(self, config: Config, base_path: str = None, shard: Shard = None) -> None:
+        self._config = config
+        self._logger = logging.getLogger(config.get("logger.name"))
+        self._is_active = config.get("metrics.active", True)
+        directory = config.get("metrics.directory", self.DEFAULT_DIRECTORY)
+        if base_path is not None:
+            directory = os.path.join(base_path, directory)
+        self._textfile = os.path.join(
+            directory, config.get("metrics.textfile", self.DEFAULT_TEXTFILE)
+        )
+        self._history_file = os.path.join(
+            directory, config.get("metrics.history_file", self.DEFAULT_HISTORY_FILE)
+        )
+        self._history_length = config.get("metrics.history_length", self.DEFAULT_HISTORY_LENGTH)
+        # Shards run at the same time, each one reports on its own
+        self._labels = {}
+        if shard is not None:
+            self._textfile = shard.get_partition_file(self._textfile)
+            self._history_file = shard.get_partition_file(self._history_file)
+            self._labels = {"shard": shard.name}
+
+        self._lock = Lock()
+        self._started_at = datetime.now(tz=pytz.UTC)
+        self._start = time.perf_counter()
+        self._duration = None
+        self._success = None
+        self.stages = {}
+        self.sources = {}
+        self.counters = {}
+        self.gauges = {}
+        self.circuits = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Times the block and accumulates it into the given stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - start)
+
+    def add_stage_time(self, name: str, seconds: float) -> None:
+        with self._lock:
+            if name not in self.stages:
+                self.stages[name] = {"seconds": 0.0, "calls": 0}
+            self.stages[name]["seconds"] += seconds
+            self.stages[name]["calls"] += 1
+
+    def count_source(
+        self,
+        source_type: str,
+        source: str,
+        fetched: int = 0,
+        discarded: int = 0,
+        queued: int = 0
+    ) -> None:
+        key = f"{source_type}:{source}"
+        with self._lock:
+            if key not in self.sources:
+                self.sources[key] = {
+                    **{
+                        "type": source_type, "name": source
+                    },
+                    **{counter: 0
+                       for counter in self.SOURCE_COUNTERS}
+                }
+            self.sources[key]["fetched"] += fetched
+            self.sources[key]["discarded"] += discarded
+            self.sources[key]["queued"] += queued
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self.gauges[name] = value
+
+    def set_circuit(self, source_type: str, source: str, state: str) -> None:
+        with self._lock:
+            self.circuits[f"{source_type}:{source}"] = {
+                "type": source_type, "name": source, "state": state
+            }
+
+    def get_open_circuits(self) -> list:
+        with self._lock:
+            return [
+                key for key, circuit in self.circuits.items() if circuit["state"] != "closed"
+            ]
+
+    def set_queue_gauges(self, queue_items: list) -> None:
+        """
+        Queue depth and the age of the oldest item, from a list of queue item dicts
+        """
+        self.set_gauge("queue_depth", len(queue_items))
+        dates = [
+            item["published_at"] for item in queue_items
+            if isinstance(item.get("published_at", None), datetime)
+        ]
+        dates = [
+            date if date.tzinfo is not None else date.replace(tzinfo=pytz.UTC) for date in dates
+        ]
+        oldest_age = (datetime.now(tz=pytz.UTC) - min(dates)).total_seconds() if dates else 0
+        self.set_gauge("queue_oldest_item_age_seconds", round(oldest_age, 3))
+
+    def finish(self, success: bool = True) -> None:
+        self._duration = time.perf_counter() - self._start
+        self._success = success
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "started_at": self._started_at.isoformat(timespec="seconds"),
+                "duration_seconds": round(self._duration, 6)
+                if self._duration is not None else None,
+                "success": self._success,
+                "stages": {
+                    name: {
+                        "seconds": round(stage["seconds"], 6), "calls": stage["calls"]
+                    }
+                    for name,
+                    stage in self.stages.items()
+                },
+                "sources": list(self.sources.values()),
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "circuits": list(self.circuits.values()),
+            }
+
+    def to_prometheus(self) -> str:
+        summary = self.to_dict()
+        prefix = self.METRIC_PREFIX
+        lines = []
+
+        def metric(name: str, description: str, samples: list) -> None:
+            lines.append(f"# HELP {prefix}_{name} {description}")
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            for labels, value in samples:
+                labels = {**self._labels, **labels}
+                label_string = ",".join(
+                    [f'{key}="{self._escape_label(label)}"' for key, label in labels.items()]
+                )
+                label_string = "{" + label_string + "}" if label_string else ""
+                lines.append(f"{prefix}_{name}{label_string} {value}")
+
+        metric(
+            "last_run_timestamp_seconds",
+            "Unix time when the last run started", [({}, int(self._started_at.timestamp()))]
+        )
+        metric(
+            "last_run_duration_seconds",
+            "Duration of the last run", [({}, summary["duration_seconds"] or 0)]
+        )
+        metric(
+            "last_run_success",
+            "Whether the last run finished without errors",
+            [({}, 1 if summary["success"] else 0)]
+        )
+        metric(
+            "stage_duration_seconds",
+            "Time spent in every stage during the last run",
+            [({
+                "stage": name
+            }, stage["seconds"]) for name, stage in summary["stages"].items()]
+        )
+        metric(
+            "stage_calls",
+            "Times every stage was entered during the last run",
+            [({
+                "stage": name
+            }, stage["calls"]) for name, stage in summary["stages"].items()]
+        )
+        metric(
+            "source_items",
+            "Items fetched, discarded and queued per source during the last run",
+            [
+                (
+                    {
+                        "source_type": source["type"],
+                        "source": source["name"],
+                        "kind": counter
+                    },
+                    source[counter]
+                ) for source in summary["sources"] for counter in self.SOURCE_COUNTERS
+            ]
+        )
+        metric(
+            "circuit_open",
+            "Whether the circuit breaker of the source was open in the last run",
+            [
+                (
+                    {
+                        "source_type": circuit["type"], "source": circuit["name"]
+                    },
+                    0 if circuit["state"] == "closed" else 1
+                ) for circuit in summary["circuits"]
+            ]
+        )
+        for name, value in summary["counters"].items():
+            metric(name, f"Counter {name} of the last run", [({}, value)])
+        for name, value in summary["gauges"].items():
+            metric(name, f"Value of {name} at the end of the last run", [({}, value)])
+
+        return "\n".join(lines) + "\n"
+
+    def _escape_label(self, value: str) -> str:
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    def save(self) -> None:
+        if not self._is_active:
+            return
+        if self._duration is None:
+            self.finish()
+
+        os.makedirs(os.path.dirname(self._textfile), exist_ok=True)
+        # The textfile collector may read at any time, never let it see a half written file
+        self._write_atomically(self._textfile, self.to_prometheus())
+
+        history = self.load_history()
+        history.append(self.to_dict())
+        self._write_atomically(
+            self._history_file, json.dumps(history[-self._history_length:], indent=2)
+        )
+        self._logger.debug("Run metrics saved into %s", self._textfile)
+
+    def load_history(self) -> list:
+        if not os.path.exists(self._history_file):
+            return []
+        try:
+            with open(self._history_file, "r") as handle:
+                return json.load(handle)
+        except ValueError:
+            self._logger.warning("The metrics history is not valid JSON, starting a new one")
+            return []
+
+    def _write_atomically(self, filename: str, content: str) -> None:
+        temporary_file = f"{filename}.tmp"
+        with open(temporary_file, "w") as handle:
+            handle.write(content)
+        os.replace(temporary_file, filename)
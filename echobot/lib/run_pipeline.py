@@ -0,0 +1,135 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from echobot.lib.publisher import Publisher
+from echobot.lib.media_prefetcher import MediaPrefetcher
+from echobot.lib.run_metrics import RunMetrics
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import asyncio
+import logging
+import time
+
+
+class RunPipeline:
+    '''
+    Runs the parsers at the same time and publishes while they run
+
+    The parsers are producers that save into the shared queue and the
+    Publisher consumes it from the head as soon as there is something.
+    A parser may still queue a post older than the head, so the head is
+    only published once it waited in the queue for the reorder window,
+    or once all the parsers are done. Posts that arrive within the window
+    of each other are published in their published_at order.
+    '''
+
+    DEFAULT_REORDER_WINDOW = 30
+    DEFAULT_POLL_INTERVAL = 2
+
+    def __init__(
+        self,
+        config: Config,
+        publisher: Publisher,
+        metrics: RunMetrics = None,
+        base_path: str = None
+    ) -> None:
+        self._config = config
+        self._logger = logging.getLogger(config.get("logger.name"))
+        self._publisher = publisher
+        self._base_path = base_path
+        self._metrics = metrics if metrics is not None else RunMetrics(config)
+        self._reorder_window = config.get(
+            "pipeline.reorder_window", self.DEFAULT_REORDER_WINDOW
+        )
+        self._poll_interval = config.get("pipeline.poll_interval", self.DEFAULT_POLL_INTERVAL)
+        self._is_dry_run = config.get("publisher.dry_run", False)
+        self._prefetch_media = config.get("publisher.media_prefetch.active", False)
+        self._first_seen = {}
+        self._start = None
+
+    def run(self, producers: dict, publish: bool = True) -> None:
+        """
+        Runs the producers, a callable per name, and publishes the queue meanwhile.
+
+        Raises the first error from the producers once all of them are done.
+        """
+        self._start = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=len(producers), thread_name_prefix="producer")
+        with executor:
+            futures = []
+            for name, producer in producers.items():
+                futures.append(executor.submit(self._produce, name, producer))
+            pending = set(futures)
+            keep_publishing = publish
+            while True:
+                producers_done = not pending
+                if keep_publishing:
+                    keep_publishing = self._consume(producers_done)
+                if producers_done:
+                    break
+                _, pending = wait(
+                    pending, timeout=self._poll_interval, return_when=FIRST_COMPLETED
+                )
+
+        if publish:
+            self._publisher.log_media_savings()
+
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            raise errors[0]
+
+    def _produce(self, name: str, producer: callable) -> None:
+        # Telethon works over the event loop of the thread, that only the main one has
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        start = time.perf_counter()
+        try:
+            producer()
+        except Exception as e:
+            self._logger.warning(
+                f"{TerminalColor.RED}The {name} parser failed: {e}{TerminalColor.END}"
+            )
+            raise
+        finally:
+            self._metrics.add_stage_time(f"pipeline.{name}", time.perf_counter() - start)
+            loop.close()
+        self._logger.debug("The %s parser is done", name)
+
+    def _consume(self, producers_done: bool) -> bool:
+        """
+        Publishes the items that are ready. Returns False when the run
+            should not publish anymore.
+        """
+        self._publisher.reload_queue()
+        now = time.monotonic()
+        for item in self._publisher._queue.get_all():
+            self._first_seen.setdefault(self._identity(item), now)
+
+        def is_ready(item) -> bool:
+            # A dry run keeps the queue untouched, the reload would bring the items back
+            if producers_done or self._is_dry_run:
+                return producers_done
+            return now - self._first_seen.get(self._identity(item), now) >= self._reorder_window
+
+        if self._publisher._queue.is_empty() or not is_ready(self._publisher._queue.first()):
+            return True
+
+        if self._prefetch_media:
+            with self._metrics.stage("media.prefetch"):
+                MediaPrefetcher(
+                    self._config, self._publisher, self._metrics, base_path=self._base_path
+                ).prefetch()
+
+        if "first_publish_seconds" not in self._metrics.gauges:
+            self._metrics.set_gauge(
+                "first_publish_seconds", round(time.monotonic() - self._start, 3)
+            )
+        with self._metrics.stage("publish"):
+            keep_publishing = self._publisher.publish_ready_from_queue(is_ready)
+
+        if not self._is_dry_run:
+            with self._metrics.stage("queue.save"):
+                self._publisher._queue.save()
+        return keep_publishing
+
+    def _identity(self, item) -> str:
+        # As the LockedQueue identifies the items
+        return str(item.unique_value())
@@ -0,0 +1,140 @@
+from pyxavi.config import Config
+from datetime import datetime, date
+import json
+import yaml
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# The C bindings of libyaml are several times faster, when PyYAML was built with them
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YamlDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+class Serializer:
+    '''
+    Reads and writes the storage and queue files
+
+    The files are written in the configured format, YAML, JSON or msgpack,
+    and the format is detected when reading, so a file can be converted
+    and keep its name. JSON uses orjson when it is installed and msgpack
+    needs the msgpack package. As they have no date type, the dates are
+    kept as {"$datetime": "<ISO 8601>"} and come back as datetime objects.
+    '''
+
+    FORMATS = ["yaml", "json", "msgpack"]
+    DEFAULT_FORMAT = "yaml"
+    DATETIME_TAG = "$datetime"
+    DATE_TAG = "$date"
+    # First byte of a msgpack map: fixmap, map 16 and map 32
+    MSGPACK_MAP_BYTES = list(range(0x80, 0x90)) + [0xde, 0xdf]
+
+    def __init__(self, format: str = None) -> None:
+        self.format = format if format is not None else self.DEFAULT_FORMAT
+        if self.format not in self.FORMATS:
+            raise RuntimeError(
+                f"I don't understand the storage format [{self.format}]," +
+                f" use one of {', '.join(self.FORMATS)}"
+            )
+        if self.format == "msgpack" and msgpack is None:
+            raise RuntimeError("The msgpack storage format needs the msgpack package")
+
+    @staticmethod
+    def from_config(config: Config):
+        return Serializer(config.get("serializer.format", Serializer.DEFAULT_FORMAT))
+
+    @staticmethod
+    def get_available_formats() -> list:
+        return [format for format in Serializer.FORMATS if format != "msgpack" or msgpack]
+
+    @staticmethod
+    def detect_format(data: bytes) -> str:
+        stripped = data.lstrip()
+        if not stripped:
+            return "yaml"
+        if data[0] in Serializer.MSGPACK_MAP_BYTES:
+            return "msgpack"
+        # A YAML flow mapping also starts with a brace, loads() falls back to YAML
+        if stripped[:1] in [b"{", b"["]:
+            return "json"
+        return "yaml"
+
+    def dumps(self, content: any) -> bytes:
+        if self.format == "json":
+            if orjson is not None:
+                return orjson.dumps(
+                    content,
+                    default=self._encode,
+                    option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+                )
+            return json.dumps(content, default=self._encode).encode()
+        if self.format == "msgpack":
+            return msgpack.packb(content, default=self._encode, use_bin_type=True)
+        return yaml.dump(content, Dumper=YamlDumper).encode()
+
+    def loads(self, data: bytes) -> any:
+        format = self.detect_format(data)
+        if format == "msgpack":
+            if msgpack is None:
+                raise RuntimeError("Reading a msgpack storage file needs the msgpack package")
+            return msgpack.unpackb(
+                data, object_hook=self._decode, raw=False, strict_map_key=False
+            )
+        if format == "json":
+            try:
+                if orjson is not None:
+                    return self._decode_all(orjson.loads(data))
+                return json.loads(data, object_hook=self._decode)
+            except ValueError:
+                pass
+        return yaml.load(data, Loader=YamlLoader)
+
+    def load_file(self, filename: str) -> any:
+        """
+        Returns the content of the file, in whatever format it is, or None
+        """
+        if not os.path.exists(filename):
+            return None
+        with open(filename, "rb") as stream:
+            return self.loads(stream.read())
+
+    def write_file(self, filename: str, content: any) -> None:
+        """
+        Readers never see a half written file, they get the old or the new one
+        """
+        data = self.dumps(content)
+        temporary_file = f"{filename}.{os.getpid()}.tmp"
+        with open(temporary_file, "wb") as stream:
+            stream.write(data)
+        os.replace(temporary_file, filename)
+
+    def _encode(self, value: any) -> any:
+        if isinstance(value, datetime):
+            return {self.DATETIME_TAG: value.isoformat()}
+        if isinstance(value, date):
+            return {self.DATE_TAG: value.isoformat()}
+        raise TypeError(f"Can't store values of type {type(value).__name__}")
+
+    def _decode(self, value: dict) -> any:
+        if len(value) == 1:
+            if self.DATETIME_TAG in value:
+                return datetime.fromisoformat(value[self.DATETIME_TAG])
+            if self.DATE_TAG in value:
+                return date.fromisoformat(value[self.DATE_TAG])
+        return value
+
+    def _decode_all(self, value: any) -> any:
+        # orjson has no hook for the objects, so they are walked afterwards
+        if isinstance(value, dict):
+            return self._decode({key: self._decode_all(item) for key, item in value.items()})
+        if isinstance(value, list):
+            return [self._decode_all(item) for item in value]
+        return value
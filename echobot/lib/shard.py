@@ -0,0 +1,88 @@
+from __future__ import annotations
+from pyxavi.config import Config
+from hashlib import sha256
+import bisect
+import os
+
+
+class Shard:
+    '''
+    One of the N parts in which the sources are split between processes
+
+    Sources are assigned with a consistent hash ring over their identifier,
+    the feed URL, the account handle or the Telegram session, so adding or
+    removing a shard only moves around the sources of that shard.
+    Every shard keeps its own partition of the storage files and only the
+    publisher shard publishes the shared queue.
+    '''
+
+    DEFAULT_VIRTUAL_NODES = 200
+    DEFAULT_PUBLISHER = 1
+
+    def __init__(
+        self, index: int, count: int, publisher: int = None, virtual_nodes: int = None
+    ) -> None:
+        if count < 1 or index < 1 or index > count:
+            raise RuntimeError(
+                f"The shard {index}/{count} does not exist, use K/N with 1<=K<=N"
+            )
+
+        self.index = index
+        self.count = count
+        self.publisher = publisher if publisher is not None else self.DEFAULT_PUBLISHER
+        virtual_nodes = virtual_nodes if virtual_nodes is not None\
+            else self.DEFAULT_VIRTUAL_NODES
+
+        # Every shard is placed many times around the ring to spread the load evenly
+        self._ring = sorted(
+            [
+                (self._hash(f"shard-{shard}-{node}"), shard) for shard in range(1, count + 1)
+                for node in range(virtual_nodes)
+            ]
+        )
+        self._points = [point for point, shard in self._ring]
+
+    @staticmethod
+    def from_config(config: Config, value: str) -> Shard:
+        """
+        Builds the shard from the "K/N" string given in the command line
+        """
+        try:
+            index, count = [int(part) for part in value.split("/")]
+        except ValueError:
+            raise RuntimeError(f"I don't understand the shard [{value}], use K/N like 1/4")
+
+        return Shard(
+            index,
+            count,
+            publisher=config.get("sharding.publisher_shard", Shard.DEFAULT_PUBLISHER),
+            virtual_nodes=config.get("sharding.virtual_nodes", Shard.DEFAULT_VIRTUAL_NODES)
+        )
+
+    @property
+    def name(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    @property
+    def is_publisher(self) -> bool:
+        return self.index == self.publisher
+
+    def owner_of(self, key: str) -> int:
+        position = bisect.bisect(self._points, self._hash(str(key))) % len(self._ring)
+        return self._ring[position][1]
+
+    def owns(self, key: str) -> bool:
+        return self.owner_of(key) == self.index
+
+    def get_partition_file(self, filename: str) -> str:
+        """
+        The file of this shard: storage/feeds.yaml becomes storage/feeds.shard-2.yaml
+
+        It does not depend on the amount of shards, so a shard keeps its
+        partition when others are added or removed.
+        """
+        root, extension = os.path.splitext(filename)
+        return f"{root}.shard-{self.index}{extension}"
+
+    def _hash(self, value: str) -> int:
+        return int(sha256(value.encode()).hexdigest()[:16], 16)
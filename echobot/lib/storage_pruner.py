@@ -0,0 +1,210 @@
+from pyxavi.config import Config
+from echobot.lib.locked_storage import LockedStorage, get_storage_files, get_storage_params
+from echobot.parsers.feed_parser import FeedParser
+from echobot.parsers.mastodon_parser import MastodonParser
+from echobot.parsers.telegram_parser import TelegramParser
+from dateutil.relativedelta import relativedelta
+from datetime import datetime
+from hashlib import sha256
+import logging
+import pytz
+import os
+
+
+class StoragePruner:
+    '''
+    Keeps the state of the parsers from growing forever
+
+    The URLs seen in the feeds are dropped once they were first seen before
+    the retention window, as their posts would be discarded as too old anyway.
+    From the Telegram message IDs only the highest are needed, as the messages
+    are fetched from the highest seen on. The state of the sources that are
+    not in the config anymore is removed, and the rest is deduplicated.
+    Every storage file, and its shard partitions, is rewritten atomically
+    one at a time under its lock.
+    '''
+
+    DEFAULT_RETENTION_MONTHS = 6
+    DEFAULT_TELEGRAM_KEEP_IDS = 100
+    TELEGRAM_PREFIXES = ["entity_", "polling_", "circuit_"]
+
+    def __init__(self, config: Config, base_path: str = None) -> None:
+        self._config = config
+        self._logger = logging.getLogger(config.get("logger.name"))
+        self._base_path = base_path
+        self._storage_params = get_storage_params(config)
+        # Below the window where the parsers accept posts, seen posts would come back
+        self._retention_months = max(
+            config.get("storage_vacuum.retention_months", self.DEFAULT_RETENTION_MONTHS),
+            FeedParser.ACCEPTED_NUM_MONTHS_AGO
+        )
+        self._telegram_keep_ids = config.get(
+            "storage_vacuum.telegram_keep_ids", self.DEFAULT_TELEGRAM_KEEP_IDS
+        )
+        self._remove_unknown = config.get("storage_vacuum.remove_unknown_sources", True)
+
+    def vacuum(self) -> list:
+        """
+        Prunes all the storage files. Returns a result per file.
+        """
+        cutoff = (datetime.now(tz=pytz.UTC) -
+                  relativedelta(months=self._retention_months)).strftime(
+                      FeedParser.URLS_SEEN_MONTH_FORMAT
+                  )
+        feed_keys = set(
+            [
+                self._hash(site["url"])
+                for site in self._config.get("feed_parser.sites", None) or []
+            ]
+        )
+        account_keys = set(
+            [
+                self._hash(account["user"])
+                for account in self._config.get("mastodon_parser.accounts", None) or []
+            ]
+        )
+        chat_ids = set(
+            [
+                str(abs(chat["id"]))
+                for chat in (self._config.get("telegram_parser.chats", None) or []) +
+                (self._config.get("telegram_parser.channels", None) or []) if "id" in chat
+            ]
+        )
+
+        results = []
+        for filename in self._get_files("feed_parser.storage_file",
+                                        FeedParser.DEFAULT_STORAGE_FILE):
+            results.append(
+                self._vacuum_file(
+                    filename, lambda content: self._prune_feeds(content, feed_keys, cutoff)
+                )
+            )
+        for filename in self._get_files("mastodon_parser.storage_file",
+                                        MastodonParser.DEFAULT_STORAGE_FILE):
+            results.append(
+                self._vacuum_file(
+                    filename, lambda content: self._prune_unknown(content, account_keys)
+                )
+            )
+        for filename in self._get_files("telegram_parser.storage_file",
+                                        TelegramParser.DEFAULT_TELEGRAM_FILE):
+            results.append(
+                self._vacuum_file(
+                    filename, lambda content: self._prune_telegram(content, chat_ids)
+                )
+            )
+        return results
+
+    def _get_files(self, param_name: str, default_file: str) -> list:
+        filename = self._config.get(param_name, default_file)
+        if self._base_path is not None and not os.path.isabs(filename):
+            filename = os.path.join(self._base_path, filename)
+        return get_storage_files(filename)
+
+    def _vacuum_file(self, filename: str, prune: callable) -> dict:
+        result = {
+            "file": filename,
+            "bytes_before": 0,
+            "bytes_after": 0,
+            "sources_removed": 0,
+            "entries_removed": 0
+        }
+        if not os.path.exists(filename):
+            return result
+
+        result["bytes_before"] = os.path.getsize(filename)
+        storage = LockedStorage(filename, **self._storage_params)
+        with storage.locked():
+            sources_removed, entries_removed = prune(storage._content)
+            if sources_removed > 0 or entries_removed > 0:
+                storage.write_file()
+        result["bytes_after"] = os.path.getsize(filename)
+        result["sources_removed"] = sources_removed
+        result["entries_removed"] = entries_removed
+        self._logger.debug(
+            "Vacuumed %s: %d sources and %d entries removed",
+            filename,
+            sources_removed,
+            entries_removed
+        )
+        return result
+
+    def _prune_unknown(self, content: dict, known_keys: set) -> tuple:
+        if not self._remove_unknown:
+            return 0, 0
+
+        unknown_keys = [key for key in content.keys() if key not in known_keys]
+        for key in unknown_keys:
+            del content[key]
+        return len(unknown_keys), 0
+
+    def _prune_feeds(self, content: dict, known_keys: set, cutoff: str) -> tuple:
+        sources_removed, entries_removed = self._prune_unknown(content, known_keys)
+        for key, site_data in content.items():
+            if not isinstance(site_data, dict) or not site_data.get("urls_seen", None):
+                continue
+
+            urls_seen, marks, removed = self._prune_urls_seen(
+                site_data["urls_seen"], site_data.get("urls_seen_since", None) or {}, cutoff
+            )
+            if removed > 0:
+                site_data["urls_seen"] = urls_seen
+                site_data["urls_seen_since"] = marks
+                entries_removed += removed
+
+        return sources_removed, entries_removed
+
+    def _prune_urls_seen(self, urls_seen: list, marks: dict, cutoff: str) -> tuple:
+        """
+        The marks say where the URLs first seen in every month start. Without
+            them the age of the URLs is unknown and all of them are kept.
+        """
+        kept_months = sorted([month for month in marks.keys() if month >= cutoff])
+        if kept_months:
+            start = marks[kept_months[0]]
+        else:
+            start = len(urls_seen) if marks else 0
+
+        # Deduplicate keeping the first time every URL was seen, and move the marks
+        seen = set()
+        pruned_urls = []
+        kept_before = []
+        for index in range(start, len(urls_seen)):
+            kept_before.append(len(pruned_urls))
+            if urls_seen[index] in seen:
+                continue
+            seen.add(urls_seen[index])
+            pruned_urls.append(urls_seen[index])
+        kept_before.append(len(pruned_urls))
+        pruned_marks = {
+            month: kept_before[min(max(marks[month] - start, 0), len(kept_before) - 1)]
+            for month in kept_months
+        }
+
+        return pruned_urls, pruned_marks, len(urls_seen) - len(pruned_urls)
+
+    def _prune_telegram(self, content: dict, chat_ids: set) -> tuple:
+        removed_ids = set()
+        entries_removed = 0
+        for key in list(content.keys()):
+            prefix = next(
+                (prefix for prefix in self.TELEGRAM_PREFIXES if key.startswith(prefix)), None
+            )
+            if prefix is None:
+                continue
+
+            if self._remove_unknown and key[len(prefix):] not in chat_ids:
+                del content[key]
+                removed_ids.add(key[len(prefix):])
+                continue
+
+            if prefix == "entity_" and content[key]:
+                kept_ids = sorted(set(content[key]))[-self._telegram_keep_ids:]
+                entries_removed += len(content[key]) - len(kept_ids)
+                content[key] = kept_ids
+
+        return len(removed_ids), entries_removed
+
+    def _hash(self, value: str) -> str:
+        # As Storage.get_hashed() does
+        return sha256(value.encode()).hexdigest()
@@ -0,0 +1,340 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from echobot.lib.http_client import HttpClient
+from echobot.lib.locked_storage import LockedStorage, get_storage_params
+from echobot.parsers.feed_parser import FeedParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime, timedelta
+from threading import Thread, Lock
+from hashlib import sha256
+import feedparser
+import logging
+import secrets
+import hmac
+import pytz
+
+
+class WebSubSubscriber:
+    '''
+    Subscribes to the WebSub hubs that the feeds advertise and receives their pushes
+
+    The hub and the topic are discovered from the feed itself. Every site gets
+    its own callback path, and the subscription is kept in the feeds storage,
+    next to the rest of the site data, so the FeedParser knows which sites are
+    pushed and polls them only as a safety net. The pushed content goes through
+    the same pipeline as the polled one.
+    '''
+
+    DEFAULT_HOST = "0.0.0.0"
+    DEFAULT_PORT = 8090
+    DEFAULT_LEASE_SECONDS = 864000
+    DEFAULT_RENEW_BEFORE = 86400
+    DEFAULT_MAX_PUSH_SIZE_KB = 10240
+    DEFAULT_STORAGE_FILE = "storage/feeds.yaml"
+    SIGNATURE_METHODS = ["sha1", "sha256", "sha384", "sha512"]
+
+    def __init__(self, config: Config, http_client: HttpClient = None) -> None:
+        self._config = config
+        self._logger = logging.getLogger(config.get("logger.name"))
+        self._http_client = http_client if http_client is not None else HttpClient(config)
+        self._feeds_storage = LockedStorage(
+            config.get("feed_parser.storage_file", self.DEFAULT_STORAGE_FILE),
+            **get_storage_params(config)
+        )
+        self._lease_seconds = config.get("websub.lease_seconds", self.DEFAULT_LEASE_SECONDS)
+        self._renew_before = config.get("websub.renew_before", self.DEFAULT_RENEW_BEFORE)
+        self._max_push_bytes = config.get(
+            "websub.max_push_size_kb", self.DEFAULT_MAX_PUSH_SIZE_KB
+        ) * 1024
+        self._callback_url = config.get("websub.callback_url", None)
+        self._sites = {
+            self.get_site_id(site["url"]): site
+            for site in config.get("feed_parser.sites", None) or [] if site.get("websub", True)
+        }
+
+        # The callbacks come in several threads
+        self._lock = Lock()
+        self._httpd = ThreadingHTTPServer(
+            (
+                config.get("websub.host", self.DEFAULT_HOST),
+                config.get("websub.port", self.DEFAULT_PORT)
+            ),
+            self._get_handler_class()
+        )
+        self._thread = None
+
+    @staticmethod
+    def get_site_id(url: str) -> str:
+        return sha256(url.encode()).hexdigest()[:16]
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def callback_base_url(self) -> str:
+        # Hubs need a public URL, the local address only works for local hubs
+        return self._callback_url.rstrip("/") if self._callback_url else self.base_url
+
+    def start(self) -> str:
+        self._thread = Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def subscribe_due(self) -> int:
+        """
+        Subscribes to the sites that are not subscribed yet,
+            and renews the subscriptions that expire soon.
+
+        Returns the amount of subscription requests sent.
+        """
+        requested = 0
+        for site_id, site in self._sites.items():
+            subscription = self._get_site_data(site).get("websub", None)
+            if not self._is_subscription_due(subscription):
+                continue
+
+            discovered = self.discover(site)
+            if discovered is None:
+                self._logger.debug("The site %s does not advertise a WebSub hub", site["name"])
+                self._update_site_data(
+                    site, {"websub": {
+                        "state": "no_hub", "requested_at": self._now()
+                    }}
+                )
+                continue
+
+            if self.subscribe(site, discovered, subscription):
+                requested += 1
+
+        return requested
+
+    def discover(self, site: dict) -> dict:
+        """
+        Returns the hub and the topic advertised in the feed, or None
+        """
+        try:
+            response = self._http_client.get(site["url"], timeout=site.get("timeout", None))
+        except Exception as e:
+            self._logger.warning(f"Could not fetch the feed {site['url']}: {e}")
+            return None
+
+        parsed_site = feedparser.parse(
+            response["content"], response_headers=response["headers"]
+        )
+        links = parsed_site.get("feed", {}).get("links", [])
+        hubs = [link["href"] for link in links if link.get("rel", None) == "hub"]
+        topics = [link["href"] for link in links if link.get("rel", None) == "self"]
+        if not hubs:
+            return None
+
+        return {"hub": hubs[0], "topic": topics[0] if topics else site["url"]}
+
+    def subscribe(self, site: dict, discovered: dict, subscription: dict = None) -> bool:
+        subscription = subscription if subscription is not None else {}
+        is_renewal = subscription.get("state", None) == "verified"\
+            and subscription.get("topic", None) == discovered["topic"]
+        subscription = {
+            **(subscription if is_renewal else {}),
+            **discovered,
+            "callback": f"{self.callback_base_url}/{self.get_site_id(site['url'])}",
+            # A renewal keeps the secret and the state until the hub verifies it again
+            "secret": subscription["secret"] if is_renewal else secrets.token_hex(20),
+            "state": "verified" if is_renewal else "pending",
+            "requested_at": self._now()
+        }
+        self._update_site_data(site, {"websub": subscription})
+
+        self._logger.info(
+            f"{TerminalColor.BLUE}{'Renewing' if is_renewal else 'Requesting'} the" +
+            f" subscription to {subscription['topic']} at {subscription['hub']}" +
+            f"{TerminalColor.END}"
+        )
+        try:
+            status_code = self._http_client.post(
+                subscription["hub"],
+                {
+                    "hub.mode": "subscribe",
+                    "hub.topic": subscription["topic"],
+                    "hub.callback": subscription["callback"],
+                    "hub.lease_seconds": self._lease_seconds,
+                    "hub.secret": subscription["secret"]
+                }
+            )
+        except Exception as e:
+            self._logger.warning(f"Could not reach the hub {subscription['hub']}: {e}")
+            return False
+
+        if status_code not in [202, 204]:
+            self._logger.warning(
+                f"The hub {subscription['hub']} refused the subscription with {status_code}"
+            )
+            return False
+
+        return True
+
+    def handle_verification(self, site_id: str, query: dict) -> tuple:
+        """
+        Answers the verification of intent from the hub.
+            Returns the HTTP status code and the body.
+        """
+        site = self._sites.get(site_id, None)
+        mode = query.get("hub.mode", [None])[0]
+        topic = query.get("hub.topic", [None])[0]
+        subscription = self._get_site_data(site).get("websub", None) if site else None
+        if subscription is None or topic != subscription.get("topic", None):
+            self._logger.warning(f"Received a verification for an unknown topic {topic}")
+            return 404, ""
+
+        if mode == "denied":
+            reason = query.get("hub.reason", ["no reason given"])[0]
+            self._logger.warning(f"The hub denied the subscription to {topic}: {reason}")
+            self._update_site_data(site, {"websub": {**subscription, "state": "denied"}})
+            return 200, ""
+
+        # We never unsubscribe, so anything else than a subscription is not ours
+        if mode != "subscribe":
+            return 404, ""
+
+        lease_seconds = int(query.get("hub.lease_seconds", [self._lease_seconds])[0])
+        self._update_site_data(
+            site,
+            {
+                "websub": {
+                    **subscription,
+                    "state": "verified",
+                    "lease_expires_at": self._now() + timedelta(seconds=lease_seconds)
+                }
+            }
+        )
+        self._logger.info(
+            f"{TerminalColor.GREEN}Subscribed to {topic} for {lease_seconds}" +
+            f" seconds{TerminalColor.END}"
+        )
+        return 200, query.get("hub.challenge", [""])[0]
+
+    def handle_push(self, site_id: str, content: bytes, headers: dict) -> int:
+        """
+        Processes the content pushed by the hub. Returns the HTTP status code.
+        """
+        site = self._sites.get(site_id, None)
+        subscription = self._get_site_data(site).get("websub", None) if site else None
+        if subscription is None or subscription.get("state", None) != "verified":
+            self._logger.warning(f"Received a push for an unknown subscription {site_id}")
+            return 404
+
+        # Unsigned or wrongly signed content is acknowledged but ignored
+        if not self._is_signature_valid(subscription, content, headers):
+            self._logger.warning(f"Ignoring a push with a wrong signature for {site['name']}")
+            return 202
+
+        with self._lock:
+            FeedParser(
+                self._config, http_client=self._http_client
+            ).parse_pushed(
+                site,
+                content,
+                {
+                    "content-type": headers.get("content-type", "application/xml"),
+                    "content-location": subscription["topic"]
+                }
+            )
+        return 200
+
+    def _is_subscription_due(self, subscription: dict) -> bool:
+        if not subscription:
+            return True
+
+        now = self._now()
+        state = subscription.get("state", None)
+        if state == "verified":
+            return subscription["lease_expires_at"] - timedelta(
+                seconds=self._renew_before
+            ) <= now
+        # Pending, denied or without hub: try again after a while
+        return subscription.get("requested_at",
+                                now) + timedelta(seconds=self._renew_before) <= now
+
+    def _is_signature_valid(self, subscription: dict, content: bytes, headers: dict) -> bool:
+        signature = headers.get("x-hub-signature", None)
+        if not signature or "=" not in signature:
+            return False
+
+        method, digest = signature.split("=", 1)
+        if method not in self.SIGNATURE_METHODS:
+            return False
+
+        expected = hmac.new(subscription["secret"].encode(), content, method).hexdigest()
+        return hmac.compare_digest(expected, digest)
+
+    def _get_site_data(self, site: dict) -> dict:
+        with self._lock:
+            # Other processes may have written the storage in the meantime
+            self._feeds_storage.read_file()
+            return self._feeds_storage.get_hashed(site["url"], None) or {}
+
+    def _update_site_data(self, site: dict, changes: dict) -> None:
+        with self._lock, self._feeds_storage.locked():
+            site_data = self._feeds_storage.get_hashed(site["url"], None) or {}
+            self._feeds_storage.set_hashed(site["url"], {**site_data, **changes})
+            self._feeds_storage.write_file()
+
+    def _now(self) -> datetime:
+        return datetime.now(tz=pytz.UTC)
+
+    def _get_handler_class(self) -> type:
+        subscriber = self
+
+        class WebSubHandler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                subscriber._logger.debug("WebSub callback: " + format, *args)
+
+            def _respond(self, status_code: int, body: str = "") -> None:
+                payload = body.encode()
+                self.send_response(status_code)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _get_site_id(self) -> str:
+                # A proxy in front may keep its own path prefix
+                return urlparse(self.path).path.rstrip("/").rsplit("/", 1)[-1]
+
+            def do_GET(self):
+                try:
+                    status_code, body = subscriber.handle_verification(
+                        self._get_site_id(), parse_qs(urlparse(self.path).query)
+                    )
+                except Exception as e:
+                    subscriber._logger.exception(e)
+                    status_code, body = 500, ""
+                self._respond(status_code, body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                if length > subscriber._max_push_bytes:
+                    self._respond(413)
+                    return
+
+                content = self.rfile.read(length) if length > 0 else b""
+                try:
+                    status_code = subscriber.handle_push(
+                        self._get_site_id(),
+                        content, {key.lower(): value
+                                  for key, value in self.headers.items()}
+                    )
+                except Exception as e:
+                    # The hub retries the failed deliveries
+                    subscriber._logger.exception(e)
+                    status_code = 500
+                self._respond(status_code)
+
+        return WebSubHandler
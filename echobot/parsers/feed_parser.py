@@ -1,16 +1,27 @@
 from pyxavi.config import Config
-from pyxavi.storage import Storage
 from pyxavi.media import Media
 from pyxavi.url import Url
 from pyxavi.terminal_color import TerminalColor
-from pyxavi.queue_stack import Queue, SimpleQueueItem
 from echobot.parsers.keywords_filter import KeywordsFilter
+from echobot.lib.queue_item import QueueItem
+from echobot.lib.run_metrics import RunMetrics
+from echobot.lib.http_client import HttpClient
+from echobot.lib.poll_scheduler import PollScheduler
+from echobot.lib.circuit_breaker import CircuitBreaker
+from echobot.lib.run_budget import RunBudget
+from echobot.lib.fetch_cache import FetchCache
+from echobot.lib.locked_storage import LockedQueue, get_storage, get_storage_params
+from echobot.lib.shard import Shard
+from echobot.parsers.incremental_feed_reader import (
+    IncrementalFeedReader, UnreadableFeedException
+)
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from dateutil import parser
 from bs4 import BeautifulSoup
 import pytz
 from time import mktime
+from hashlib import sha256
 import feedparser
 import logging
 import re
@@ -26,19 +37,52 @@ class FeedParser:
     MAX_SUMMARY_LENGTH = 300
     DEFAULT_STORAGE_FILE = "storage/feeds.yaml"
     DEFAULT_QUEUE_FILE = "storage/queue.yaml"
-
-    def __init__(self, config: Config) -> None:
+    DEFAULT_WEBSUB_SAFETY_INTERVAL = 86400
+    ACCEPTED_NUM_MONTHS_AGO = 6
+    URLS_SEEN_MONTH_FORMAT = "%Y-%m"
+
+    def __init__(
+        self,
+        config: Config,
+        metrics: RunMetrics = None,
+        http_client: HttpClient = None,
+        fetch_cache: FetchCache = None,
+        shard: Shard = None,
+        budget: RunBudget = None
+    ) -> None:
         self._config = config
         self._logger = logging.getLogger(config.get("logger.name"))
-        self._feeds_storage = Storage(
-            self._config.get("feed_parser.storage_file", self.DEFAULT_STORAGE_FILE)
-        )
-        self._queue = Queue(
-            logger=self._logger,
-            storage_file=config.get("toots_queue_storage.file", self.DEFAULT_QUEUE_FILE)
+        self._metrics = metrics if metrics is not None else RunMetrics(config)
+        self._shard = shard
+        self._budget = budget
+        storage_params = get_storage_params(config)
+        self._feeds_storage = get_storage(
+            self._config.get("feed_parser.storage_file", self.DEFAULT_STORAGE_FILE),
+            shard=shard,
+            **storage_params
         )
+        with self._metrics.stage("queue.load"):
+            self._queue = LockedQueue(
+                logger=self._logger,
+                storage_file=config.get("toots_queue_storage.file", self.DEFAULT_QUEUE_FILE),
+                queue_item_object=QueueItem,
+                **storage_params
+            )
         self._media = Media()
         self._keywords_filter = KeywordsFilter(config)
+        self._poll_scheduler = PollScheduler(config)
+        self._circuit_breaker = CircuitBreaker(config)
+        self._websub_safety_interval = config.get(
+            "websub.safety_interval", self.DEFAULT_WEBSUB_SAFETY_INTERVAL
+        ) if config.get("websub.active", False) else None
+        # All feeds share the connections, many of them come from the same hosts
+        self._http_client = http_client if http_client is not None else HttpClient(config)
+        # Shared with other bots in the same process. The incremental reading
+        #   stops at what this bot has seen, so it can't be shared
+        self._fetch_cache = fetch_cache
+        self._incremental_reader = IncrementalFeedReader(config, self._http_client)\
+            if config.get("feed_parser.incremental.active", False)\
+            and fetch_cache is None else None
 
     def _format_toot(self, post: dict, origin: str, site_options: dict) -> str:
 
@@ -90,133 +134,425 @@ class FeedParser:
             self._logger.info("No sites registered to parse, skipping,")
             return
 
+        if self._shard is not None:
+            sites_params = [site for site in sites_params if self._shard.owns(site["url"])]
+        if self._budget is not None:
+            sites_params = self._budget.order("feed", sites_params, lambda site: site["url"])
+
         # For each user in the config
-        for site in sites_params:
-            site_name = site["name"]
+        for position, site in enumerate(sites_params):
+            if self._budget is not None and not self._budget.allows_source(
+                    "feed", sites_params, position, lambda site: site["url"]):
+                break
+            try:
+                self._parse_site(site)
+            except Exception as e:
+                # A broken site must not stop the rest
+                self._record_failure(site, e)
+        else:
+            if self._budget is not None:
+                self._budget.finish("feed")
+
+        self._save_queue()
+
+    def _parse_site(self, site: dict) -> None:
+        site_name = site["name"]
+        self._logger.info(f"{TerminalColor.BLUE}Processing site {site_name}{TerminalColor.END}")
+
+        self._logger.debug("Getting possible stored data for %s", site_name)
+        site_data = self._feeds_storage.get_hashed(site["url"], None)
+
+        # Feeds that publish rarely don't need to be fetched in every run,
+        #   and the ones pushed by a WebSub hub are only polled as a safety net
+        polling = site_data.get("polling", None) if site_data else None
+        is_pushed = self._is_pushed(site_data)
+        if not self._poll_scheduler.is_due(polling, enforce=is_pushed):
             self._logger.info(
-                f"{TerminalColor.BLUE}Processing site {site_name}{TerminalColor.END}"
+                f"Not due until {polling['next_due_at']}" +
+                f"{', pushed by WebSub' if is_pushed else ''}, skipping"
             )
+            self._metrics.count_source("feed", site_name)
+            self._metrics.increment("sources_not_due")
+            return
 
-            keywords_filter_profile = site["keywords_filter_profile"] \
-                if "keywords_filter_profile" in site and\
-                site["keywords_filter_profile"] else None
+        # A site that keeps failing is left alone for a while
+        circuit = site_data.get("circuit", None) if site_data else None
+        if not self._circuit_breaker.is_allowed(circuit):
+            self._logger.info(f"{self._circuit_breaker.describe(circuit)}, skipping")
+            self._metrics.count_source("feed", site_name)
+            self._metrics.set_circuit("feed", site_name, CircuitBreaker.OPEN)
+            self._metrics.increment("sources_circuit_open")
+            return
 
-            self._logger.debug("Getting possible stored data for %s", site_name)
-            site_data = self._feeds_storage.get_hashed(site["url"], None)
+        # Keep track of the post seen.
+        known_links = set(site_data["urls_seen"]
+                          ) if site_data and "urls_seen" in site_data else set()
+        last_published_at = site_data["last_published_at"]\
+            if site_data and "last_published_at" in site_data else None
+        previous_digest = site_data["digest"] if site_data and "digest" in site_data else None
+
+        self._logger.debug("Parsing site %s", site_name)
+        parsed_site = self._circuit_breaker.call(
+            lambda: self._read_feed(site, known_links, last_published_at, previous_digest),
+            site
+        )
+        if circuit is not None:
+            self._metrics.set_circuit("feed", site_name, CircuitBreaker.CLOSED)
+
+        # The fetch is done without the lock, it can take longer than the lock waits.
+        #   Another process may have worked on the same site meanwhile
+        with self._feeds_storage.locked():
+            self._store_site(site, parsed_site)
+
+    def _store_site(self, site: dict, parsed_site: dict) -> None:
+        site_name = site["name"]
+        site_data = self._feeds_storage.get_hashed(site["url"], None) or {}
+        circuit = site_data.get("circuit", None)
+        polling = site_data.get("polling", None)
+
+        # Nothing changed since the last time, so nothing new can come out of it
+        if parsed_site.get("unchanged", False):
+            skipped_parses = site_data.get("skipped_parses", 0) + 1
+            self._logger.info(
+                "The feed did not change since the last run, skipping." +
+                f" Skipped {skipped_parses} times so far"
+            )
+            self._metrics.count_source("feed", site_name)
+            self._metrics.increment("feeds_unchanged")
+            self._feeds_storage.set_hashed(
+                site["url"],
+                {
+                    **site_data,
+                    "skipped_parses": skipped_parses,
+                    "circuit": self._circuit_breaker.record_success(circuit),
+                    "polling": self._poll_scheduler.schedule(
+                        polling, [], self._get_polling_params(site, site_data)
+                    )
+                }
+            )
+            self._feeds_storage.write_file()
+            return
+
+        # Update our storage with what we found
+        site_data = self.process_entries(site, parsed_site, site_data)
+        self._logger.debug("Updating gathered site data for %s", site_name)
+        self._feeds_storage.set_hashed(
+            site["url"],
+            {
+                **site_data,
+                "digest": parsed_site.get("digest", None),
+                "circuit": self._circuit_breaker.record_success(circuit)
+            }
+        )
+        self._logger.debug("Storing data for %s", site_name)
+        self._feeds_storage.write_file()
+
+    def _record_failure(self, site: dict, error: Exception) -> None:
+        self._logger.warning(
+            f"{TerminalColor.RED}Could not parse the site {site['name']}: {error}" +
+            f"{TerminalColor.END}"
+        )
+        self._metrics.count_source("feed", site["name"])
+        self._metrics.increment("source_failures")
+        with self._feeds_storage.locked():
+            site_data = self._feeds_storage.get_hashed(site["url"], None) or {}
+            circuit = self._circuit_breaker.record_failure(
+                site_data.get("circuit", None), error
+            )
+            self._metrics.set_circuit("feed", site["name"], circuit["state"])
+            self._feeds_storage.set_hashed(site["url"], {**site_data, "circuit": circuit})
+            self._feeds_storage.write_file()
+
+    def parse_pushed(self, site: dict, content: bytes, headers: dict = None) -> None:
+        """
+        Sends the content pushed by a WebSub hub through the same pipeline
+            as the polled feeds.
+        """
+        self._logger.info(
+            f"{TerminalColor.BLUE}Processing pushed content for site {site['name']}" +
+            f"{TerminalColor.END}"
+        )
+        with self._metrics.stage("feed.parse"):
+            parsed_site = feedparser.parse(content, response_headers=headers or {})
+        self._metrics.increment("feeds_pushed")
 
-            self._logger.debug("Parsing site %s", site_name)
-            parsed_site = feedparser.parse(site["url"])
+        with self._feeds_storage.locked():
+            site_data = self._feeds_storage.get_hashed(site["url"], None)
+            self._feeds_storage.set_hashed(
+                site["url"], self.process_entries(site, parsed_site, site_data)
+            )
+            self._feeds_storage.write_file()
+        self._save_queue()
+
+    def process_entries(self, site: dict, parsed_site: dict, site_data: dict = None) -> dict:
+        """
+        Runs the entries of a parsed feed through the seen check, the filters
+            and the formatting, and appends the survivors to the queue.
+
+        Returns the site data updated with what was seen. Neither the storage
+            nor the queue are saved here.
+        """
+        site_name = site["name"]
+        site_data = site_data if site_data else {}
+        keywords_filter_profile = site["keywords_filter_profile"] \
+            if "keywords_filter_profile" in site and\
+            site["keywords_filter_profile"] else None
+
+        # Keep track of the post seen.
+        urls_seen = site_data["urls_seen"] if "urls_seen" in site_data else []
+        known_links = set(urls_seen)
+        # Where the URLs first seen this month start, so they can be pruned once too old
+        urls_seen_since = site_data.get("urls_seen_since", None) or {}
+        month = datetime.now(tz=pytz.UTC).strftime(self.URLS_SEEN_MONTH_FORMAT)
+        if month not in urls_seen_since:
+            urls_seen_since = {**urls_seen_since, month: len(urls_seen)}
+        last_published_at = site_data["last_published_at"]\
+            if "last_published_at" in site_data else None
+
+        if "language_overwrite" in site and "language_default" in site and site[
+                "language_default"] and site["language_overwrite"]:
+            metadata = {"language": site["language_default"]}
+        else:
+            metadata = {
+                "language": parsed_site["feed"]["language"]
+                if "language" in parsed_site["feed"] else site["language_default"]
+            }
+
+        if "entries" not in parsed_site or not parsed_site["entries"]:
+            self._logger.warn("No entries in this feed, skipping.")
+
+        self._logger.debug("Sorting %d entries ASC", len(parsed_site["entries"]))
+        # Entries without date go first, they'll be discarded later on
+        posts = sorted(
+            parsed_site["entries"], key=lambda x: x.get("published_parsed", None) or ()
+        )
 
-            if "language_overwrite" in site and "language_default" in site and site[
-                    "language_default"] and site["language_overwrite"]:
-                metadata = {"language": site["language_default"]}
+        discarded_posts = 0
+        queued_posts = 0
+        total_posts = len(posts)
+        new_posts_dates = []
+        for post in posts:
+
+            # Malformed feeds may bring entries without link
+            if not post.get("link", None):
+                self._logger.debug("Discarding post: it has no link")
+                discarded_posts += 1
+                continue
+
+            # Check if this post was already seen
+            post_link = Url.clean(post["link"], {"scheme": True})
+            if post_link in known_links:
+                self._logger.debug("Discarding post: already seen %s", post["title"])
+                discarded_posts += 1
+                continue
             else:
-                metadata = {
-                    "language": parsed_site["feed"]["language"]
-                    if "language" in parsed_site["feed"] else site["language_default"]
-                }
+                urls_seen.append(post_link)
+                known_links.add(post_link)
+
+            # Calculate post date
+            post_date = self._get_post_date(post)
+            new_posts_dates.append(post_date)
+
+            # In some cases we don't have a 'summary', but a 'description' field
+            if "summary" not in post and "description" in post:
+                self._logger.debug("Making out a [summary] from a [description]")
+                post["summary"] = post["description"]
+            elif "summary" not in post and "description" not in post:
+                self._logger.debug("Could not fix not present [summary]. Discarding.")
+                discarded_posts += 1
+                continue
+
+            # Only in case that we need to filter per
+            #   keywords and the filtering bans the content.
+            if keywords_filter_profile and \
+                not self._profile_allows_text(
+                    keywords_filter_profile,
+                    post["summary"]):
+                self._logger.info(
+                    "Filtering %s per keyword profile '%s', this Feed post is not allowed",
+                    site_name,
+                    keywords_filter_profile
+                )
+                discarded_posts += 1
+                continue
+
+            if post_date is None:
+                self._logger.warn("Discarding post: no usable published date, can't rely on it")
+                discarded_posts += 1
+                continue
+
+            if last_published_at is None or post_date > last_published_at:
+                last_published_at = post_date
+
+            # We don't want anything older than 6 months
+            #   and also older of the last entry we have registered
+            if datetime.now().replace(tzinfo=pytz.UTC) - relativedelta(
+                    months=self.ACCEPTED_NUM_MONTHS_AGO) > post_date:
+                self._logger.debug("Discarding post: too old %s", post_date)
+                discarded_posts += 1
+                continue
+
+            # Prepare the new toot
+            self._logger.debug("The post [%s] made it to the end.", post["title"])
+            media = self._parse_media(post)
+            self._logger.debug("The post [%s] has %d media elements", post["title"], len(media))
+            self._queue.append(
+                QueueItem(
+                    {
+                        "status": self._format_toot(post, site_name, site),
+                        "media": media if media else None,
+                        "language": metadata["language"],
+                        "published_at": post_date,
+                        "action": "new"
+                    }
+                )
+            )
+            queued_posts += 1
+            self._logger.debug("The post [%s] has been added tot he queue", post["title"])
+
+        self._metrics.count_source(
+            "feed",
+            site_name,
+            fetched=total_posts,
+            discarded=discarded_posts,
+            queued=queued_posts
+        )
 
-            if "entries" not in parsed_site or not parsed_site["entries"]:
-                self._logger.warn("No entries in this feed, skipping.")
-
-            self._logger.debug("Sorting %d entries ASC", len(parsed_site["entries"]))
-            posts = sorted(parsed_site["entries"], key=lambda x: x["published_parsed"])
-
-            # Keep track of the post seen.
-            urls_seen = site_data["urls_seen"] if site_data and "urls_seen" in site_data else []
-
-            discarded_posts = 0
-            queued_posts = 0
-            total_posts = len(posts)
-            for post in posts:
-
-                # Check if this post was already seen
-                post_link = Url.clean(post["link"], {"scheme": True})
-                if post_link in urls_seen:
-                    self._logger.debug("Discarding post: already seen %s", post["title"])
-                    discarded_posts += 1
-                    continue
-                else:
-                    urls_seen.append(post_link)
-
-                # In some cases we don't have a 'summary', but a 'description' field
-                if "summary" not in post and "description" in post:
-                    self._logger.debug("Making out a [summary] from a [description]")
-                    post["summary"] = post["description"]
-                elif "summary" not in post and "description" not in post:
-                    self._logger.debug("Could not fix not present [summary]. Discarding.")
-                    discarded_posts += 1
-                    continue
-
-                # Only in case that we need to filter per
-                #   keywords and the filtering bans the content.
-                if keywords_filter_profile and \
-                    not self._keywords_filter.profile_allows_text(
-                        keywords_filter_profile,
-                        post["summary"]):
-                    self._logger.info(
-                        "Filtering %s per keyword profile '%s', this Feed post is not allowed",
-                        site_name,
-                        keywords_filter_profile
-                    )
-                    discarded_posts += 1
-                    continue
-
-                # Calculate post date
-                post_date = None
-                if "published_parsed" in post and post["published_parsed"]:
-                    post_date = datetime.fromtimestamp(mktime(post["published_parsed"])
-                                                       ).replace(tzinfo=pytz.UTC)
-                elif "published" in post and post["published"]:
-                    post_date = parser.parse(post["published"])
-                else:
-                    self._logger.warn(
-                        "Discarding post: no usable published date, can't rely on it"
+        color = TerminalColor.GREEN if queued_posts > 0 else TerminalColor.END
+        self._logger.info(
+            f"{color}Added {queued_posts} posts of {total_posts} to the queue," +
+            f" {discarded_posts} were discarded{TerminalColor.END}"
+        )
+
+        return {
+            **site_data,
+            "urls_seen": urls_seen,
+            "urls_seen_since": urls_seen_since,
+            "last_published_at": last_published_at,
+            "polling": self._poll_scheduler.schedule(
+                site_data.get("polling", None),
+                new_posts_dates,
+                self._get_polling_params(site, site_data)
+            )
+        }
+
+    def _save_queue(self) -> None:
+        # Update the toots queue, by adding the new ones at the end of the list
+        with self._metrics.stage("queue.save"), self._queue.locked():
+            self._queue.sort(param="published_at")
+            self._queue.deduplicate(param="status")
+            self._queue.save()
+
+    def _is_pushed(self, site_data: dict) -> bool:
+        """
+        A site is pushed when it has a verified WebSub subscription that is not expired
+        """
+        subscription = site_data.get("websub", None) if site_data else None
+        if self._websub_safety_interval is None or not subscription\
+           or subscription.get("state", None) != "verified"\
+           or not subscription.get("lease_expires_at", None):
+            return False
+
+        return subscription["lease_expires_at"] > datetime.now(tz=pytz.UTC)
+
+    def _get_polling_params(self, site: dict, site_data: dict) -> dict:
+        if not self._is_pushed(site_data):
+            return site
+
+        return {
+            **site,
+            "min_interval": max(site.get("min_interval", 0), self._websub_safety_interval),
+            "max_interval": max(site.get("max_interval", 0), self._websub_safety_interval)
+        }
+
+    def _read_feed(
+        self,
+        site: dict,
+        known_links: set,
+        last_published_at: datetime,
+        previous_digest: str = None
+    ) -> dict:
+        """
+        Reads the feed incrementally if it is enabled.
+            Feedparser is still used for the feeds that the fast path can't read.
+
+        Many sites don't send validators but keep the same body for hours.
+            A digest of the raw body, or of the entries when reading incrementally,
+            is returned under "digest", and "unchanged" is True if it matches
+            the previous one. In that case the entries may not be parsed at all.
+        """
+        url = site["url"]
+        timeout = site.get("timeout", None)
+        max_bytes = site["max_size_kb"] * 1024 if site.get("max_size_kb", None) else None
+
+        if self._incremental_reader is not None:
+            try:
+                # Here the download and the parsing are interleaved
+                with self._metrics.stage("feed.fetch_parse"):
+                    parsed_site = self._incremental_reader.read(
+                        url,
+                        known_links=known_links,
+                        last_published_at=last_published_at,
+                        timeout=timeout,
+                        max_bytes=max_bytes
                     )
-                    discarded_posts += 1
-                    continue
-
-                # We don't want anything older than 6 months
-                #   and also older of the last entry we have registered
-                if datetime.now().replace(tzinfo=pytz.UTC) - relativedelta(months=6
-                                                                           ) > post_date:
-                    self._logger.debug("Discarding post: too old %s", post_date)
-                    discarded_posts += 1
-                    continue
-
-                # Prepare the new toot
-                self._logger.debug("The post [%s] made it to the end.", post["title"])
-                media = self._parse_media(post)
+                self._metrics.increment("feeds_read_incrementally")
+                digest = self._get_entries_digest(parsed_site["entries"])
+                return {**parsed_site, "digest": digest, "unchanged": digest == previous_digest}
+            except UnreadableFeedException as e:
                 self._logger.debug(
-                    "The post [%s] has %d media elements", post["title"], len(media)
+                    "Incremental reading of %s failed, falling back to feedparser: %s", url, e
                 )
-                self._queue.append(
-                    SimpleQueueItem(
-                        {
-                            "status": self._format_toot(post, site_name, site),
-                            "media": media if media else None,
-                            "language": metadata["language"],
-                            "published_at": post_date,
-                            "action": "new"
-                        }
-                    )
-                )
-                queued_posts += 1
-                self._logger.debug("The post [%s] has been added tot he queue", post["title"])
+                self._metrics.increment("feeds_read_with_fallback")
 
-            color = TerminalColor.GREEN if queued_posts > 0 else TerminalColor.END
-            self._logger.info(
-                f"{color}Added {queued_posts} posts of {total_posts} to the queue," +
-                f" {discarded_posts} were discarded{TerminalColor.END}"
+        # A failed fetch goes up to the circuit breaker of the site
+        with self._metrics.stage("feed.fetch"):
+            response = self._get_shared(
+                ("feed", url),
+                lambda: self._http_client.get(url, timeout=timeout, max_bytes=max_bytes)
             )
 
-            # Update our storage with what we found
-            self._logger.debug("Updating gathered site data for %s", site_name)
-            self._feeds_storage.set_hashed(site["url"], {"urls_seen": urls_seen})
-            self._logger.debug("Storing data for %s", site_name)
-            self._feeds_storage.write_file()
+        digest = sha256(response["content"]).hexdigest()
+        if digest == previous_digest:
+            return {"feed": {}, "entries": [], "digest": digest, "unchanged": True}
+
+        # Feedparser takes the encoding and the base URL from the headers
+        def parse_response() -> dict:
+            return feedparser.parse(response["content"], response_headers=response["headers"])
+
+        with self._metrics.stage("feed.parse"):
+            parsed_site = self._get_shared(("feed.parsed", url), parse_response)
+        return {**parsed_site, "digest": digest}
+
+    def _get_shared(self, key: tuple, producer: callable) -> any:
+        return producer() if self._fetch_cache is None else self._fetch_cache.get(key, producer)
+
+    def _get_post_date(self, post: dict) -> datetime:
+        if "published_parsed" in post and post["published_parsed"]:
+            return datetime.fromtimestamp(mktime(post["published_parsed"])
+                                          ).replace(tzinfo=pytz.UTC)
+        elif "published" in post and post["published"]:
+            return parser.parse(post["published"])
+        return None
+
+    def _get_entries_digest(self, entries: list) -> str:
+        """
+        Digest of the entries, normalized to the fields that matter to us
+        """
+        digest = sha256()
+        for entry in entries:
+            digest.update(
+                "\x00".join(
+                    [
+                        entry.get("link", ""),
+                        entry.get("published", ""),
+                        entry.get("title", ""),
+                        entry.get("summary", "")
+                    ]
+                ).encode()
+            )
+        return digest.hexdigest()
 
-        # Update the toots queue, by adding the new ones at the end of the list
-        self._queue.sort(param="published_at")
-        self._queue.deduplicate(param="status")
-        self._queue.save()
+    def _profile_allows_text(self, profile: str, text: str) -> bool:
+        with self._metrics.stage("filter"):
+            return self._keywords_filter.profile_allows_text(profile, text)
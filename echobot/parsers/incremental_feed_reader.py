@@ -0,0 +1,212 @@
+from pyxavi.config import Config
+from pyxavi.url import Url
+from echobot.lib.http_client import HttpClient
+from xml.etree.ElementTree import XMLPullParser, ParseError, tostring
+from email.utils import parsedate_to_datetime
+from datetime import datetime
+from dateutil import parser
+import logging
+import pytz
+
+
+class UnreadableFeedException(RuntimeError):
+    pass
+
+
+class IncrementalFeedReader:
+    '''
+    Reads RSS and Atom feeds incrementally, as they are downloaded
+
+    Every entry is built from the XML events and its elements are released
+    right after, so memory stays bounded. For feeds that come newest first,
+    the reading stops once enough consecutive entries are already known
+    or older than the last processed date, leaving the rest unread.
+
+    Returns a subset of the structure that feedparser returns,
+    only with the fields that the FeedParser uses.
+    A document that can't be read raises an UnreadableFeedException,
+    so that the caller can fall back to feedparser.
+    '''
+
+    DEFAULT_STOP_AFTER_KNOWN = 5
+    DEFAULT_CHUNK_SIZE_KB = 64
+    ENTRY_TAGS = ["item", "entry"]
+    ROOT_TAGS = ["rss", "feed", "RDF"]
+    XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+
+    def __init__(self, config: Config, http_client: HttpClient = None) -> None:
+        self._logger = logging.getLogger(config.get("logger.name"))
+        self._http_client = http_client if http_client is not None else HttpClient(config)
+        self._stop_after_known = config.get(
+            "feed_parser.incremental.stop_after_known", self.DEFAULT_STOP_AFTER_KNOWN
+        )
+        self._chunk_size = config.get(
+            "feed_parser.incremental.chunk_size_kb", self.DEFAULT_CHUNK_SIZE_KB
+        ) * 1024
+
+    def read(
+        self,
+        url: str,
+        known_links: set = None,
+        last_published_at: datetime = None,
+        timeout: int = None,
+        max_bytes: int = None
+    ) -> dict:
+        """
+        Reads the feed from an URL or a local file.
+
+        known_links are the already seen links, without scheme.
+        """
+        known_links = known_links if known_links is not None else set()
+        pull_parser = XMLPullParser(events=["start", "end"])
+        state = {
+            "language": None,
+            "entries": [],
+            "depth": 0,
+            "is_descending": True,
+            "previous_date": None,
+            "consecutive_known": 0,
+            "stopped_early": False,
+            "root_found": False
+        }
+
+        chunks = self._http_client.stream(
+            url, timeout=timeout, max_bytes=max_bytes, chunk_size=self._chunk_size
+        )
+        try:
+            for chunk in chunks:
+                pull_parser.feed(chunk)
+                self._process_events(pull_parser, state, known_links, last_published_at)
+                if state["stopped_early"]:
+                    break
+            else:
+                pull_parser.close()
+                self._process_events(pull_parser, state, known_links, last_published_at)
+        except ParseError as e:
+            raise UnreadableFeedException(f"The feed is not well formed: {e}")
+        finally:
+            # Stops the download when we stopped early
+            chunks.close()
+
+        if not state["root_found"]:
+            raise UnreadableFeedException("The document is not an RSS or Atom feed")
+
+        self._logger.debug(
+            "Read %d entries incrementally%s",
+            len(state["entries"]),
+            ", stopped early" if state["stopped_early"] else ""
+        )
+        return {
+            "feed": {
+                "language": state["language"]
+            } if state["language"] else {},
+            "entries": state["entries"],
+            "stopped_early": state["stopped_early"]
+        }
+
+    def _process_events(
+        self,
+        pull_parser: XMLPullParser,
+        state: dict,
+        known_links: set,
+        last_published_at: datetime
+    ) -> None:
+        for event, element in pull_parser.read_events():
+            tag = self._local_name(element.tag)
+            if event == "start":
+                state["depth"] += 1
+                if state["depth"] == 1:
+                    state["root_found"] = tag in self.ROOT_TAGS
+                    state["language"] = element.get(self.XML_LANG, None)
+                continue
+
+            state["depth"] -= 1
+            if tag == "language" and state["language"] is None:
+                state["language"] = (element.text or "").strip() or None
+            elif tag in self.ENTRY_TAGS:
+                entry = self._build_entry(element)
+                # Release the already processed content
+                element.clear()
+                if entry is None:
+                    continue
+                state["entries"].append(entry)
+                if self._should_stop(entry, state, known_links, last_published_at):
+                    state["stopped_early"] = True
+                    return
+
+    def _should_stop(
+        self, entry: dict, state: dict, known_links: set, last_published_at: datetime
+    ) -> bool:
+        date = entry.get("published_datetime", None)
+        if date is not None:
+            if state["previous_date"] is not None and date > state["previous_date"]:
+                # Not newest first, we can't assume that the rest is known
+                state["is_descending"] = False
+            state["previous_date"] = date
+
+        is_known = Url.clean(entry["link"], {"scheme": True}) in known_links\
+            or (date is not None and last_published_at is not None
+                and date <= last_published_at)
+        state["consecutive_known"] = state["consecutive_known"] + 1 if is_known else 0
+
+        return state["is_descending"] and self._stop_after_known > 0\
+            and state["consecutive_known"] >= self._stop_after_known
+
+    def _build_entry(self, element) -> dict:
+        fields = {}
+        for child in element:
+            tag = self._local_name(child.tag)
+            if tag == "link":
+                # Atom links come in the href, and there may be several
+                if child.get("href", None) is not None:
+                    if child.get("rel", "alternate") == "alternate" or "link" not in fields:
+                        fields["link"] = child.get("href")
+                elif child.text:
+                    fields["link"] = child.text.strip()
+            elif tag not in fields:
+                fields[tag] = self._get_content(child)
+
+        if "link" not in fields:
+            return None
+
+        entry = {"title": fields.get("title", ""), "link": fields["link"]}
+        summary = fields.get("summary", fields.get("description", None))
+        if summary is None:
+            summary = fields.get("encoded", fields.get("content", None))
+        if summary is not None:
+            entry["summary"] = summary
+
+        published = fields.get(
+            "published", fields.get("pubDate", fields.get("date", fields.get("updated", None)))
+        )
+        date = self._parse_date(published) if published else None
+        if date is not None:
+            entry["published"] = published
+            entry["published_parsed"] = date.timetuple()
+            entry["published_datetime"] = date
+
+        return entry
+
+    def _get_content(self, element) -> str:
+        # XHTML contents come as child elements instead of escaped text
+        content = element.text or ""
+        for child in element:
+            for descendant in child.iter():
+                descendant.tag = self._local_name(descendant.tag)
+            content += tostring(child, encoding="unicode")
+        return content.strip()
+
+    def _parse_date(self, value: str) -> datetime:
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            try:
+                date = parser.parse(value)
+            except (ValueError, OverflowError):
+                return None
+
+        date = date if date.tzinfo is not None else date.replace(tzinfo=pytz.UTC)
+        return date.astimezone(pytz.UTC)
+
+    def _local_name(self, tag: str) -> str:
+        return tag.rsplit("}", 1)[-1] if isinstance(tag, str) else ""
@@ -8,16 +8,20 @@ class KeywordsFilter:
     def __init__(self, config: Config) -> None:
         self._config = config
         self._logger = logging.getLogger(config.get("logger.name"))
+        # Resolved once, every filtered post looks them up
+        self._profiles = {}
+        for name, profile in (config.get("keywords_filter.profiles", None) or {}).items():
+            self._profiles[name] = (profile or {}).get("keywords", None) or []
 
     def profile_allows_text(self, profile: str, text: str) -> bool:
-        if profile not in self._config.get("keywords_filter.profiles", []):
+        if profile not in self._profiles:
             self._logger.warning(
                 f"Can't find the profile [{profile}] in the config's Keyword Filters"
             )
             # If the profile does not exist, assume that is not set up, so all is allowed
             return True
 
-        keywords = self._config.get(f"keywords_filter.profiles.{profile}.keywords", [])
+        keywords = self._profiles[profile]
         text = self._clean_text(text)
 
         for keyword in keywords:
@@ -1,9 +1,15 @@
 from pyxavi.config import Config
-from pyxavi.storage import Storage
 from pyxavi.terminal_color import TerminalColor
 from echobot.parsers.keywords_filter import KeywordsFilter
 from mastodon import Mastodon
-from pyxavi.queue_stack import Queue, SimpleQueueItem
+from echobot.lib.queue_item import QueueItem
+from echobot.lib.run_metrics import RunMetrics
+from echobot.lib.poll_scheduler import PollScheduler
+from echobot.lib.circuit_breaker import CircuitBreaker
+from echobot.lib.run_budget import RunBudget
+from echobot.lib.fetch_cache import FetchCache
+from echobot.lib.locked_storage import LockedQueue, get_storage, get_storage_params
+from echobot.lib.shard import Shard
 import logging
 
 
@@ -14,17 +20,44 @@ class MastodonParser:
     DEFAULT_STORAGE_FILE = "storage/accounts.yaml"
     DEFAULT_QUEUE_FILE = "storage/queue.yaml"
 
-    def __init__(self, config: Config) -> None:
+    def __init__(
+        self,
+        config: Config,
+        metrics: RunMetrics = None,
+        fetch_cache: FetchCache = None,
+        shard: Shard = None,
+        budget: RunBudget = None
+    ) -> None:
         self._config = config
         self._logger = logging.getLogger(config.get("logger.name"))
-        self._accounts_storage = Storage(
-            config.get("mastodon_parser.storage_file", self.DEFAULT_STORAGE_FILE)
+        self._metrics = metrics if metrics is not None else RunMetrics(config)
+        self._shard = shard
+        self._budget = budget
+        storage_params = get_storage_params(config)
+        self._accounts_storage = get_storage(
+            config.get("mastodon_parser.storage_file", self.DEFAULT_STORAGE_FILE),
+            shard=shard,
+            **storage_params
         )
-        self._queue = Queue(
-            logger=self._logger,
-            storage_file=config.get("toots_queue_storage.file", self.DEFAULT_QUEUE_FILE)
+        with self._metrics.stage("queue.load"):
+            self._queue = LockedQueue(
+                logger=self._logger,
+                storage_file=config.get("toots_queue_storage.file", self.DEFAULT_QUEUE_FILE),
+                queue_item_object=QueueItem,
+                **storage_params
+            )
+        # Resolved once, they are checked for every account and toot
+        self._only_public_visibility = config.get(
+            "mastodon_parser.only_public_visibility", False
         )
+        self._ignore_toots_offset = config.get("mastodon_parser.ignore_toots_offset", False)
         self._keywords_filter = KeywordsFilter(config)
+        self._poll_scheduler = PollScheduler(config)
+        self._circuit_breaker = CircuitBreaker(config)
+        # Shared with other bots in the same process
+        self._fetch_cache = fetch_cache
+        # What an account shows depends on who is asking, known when parsing
+        self._viewer = None
 
     def parse(self, mastodon: Mastodon) -> None:
 
@@ -34,12 +67,33 @@ class MastodonParser:
             self._logger.info("No accounts registered to parse, skipping,")
             return
 
+        if self._shard is not None:
+            accounts_params = [
+                account for account in accounts_params if self._shard.owns(account["user"])
+            ]
+            if not accounts_params:
+                self._logger.info(f"No accounts for the shard {self._shard.name}, skipping,")
+                return
+
         # Get info about the bot itself.
         # Will be useful later on to get the relations with other accounts.
         bot_account = mastodon.me()
+        # What an account shows depends on the instance and, for the non public
+        #   statuses, on who is asking
+        self._viewer = mastodon.api_base_url\
+            if self._only_public_visibility\
+            else f"{mastodon.api_base_url}#{bot_account['id']}"
+
+        if self._budget is not None:
+            accounts_params = self._budget.order(
+                "mastodon", accounts_params, lambda account: account["user"]
+            )
 
         # For each user in the config
-        for account_params in accounts_params:
+        for position, account_params in enumerate(accounts_params):
+            if self._budget is not None and not self._budget.allows_source(
+                    "mastodon", accounts_params, position, lambda account: account["user"]):
+                break
             account_user = account_params["user"]
             self._logger.info(
                 f"{TerminalColor.BLUE}Processing account {account_user}{TerminalColor.END}"
@@ -54,24 +108,50 @@ class MastodonParser:
             # Do we have any config relating this user already?
             self._logger.debug("Getting possible stored data for %s", account_user)
             user = self._accounts_storage.get_hashed(account_user)
-            if user:
+            if user and not self._poll_scheduler.is_due(user.get("polling", None)):
+                self._logger.info(f"Not due until {user['polling']['next_due_at']}, skipping")
+                self._metrics.count_source("mastodon", account_user)
+                self._metrics.increment("sources_not_due")
+                continue
+
+            # An account that keeps failing is left alone for a while
+            circuit = user.get("circuit", None) if user else None
+            if not self._circuit_breaker.is_allowed(circuit):
+                self._logger.info(f"{self._circuit_breaker.describe(circuit)}, skipping")
+                self._metrics.count_source("mastodon", account_user)
+                self._metrics.set_circuit("mastodon", account_user, CircuitBreaker.OPEN)
+                self._metrics.increment("sources_circuit_open")
+                continue
+
+            if user and "id" in user:
                 self._logger.debug("Reusing stored data for %s", account_user)
                 account_id = user["id"]
 
-                if not self._config.get("mastodon_parser.ignore_toots_offset") \
-                   and user["last_seen_toot"]:
+                if not self._ignore_toots_offset \
+                   and user.get("last_seen_toot", None):
                     last_seen_toot = user["last_seen_toot"]
             else:
                 # Get the account ID from the given user string
                 self._logger.debug("Searching for %s", account_user)
-                accounts = mastodon.account_search(account_user)
+                try:
+                    accounts = self._circuit_breaker.call(
+                        lambda: self._get_shared(
+                            ("mastodon.search", mastodon.api_base_url, account_user),
+                            lambda: mastodon.account_search(account_user)
+                        ),
+                        account_params
+                    )
+                except Exception as e:
+                    # A broken account must not stop the rest
+                    self._record_failure(account_user, user, e)
+                    continue
 
                 if not accounts:
                     self._logger.warn("No account found for %s, skipping", account_user)
                     continue
                 else:
                     account_id = accounts[0]["id"]
-                    user = {"id": account_id}
+                    user = {**(user or {}), "id": account_id}
 
                     # Do we need to follow this account?
                     if "auto_follow" in account_params and account_params["auto_follow"]:
@@ -97,16 +177,39 @@ class MastodonParser:
                 account_user,
                 last_seen_toot if last_seen_toot else "ever"
             )
-            toots = mastodon.account_statuses(account_id, since_id=last_seen_toot)
+            try:
+                with self._metrics.stage("mastodon.fetch"):
+                    toots = self._circuit_breaker.call(
+                        lambda: self._fetch_statuses(mastodon, account_id, last_seen_toot),
+                        account_params
+                    )
+            except Exception as e:
+                self._record_failure(account_user, user, e)
+                continue
             self._logger.debug("got %s", len(toots))
+            user["circuit"] = self._circuit_breaker.record_success(circuit)
+            if circuit is not None:
+                self._metrics.set_circuit("mastodon", account_user, CircuitBreaker.CLOSED)
 
             # If no toots, just go for the next account
             if len(toots) == 0:
+                self._metrics.count_source("mastodon", account_user)
                 self._logger.debug(
                     "No Toots received for account %s.May be a federation issue. " +
                     "Is the bot following the account?",
                     account_user
                 )
+                self._accounts_storage.set_hashed(
+                    account_user,
+                    {
+                        **user,
+                        "last_seen_toot": user.get("last_seen_toot", None),
+                        "polling": self._poll_scheduler.schedule(
+                            user.get("polling", None), [], account_params
+                        )
+                    }
+                )
+                self._accounts_storage.write_file()
                 continue
 
             # Keep track of the last toot seen
@@ -114,6 +217,7 @@ class MastodonParser:
 
             # For each status
             queued_toots = 0
+            discarded_toots = 0
             total_toots = len(toots)
             for received_toot in toots:
 
@@ -124,14 +228,15 @@ class MastodonParser:
                 }
 
                 # Is visibility matching?
-                if self._config.get("mastodon_parser.only_public_visibility"):
+                if self._only_public_visibility:
                     if received_toot.visibility != "public":
+                        discarded_toots += 1
                         continue
 
                 # Only in case that we need to filter per
                 #   keywords and the filtering bans the content.
                 if keywords_filter_profile and \
-                    not self._keywords_filter.profile_allows_text(
+                    not self._profile_allows_text(
                         keywords_filter_profile,
                         received_toot.content):
                     self._logger.debug(
@@ -139,22 +244,31 @@ class MastodonParser:
                         account_user,
                         keywords_filter_profile
                     )
+                    discarded_toots += 1
                     continue
 
                 # Is an own status?
-                if not received_toot.in_reply_to_id \
+                is_own_toot = not received_toot.in_reply_to_id \
                     and not received_toot.in_reply_to_account_id \
-                        and account_params["toots"]:
-                    # queue to publish if the config say so
-                    queued_toots += 1
-                    self._queue.append(SimpleQueueItem(toot))
+                    and account_params["toots"]
 
                 # Is a retoot?
-                if received_toot.reblog \
-                   and account_params["retoots"]:
-                    # queue to publish if the config say so
+                is_retoot = received_toot.reblog and account_params["retoots"]
+
+                # queue to publish if the config say so
+                if is_own_toot or is_retoot:
                     queued_toots += 1
-                    self._queue.append(SimpleQueueItem(toot))
+                    self._queue.append(QueueItem(toot))
+                else:
+                    discarded_toots += 1
+
+            self._metrics.count_source(
+                "mastodon",
+                account_user,
+                fetched=total_toots,
+                discarded=discarded_toots,
+                queued=queued_toots
+            )
 
             # Log minimal stats
             if queued_toots > 0:
@@ -166,16 +280,52 @@ class MastodonParser:
             # Update our storage with what we found
             self._logger.debug("Updating gathered account data for %s", account_user)
             self._accounts_storage.set_hashed(
-                account_user, {
-                    **user, **{
-                        "last_seen_toot": new_last_seen_toot
-                    }
+                account_user,
+                {
+                    **user,
+                    "last_seen_toot": new_last_seen_toot,
+                    "polling": self._poll_scheduler.schedule(
+                        user.get("polling", None), [toot.created_at for toot in toots],
+                        account_params
+                    )
                 }
             )
             self._logger.debug("Storing data for %s", account_user)
             self._accounts_storage.write_file()
+        else:
+            if self._budget is not None:
+                self._budget.finish("mastodon")
 
         # Update the toots queue, by adding the new ones at the end of the list
-        self._queue.sort(param="published_at")
-        self._queue.deduplicate(param="id")
-        self._queue.save()
+        with self._metrics.stage("queue.save"), self._queue.locked():
+            self._queue.sort(param="published_at")
+            self._queue.deduplicate(param="id")
+            self._queue.save()
+
+    def _fetch_statuses(self, mastodon: Mastodon, account_id: int, last_seen_toot: int) -> list:
+        # Only the bots at the same offset share the fetch: the newest page alone
+        #   would miss the toots between an older offset and that page
+        return self._get_shared(
+            ("mastodon.statuses", self._viewer, account_id, last_seen_toot),
+            lambda: mastodon.account_statuses(account_id, since_id=last_seen_toot)
+        )
+
+    def _record_failure(self, account_user: str, user: dict, error: Exception) -> None:
+        self._logger.warning(
+            f"{TerminalColor.RED}Could not fetch the account {account_user}: {error}" +
+            f"{TerminalColor.END}"
+        )
+        self._metrics.count_source("mastodon", account_user)
+        self._metrics.increment("source_failures")
+        user = user if user else {}
+        circuit = self._circuit_breaker.record_failure(user.get("circuit", None), error)
+        self._metrics.set_circuit("mastodon", account_user, circuit["state"])
+        self._accounts_storage.set_hashed(account_user, {**user, "circuit": circuit})
+        self._accounts_storage.write_file()
+
+    def _get_shared(self, key: tuple, producer: callable) -> any:
+        return producer() if self._fetch_cache is None else self._fetch_cache.get(key, producer)
+
+    def _profile_allows_text(self, profile: str, text: str) -> bool:
+        with self._metrics.stage("filter"):
+            return self._keywords_filter.profile_allows_text(profile, text)
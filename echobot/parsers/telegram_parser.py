@@ -1,16 +1,25 @@
 from pyxavi.config import Config
-from pyxavi.storage import Storage
 from pyxavi.terminal_color import TerminalColor
-from pyxavi.queue_stack import Queue, SimpleQueueItem
+from echobot.lib.queue_item import QueueItem
+from echobot.lib.run_metrics import RunMetrics
+from echobot.lib.poll_scheduler import PollScheduler
+from echobot.lib.circuit_breaker import CircuitBreaker, SourceTimeoutException
+from echobot.lib.run_budget import RunBudget
+from echobot.lib.locked_storage import LockedQueue, get_storage, get_storage_params
+from echobot.lib.shard import Shard
+from echobot.lib.publisher import Publisher
 from telethon import TelegramClient
 from telethon.types import Message as TelegramMessage
 import logging
+import asyncio
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 import pytz
 import math
 import copy
+import time
 from hashlib import sha1
+from tempfile import SpooledTemporaryFile
 
 
 class TelegramParser:
@@ -21,19 +30,57 @@ class TelegramParser:
     DATE_FORMAT = "%Y-%m-%d"
     DEFAULT_TELEGRAM_FILE = "storage/telegram.yaml"
     DEFAULT_QUEUE_FILE = "storage/queue.yaml"
+    DEFAULT_STREAM_MAX_MEMORY_MB = 20
 
     _telegram: TelegramClient
 
-    def __init__(self, config: Config) -> None:
+    def __init__(
+        self,
+        config: Config,
+        metrics: RunMetrics = None,
+        shard: Shard = None,
+        publisher: Publisher = None,
+        budget: RunBudget = None
+    ) -> None:
         self._config = config
         self._logger = logging.getLogger(config.get("logger.name"))
-        self._chats_storage = Storage(
-            self._config.get("telegram_parser.storage_file", self.DEFAULT_TELEGRAM_FILE)
+        self._metrics = metrics if metrics is not None else RunMetrics(config)
+        self._shard = shard
+        self._budget = budget
+        # Streaming uploads the media while parsing, so it needs who uploads it
+        self._publisher = publisher
+        self._stream_media = publisher is not None\
+            and config.get("telegram_parser.stream_media.active", False)\
+            and not config.get("publisher.dry_run", False)
+        self._stream_max_memory = config.get(
+            "telegram_parser.stream_media.max_memory_mb", self.DEFAULT_STREAM_MAX_MEMORY_MB
+        ) * 1024 * 1024
+        self._stream_spool_directory = config.get(
+            "telegram_parser.stream_media.spool_directory", None
         )
-        self._queue = Queue(
-            logger=self._logger,
-            storage_file=config.get("toots_queue_storage.file", self.DEFAULT_QUEUE_FILE)
+        self._streamed_media_ttl = config.get(
+            "publisher.media_prefetch.uploads_ttl", Publisher.DEFAULT_PREFETCHED_MEDIA_TTL
         )
+        # Resolved once, they are the same for every chat
+        self._ignore_offsets = config.get("telegram_parser.ignore_offsets", False)
+        date_to_start_from = config.get("telegram_parser.date_to_start_from", None)
+        self._date_to_start_from = datetime.strptime(date_to_start_from, self.DATE_FORMAT)\
+            if date_to_start_from is not None else None
+        storage_params = get_storage_params(config)
+        self._chats_storage = get_storage(
+            self._config.get("telegram_parser.storage_file", self.DEFAULT_TELEGRAM_FILE),
+            shard=shard,
+            **storage_params
+        )
+        with self._metrics.stage("queue.load"):
+            self._queue = LockedQueue(
+                logger=self._logger,
+                storage_file=config.get("toots_queue_storage.file", self.DEFAULT_QUEUE_FILE),
+                queue_item_object=QueueItem,
+                **storage_params
+            )
+        self._poll_scheduler = PollScheduler(config)
+        self._circuit_breaker = CircuitBreaker(config)
 
     def telegram_ok(self) -> None:
         self._telegram.get_me()
@@ -41,9 +88,7 @@ class TelegramParser:
     def initialize_client(self) -> TelegramClient:
         api_id = self._config.get("telegram_parser.api_id")
         api_hash = self._config.get("telegram_parser.api_hash")
-        session_name = self._config.get(
-            "telegram_parser.session_name", self._config.get("app.name", "echo bot")
-        )
+        session_name = self._get_session_name()
 
         self._logger.debug("Setting up Telegram Client, reusing if exists...")
         client = TelegramClient(
@@ -52,7 +97,12 @@ class TelegramParser:
         self._logger.debug("Done")
 
         return client
-    
+
+    def _get_session_name(self) -> str:
+        return self._config.get(
+            "telegram_parser.session_name", self._config.get("app.name", "echo bot")
+        )
+
     def parse(self) -> None:
         """
         The Telegram wrapper is reactive. You can't parse a list of messages but
@@ -66,9 +116,46 @@ class TelegramParser:
             self._logger.info("No Telegram conversations registered to parse, skipping,")
             return
 
+        # All the conversations go through the same session file,
+        #   that can't be opened by two processes, so they stay in one shard
+        if self._shard is not None and not self._shard.owns(self._get_session_name()):
+            self._logger.info(
+                f"Telegram conversations belong to another shard than {self._shard.name}," +
+                " skipping,"
+            )
+            return
+
+        # The queued posts whose streamed media expired wait for it to be downloaded again
+        expired_media = self._get_expired_streamed_media()
+
+        # Conversations that publish rarely don't need to be fetched in every run
+        due_chats = []
+        for chat in chats:
+            polling = self._chats_storage.get(f"polling_{abs(chat['id'])}", None)\
+                if "id" in chat else None
+            if self._poll_scheduler.is_due(polling):
+                due_chats.append(chat)
+            else:
+                self._logger.info(
+                    f"Conversation {chat.get('name', chat['id'])} not due until " +
+                    f"{polling['next_due_at']}, skipping"
+                )
+                self._metrics.increment("sources_not_due")
+        chats = due_chats
+
+        if not chats and not expired_media:
+            self._logger.info("No Telegram conversations due to parse, skipping,")
+            return
+
         # Initialize Client
         self._telegram = self.initialize_client()
 
+        if expired_media:
+            self.restore_streamed_media(expired_media)
+        if not chats:
+            self._logger.info("No Telegram conversations due to parse, skipping,")
+            return
+
         # We only need the chat IDs to then retrieve later the Entities.
         chat_ids = list(
             filter(bool, [abs(chat["id"]) if "id" in chat else False for chat in chats])
@@ -79,7 +166,9 @@ class TelegramParser:
             chats_params[str(abs(chat["id"]))] = chat
 
         # Get the entities that match with the given IDs.
-        self._logger.debug("Get matching entities from the current user's dialogs " + str(len(chat_ids)))
+        self._logger.debug(
+            "Get matching entities from the current user's dialogs " + str(len(chat_ids))
+        )
         entities = list(
             filter(
                 bool,
@@ -98,21 +187,31 @@ class TelegramParser:
             return
         self._logger.debug(logger_string)
 
-        # Now work with the messages for each entity
-        for entity in entities:
+        if self._budget is not None:
+            entities = self._budget.order("telegram", entities, lambda entity: entity.id)
 
-            # Shall we ignore the offsets?
-            ignore_offsets = self._config.get("telegram_parser.ignore_offsets", False)
+        # Now work with the messages for each entity
+        for position, entity in enumerate(entities):
+            if self._budget is not None and not self._budget.allows_source(
+                    "telegram", entities, position, lambda entity: entity.id):
+                break
+
+            # An entity that keeps failing is left alone for a while
+            circuit = self._chats_storage.get(f"circuit_{entity.id}", None)
+            if not self._circuit_breaker.is_allowed(circuit):
+                self._logger.info(
+                    f"{entity.title}: {self._circuit_breaker.describe(circuit)}, skipping"
+                )
+                self._metrics.count_source("telegram", entity.title)
+                self._metrics.set_circuit("telegram", entity.title, CircuitBreaker.OPEN)
+                self._metrics.increment("sources_circuit_open")
+                continue
 
             # We have to control what did we already see, to avoid duplicates
             seen_message_ids = list(self._chats_storage.get(f"entity_{entity.id}", []))
-
-            # Do we have defined a date to start from?
-            offset_date = self._config.get("telegram_parser.date_to_start_from", None)
-            offset_date = datetime.strptime(offset_date, self.DATE_FORMAT)
+            known_message_ids = set(seen_message_ids)
 
             # First we get all messages in queue.
-            # We must use the iter_messages to avoid using asyncs
             messages_to_post = []
             # Retrieving messages:
             #   reverse=True -> from oldest to newest, to keep the posting order
@@ -123,17 +222,33 @@ class TelegramParser:
                 f" {entity.title}{TerminalColor.END}"
             )
             discarded_messages = 0
-            for message in self._telegram.iter_messages(
+            new_messages_dates = []
+            fetch_start = time.perf_counter()
+            try:
+                messages = self._fetch_messages(
                     entity=entity,
-                    reverse=True,
+                    chat_params=chats_params[str(entity.id)],
                     offset_id=max(seen_message_ids)
-                    if seen_message_ids and not ignore_offsets else 0,
-                    offset_date=offset_date if not ignore_offsets else None):
+                    if seen_message_ids and not self._ignore_offsets else 0,
+                    offset_date=self._date_to_start_from if not self._ignore_offsets else None
+                )
+            except Exception as e:
+                # A broken entity must not stop the rest
+                self._record_failure(entity, circuit, e)
+                continue
+            finally:
+                self._metrics.add_stage_time(
+                    "telegram.fetch", time.perf_counter() - fetch_start
+                )
+            if circuit is not None:
+                self._metrics.set_circuit("telegram", entity.title, CircuitBreaker.CLOSED)
+            for message in messages:
                 # Theoreticaly we don't need to check again the seen message IDs, but...
-                if message.id in seen_message_ids and not ignore_offsets:
+                if message.id in known_message_ids and not self._ignore_offsets:
                     self._logger.debug(f"Discarding message: already seen {message.id}")
                     discarded_messages += 1
                     continue
+                new_messages_dates.append(message.date)
 
                 # We don't want anything older than 6 months
                 if datetime.now().replace(tzinfo=pytz.UTC) - relativedelta(
@@ -153,14 +268,29 @@ class TelegramParser:
                 messages_to_post.append(message)
 
                 # Remember this message
-                if message.id not in seen_message_ids:
+                if message.id not in known_message_ids:
                     seen_message_ids.append(message.id)
+                    known_message_ids.add(message.id)
 
             if discarded_messages > 0:
                 self._logger.info(f"Discarded {discarded_messages} messages")
+            self._metrics.count_source(
+                "telegram", entity.title, fetched=len(messages), discarded=discarded_messages
+            )
 
             # Store the new seen value. In the worst case it is the same as before.
             self._chats_storage.set(f"entity_{entity.id}", seen_message_ids)
+            self._chats_storage.set(
+                f"circuit_{entity.id}", self._circuit_breaker.record_success(circuit)
+            )
+            self._chats_storage.set(
+                f"polling_{entity.id}",
+                self._poll_scheduler.schedule(
+                    self._chats_storage.get(f"polling_{entity.id}", None),
+                    new_messages_dates,
+                    chats_params[str(entity.id)]
+                )
+            )
             self._chats_storage.write_file()
 
             if len(messages_to_post) > 0:
@@ -192,9 +322,45 @@ class TelegramParser:
                         entity=entity,
                         chat_params=chats_params[str(entity.id)]
                     )
+        else:
+            if self._budget is not None:
+                self._budget.finish("telegram")
 
         self._logger.debug(f"Finished processing entity {entity.title}")
 
+    def _fetch_messages(
+        self, entity, chat_params: dict, offset_id: int, offset_date: datetime
+    ) -> list:
+        """
+        The client runs in the event loop of this thread, so instead of
+            a thread the timeout cancels the fetch in the loop.
+        """
+        timeout = self._circuit_breaker.get_fetch_timeout(chat_params)
+
+        async def fetch() -> list:
+            return [
+                message async for message in self._telegram.iter_messages(
+                    entity=entity, reverse=True, offset_id=offset_id, offset_date=offset_date
+                )
+            ]
+
+        try:
+            return self._telegram.loop.run_until_complete(asyncio.wait_for(fetch(), timeout))
+        except asyncio.TimeoutError:
+            raise SourceTimeoutException(f"The fetch did not finish in {timeout} seconds")
+
+    def _record_failure(self, entity, circuit: dict, error: Exception) -> None:
+        self._logger.warning(
+            f"{TerminalColor.RED}Could not fetch the messages of {entity.title}: {error}" +
+            f"{TerminalColor.END}"
+        )
+        self._metrics.count_source("telegram", entity.title)
+        self._metrics.increment("source_failures")
+        circuit = self._circuit_breaker.record_failure(circuit, error)
+        self._metrics.set_circuit("telegram", entity.title, circuit["state"])
+        self._chats_storage.set(f"circuit_{entity.id}", circuit)
+        self._chats_storage.write_file()
+
     def group_messages(self, messages: list[TelegramMessage]) -> list[list]:
         groups = []
         current_group = []
@@ -250,15 +416,18 @@ class TelegramParser:
             self._logger.debug(f"Message {message.id} in group")
             # First of all download the possible media
             if message.file is not None:
-                file_name = str(message.file.media.id)\
-                 if message.file.name is None else message.file.name
-
-                filename = f"storage/media/{file_name}{message.file.ext}"
-                self._logger.debug(f"Downloading media to {filename}")
-                path = self._telegram.loop.run_until_complete(
-                    self._download_media(message=message, filename=filename)
-                )
-                media_stack.append({"path": path, "mime_type": message.file.mime_type})
+                streamed = self._stream_media_file(
+                    message=message, file_name=self._get_media_file_name(message)
+                ) if self._stream_media else None
+                if streamed is not None:
+                    media_stack.append(streamed)
+                else:
+                    media_stack.append(
+                        {
+                            "path": self._download_media_file(message),
+                            "mime_type": message.file.mime_type
+                        }
+                    )
 
             # Now add the text to the text stack
             if message.text is not None and len(message.text) > 0:
@@ -300,36 +469,39 @@ class TelegramParser:
             # Leave the remaining text
             text = text[self.MAX_STATUS_LENGTH:]
 
-            self._queue.append(
-                SimpleQueueItem(
-                    {
-                        "status": self._format_status(
-                            text=text_to_post,
-                            current_index=status_num,
-                            total=num_of_statuses,
-                            entity=entity,
-                            show_name=chat_params["show_name"]
-                            if "show_name" in chat_params and chat_params else False
-                        ),
-                        "media": media_to_post if media_to_post else None,
-                        "language": chat_params["language"] or "en_US",
-                        "published_at": copy.deepcopy(status_date),
-                        "action": "new",
-                        "group_id": identification
-                    }
-                )
-            )
+            item = {
+                "status": self._format_status(
+                    text=text_to_post,
+                    current_index=status_num,
+                    total=num_of_statuses,
+                    entity=entity,
+                    show_name=chat_params["show_name"]
+                    if "show_name" in chat_params and chat_params else False
+                ),
+                "media": media_to_post if media_to_post else None,
+                "language": chat_params["language"] or "en_US",
+                "published_at": copy.deepcopy(status_date),
+                "action": "new",
+                "group_id": identification
+            }
+            if media_to_post and all(["media_id" in media for media in media_to_post]):
+                # Already uploaded, the Publisher takes them as prefetched media
+                item["media_ids"] = [media["media_id"] for media in media_to_post]
+                item["media_uploaded_at"] = datetime.now(tz=pytz.UTC)
+            self._queue.append(QueueItem(item))
             queued_messages += 1
 
         self._logger.info(
             f"{TerminalColor.GREEN}Added {queued_messages} " +
             f"messages into the queue{TerminalColor.END}"
         )
+        self._metrics.count_source("telegram", entity.title, queued=queued_messages)
 
         # Update the toots queue, by adding the new ones at the end of the list
-        self._queue.sort(param="published_at")
-        self._queue.deduplicate(param="status")
-        self._queue.save()
+        with self._metrics.stage("queue.save"), self._queue.locked():
+            self._queue.sort(param="published_at")
+            self._queue.deduplicate(param="status")
+            self._queue.save()
 
     def _format_status(
         self, text: str, current_index: int, total: int, entity, show_name: bool
@@ -345,8 +517,161 @@ class TelegramParser:
 
         return result
 
-    async def _download_media(self, message: TelegramMessage, filename: str) -> None:
-        # Download the media. Returns the path where it finally got downloaded.
+    def _stream_media_file(self, message: TelegramMessage, file_name: str) -> dict:
+        """
+        Downloads the media into a buffer and uploads it from there, without
+            going through the media storage. The buffer is kept in memory and
+            only spills to a temporary file above the configured size.
+
+        Returns the media with its uploaded ID, or None to fall back to the disk.
+        """
+        mime_type = message.file.mime_type
+        try:
+            buffer = SpooledTemporaryFile(
+                max_size=self._stream_max_memory, dir=self._stream_spool_directory
+            )
+            with buffer:
+                with self._metrics.stage("media.download"):
+                    self._telegram.loop.run_until_complete(
+                        self._download_media(message=message, filename=buffer)
+                    )
+                size = buffer.tell()
+                buffer.seek(0)
+                with self._metrics.stage("media.upload"):
+                    uploaded = self._publisher.upload_media_stream(
+                        stream=buffer, mime_type=mime_type, file_name=file_name
+                    )
+        except Exception as e:
+            self._logger.warning(
+                f"{TerminalColor.RED}Could not stream {file_name}, " +
+                f"downloading it to disk: {e}{TerminalColor.END}"
+            )
+            return None
+
+        self._metrics.increment("media_streamed")
+        if size > self._stream_max_memory:
+            self._metrics.increment("media_streamed_spilled")
+        self._logger.debug(
+            "Streamed %s (%d bytes) as media %s", file_name, size, uploaded["id"]
+        )
+        # The message is kept to download it again if the ID expires before publishing
+        return {
+            "media_id": uploaded["id"],
+            "mime_type": mime_type,
+            "telegram_message": {
+                "chat_id": message.chat_id, "message_id": message.id
+            }
+        }
+
+    def _get_expired_streamed_media(self) -> list:
+        """
+        The streamed media of the queued posts whose uploaded IDs expired before
+            being published. Only the Telegram message they came from is left.
+        """
+        now = datetime.now(tz=pytz.UTC)
+        expired = []
+        for queue_item in self._queue.get_all():
+            item = queue_item.to_dict()
+            uploaded_at = item.get("media_uploaded_at", None)
+            if uploaded_at is not None\
+               and uploaded_at + timedelta(seconds=self._streamed_media_ttl) > now:
+                continue
+            expired += [
+                media for media in item.get("media", None) or []
+                if self._must_be_downloaded_again(media)
+            ]
+        return expired
+
+    def _must_be_downloaded_again(self, media: dict) -> bool:
+        message = media.get("telegram_message", None)
+        return message is not None and not message.get("unavailable", False)\
+            and not media.get("path", None) and not media.get("url", None)
+
+    def restore_streamed_media(self, expired_media: list) -> None:
+        """
+        Downloads again to the media storage the given streamed media, from
+            their Telegram messages, so the Publisher uploads them from there.
+            A message that is gone is marked as unavailable and its post goes
+            to the dead letters.
+
+        The downloads happen without the queue lock, the paths are applied
+            to a fresh copy of the queue afterwards.
+        """
+        self._logger.info(
+            f"{TerminalColor.YELLOW}Downloading again {len(expired_media)} streamed media " +
+            f"whose uploaded IDs expired{TerminalColor.END}"
+        )
+        paths = {}
+        for media in expired_media:
+            reference = self._get_message_reference(media)
+            if reference in paths:
+                continue
+            try:
+                message = self._telegram.get_messages(reference[0], ids=reference[1])
+            except Exception as e:
+                # It is tried again in the next run
+                self._logger.warning(
+                    f"{TerminalColor.RED}Could not get the message {reference[1]} " +
+                    f"of the chat {reference[0]}: {e}{TerminalColor.END}"
+                )
+                continue
+            paths[reference] = self._download_media_file(message)\
+                if message is not None and message.file is not None else None
+
+        restored_posts = 0
+        with self._metrics.stage("queue.save"), self._queue.locked():
+            for queue_item in self._queue.get_all():
+                item = queue_item.to_dict()
+                restored = [
+                    media for media in item.get("media", None) or []
+                    if self._must_be_downloaded_again(media) and
+                    self._get_message_reference(media) in paths
+                ]
+                for media in restored:
+                    path = paths[self._get_message_reference(media)]
+                    if path is None:
+                        media["telegram_message"]["unavailable"] = True
+                    else:
+                        media["path"] = path
+                if restored:
+                    # Published as soon as possible, uploading the files again
+                    item.pop("media_ids", None)
+                    item.pop("media_uploaded_at", None)
+                    item.pop("retry", None)
+                    restored_posts += 1
+            self._queue.save()
+
+        self._metrics.increment(
+            "media_restored", len([path for path in paths.values() if path])
+        )
+        self._logger.info(
+            f"{TerminalColor.GREEN}Restored the media of {restored_posts} posts" +
+            f"{TerminalColor.END}"
+        )
+
+    def _get_message_reference(self, media: dict) -> tuple:
+        message = media["telegram_message"]
+        return (message["chat_id"], message["message_id"])
+
+    def _get_media_file_name(self, message: TelegramMessage) -> str:
+        file_name = str(message.file.media.id)\
+            if message.file.name is None else message.file.name
+        return f"{file_name}{message.file.ext}"
+
+    def _download_media_file(self, message: TelegramMessage) -> str:
+        """
+        Downloads the media into the media storage and returns its path
+        """
+        filename = f"storage/media/{self._get_media_file_name(message)}"
+        self._logger.debug(f"Downloading media to {filename}")
+        with self._metrics.stage("media.download"):
+            return self._telegram.loop.run_until_complete(
+                self._download_media(message=message, filename=filename)
+            )
+
+    async def _download_media(self, message: TelegramMessage, filename: any) -> None:
+        # Download the media. Returns the path where it finally got downloaded,
+        #   or the given file object when downloading into a buffer.
         path = await self._telegram.download_media(message=message, file=filename)
         self._logger.debug(f"File {filename} has been downloaded")
         return path
@@ -0,0 +1,212 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from pyxavi.queue_stack import Queue
+from echobot.lib.queue_item import QueueItem
+from pyxavi.mastodon_publisher import MastodonPublisherException
+from echobot.bench.fake_mastodon import FakeMastodonServer
+from echobot.bench.fixtures import FixtureGenerator
+from echobot.bench.measure import Measure
+from echobot.runners.echo import Echo
+from echobot.runners.runner_protocol import RunnerProtocol
+import tempfile
+import logging
+import base64
+import time
+import os
+
+# The smallest valid PNG, to have some media to upload
+PIXEL_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9aw" +
+    "AAAABJRU5ErkJggg=="
+)
+
+
+class BenchE2E(RunnerProtocol):
+    '''
+    Runner that drives full Echo runs against a local fake Mastodon API
+
+    Reports the published items per second and the publishing latency percentiles,
+    under the latency, error rate and rate limit set in the config.
+    '''
+
+    DEFAULT_RUNS = 3
+    DEFAULT_ACCOUNTS = 5
+    DEFAULT_STATUSES_PER_ACCOUNT = 20
+    DEFAULT_NEW_POSTS_PER_RUN = 20
+    DEFAULT_LATENCY_MS = 50
+    DEFAULT_LATENCY_JITTER_MS = 20
+    DEFAULT_ERROR_RATE = 0.0
+    DEFAULT_RATE_LIMIT = 300
+    DEFAULT_RATE_LIMIT_WINDOW = 300
+    DEFAULT_RETRY_SLEEP = 0
+    DEFAULT_SEED = 42
+    PERCENTILES = [50, 90, 99]
+
+    def __init__(
+        self, config: Config = None, logger: logging = None, params: dict = None
+    ) -> None:
+        self._config = config
+        self._logger = logger
+        self._runs = config.get("bench.e2e.runs", self.DEFAULT_RUNS)
+        self._num_accounts = config.get("bench.e2e.accounts", self.DEFAULT_ACCOUNTS)
+        self._new_posts = config.get(
+            "bench.e2e.new_posts_per_run", self.DEFAULT_NEW_POSTS_PER_RUN
+        )
+        self._retry_sleep = config.get("bench.e2e.retry_sleep", self.DEFAULT_RETRY_SLEEP)
+        self._seed = config.get("bench.seed", self.DEFAULT_SEED)
+        latency_ms = config.get("bench.e2e.latency_ms", self.DEFAULT_LATENCY_MS)
+        jitter_ms = config.get("bench.e2e.latency_jitter_ms", self.DEFAULT_LATENCY_JITTER_MS)
+        self._server = FakeMastodonServer(
+            latency=latency_ms / 1000,
+            latency_jitter=jitter_ms / 1000,
+            error_rate=config.get("bench.e2e.error_rate", self.DEFAULT_ERROR_RATE),
+            rate_limit=config.get("bench.e2e.rate_limit", self.DEFAULT_RATE_LIMIT),
+            rate_limit_window=config.get(
+                "bench.e2e.rate_limit_window", self.DEFAULT_RATE_LIMIT_WINDOW
+            ),
+            statuses_per_account=config.get(
+                "bench.e2e.statuses_per_account", self.DEFAULT_STATUSES_PER_ACCOUNT
+            ),
+            seed=self._seed
+        )
+
+    def run(self):
+        base_url = self._server.start()
+        try:
+            self._logger.info(
+                f"{TerminalColor.MAGENTA}End to end benchmark against {base_url}" +
+                f"{TerminalColor.END}"
+            )
+            with tempfile.TemporaryDirectory() as workdir:
+                config = self._get_bench_config(workdir, base_url)
+                fixtures = FixtureGenerator(self._seed)
+                latencies = []
+                failed_runs = 0
+                elapsed = 0
+                for run_index in range(self._runs):
+                    self._enqueue_new_posts(config, workdir, fixtures)
+                    echo = Echo(config=config, logger=self._logger)
+                    echo._publisher.SLEEP_TIME = self._retry_sleep
+                    echo._publisher._execute_action = self._timed(
+                        echo._publisher._execute_action, latencies
+                    )
+
+                    start = time.perf_counter()
+                    try:
+                        echo.run()
+                    except MastodonPublisherException as e:
+                        failed_runs += 1
+                        self._logger.warning(f"Run {run_index + 1} failed: {e}")
+                    elapsed += time.perf_counter() - start
+
+                self.report(latencies, elapsed, failed_runs)
+        except Exception as e:
+            self._logger.exception(e)
+        finally:
+            self._server.stop()
+
+    def _get_bench_config(self, workdir: str, base_url: str) -> Config:
+        client_file = os.path.join(workdir, "client.secret")
+        user_file = os.path.join(workdir, "user.secret")
+        with open(client_file, "w") as handle:
+            handle.write(f"fake_client_id\nfake_client_secret\n{base_url}\n")
+        with open(user_file, "w") as handle:
+            handle.write(f"fake_access_token\n{base_url}\n")
+        media_storage = os.path.join(workdir, "media")
+        os.makedirs(media_storage, exist_ok=True)
+        media_prefetch = self._config.get("publisher.media_prefetch", {"active": True})
+        pipeline = self._config.get("pipeline", {"active": False})
+
+        return Config(
+            params={
+                "logger": self._config.get("logger"),
+                "app": {
+                    "name": "Echo bench",
+                    "api_base_url": base_url,
+                    "instance_type": "mastodon",
+                    "client_credentials": client_file,
+                    "user_credentials": user_file,
+                },
+                "toots_queue_storage": {
+                    "file": os.path.join(workdir, "queue.yaml")
+                },
+                "publisher": {
+                    "media_storage": media_storage,
+                    "dry_run": False,
+                    "only_older_toot": False,
+                    "media_prefetch": media_prefetch,
+                    "dead_letter_file": os.path.join(workdir, "dead_letter.yaml"),
+                    "identity_file": os.path.join(workdir, "identity.yaml")
+                },
+                "pipeline": pipeline,
+                "metrics": {
+                    "directory": os.path.join(workdir, "metrics")
+                },
+                "locks": {
+                    "run_lock_file": os.path.join(workdir, "run.lock")
+                },
+                "mastodon_parser": {
+                    "storage_file": os.path.join(workdir, "accounts.yaml"),
+                    "only_public_visibility": True,
+                    "accounts": [
+                        {
+                            "user": f"@account{index}@fake.local",
+                            "toots": True,
+                            "retoots": True,
+                            "auto_follow": True
+                        } for index in range(self._num_accounts)
+                    ]
+                },
+            }
+        )
+
+    def _enqueue_new_posts(self, config: Config, workdir: str, fixtures: FixtureGenerator):
+        queue = Queue(
+            storage_file=config.get("toots_queue_storage.file"), queue_item_object=QueueItem
+        )
+        for index in range(self._new_posts):
+            item = fixtures.queue_items(1)[0]
+            # One of every two posts bring an image
+            if index % 2 == 0:
+                media_file = os.path.join(workdir, "media", f"{time.time_ns()}.png")
+                with open(media_file, "wb") as handle:
+                    handle.write(PIXEL_PNG)
+                item["media"] = [{"path": media_file, "mime_type": "image/png"}]
+            queue.append(QueueItem(item))
+        queue.sort(param="published_at")
+        queue.save()
+
+    def _timed(self, function: callable, latencies: list) -> callable:
+
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+        return timed_function
+
+    def report(self, latencies: list, elapsed: float, failed_runs: int) -> None:
+        stats = self._server.get_stats()
+        published = stats["statuses"] + stats["reblogs"]
+        self._logger.info(
+            f"{TerminalColor.GREEN}Published {published} items in {self._runs} runs" +
+            f" ({failed_runs} failed) in {elapsed:.2f}s:" +
+            f" {published / elapsed if elapsed > 0 else 0:.2f} items/s{TerminalColor.END}"
+        )
+        self._logger.info(
+            "Publish latency: " + ", ".join(
+                [
+                    f"p{percent}={(Measure.percentile(latencies, percent) or 0) * 1000:.1f}ms"
+                    for percent in self.PERCENTILES
+                ]
+            )
+        )
+        self._logger.info(
+            f"Server got {stats['requests']} requests, {stats['errors_injected']} errors" +
+            f" injected and {stats['rate_limited']} rate limited." +
+            f" {stats['media']} media uploaded and {stats['follows']} follows"
+        )
+        for endpoint, count in sorted(stats["requests_by_endpoint"].items()):
+            self._logger.debug(f"  {endpoint:<40} {count}")
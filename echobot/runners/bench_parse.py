@@ -0,0 +1,382 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from pyxavi.queue_stack import Queue, SimpleQueueItem
+from echobot.bench.fixtures import FixtureGenerator
+from echobot.bench.measure import Measure, BenchResults
+from echobot.lib.locked_storage import LockedQueue, get_storage, get_storage_params
+from echobot.lib.queue_item import QueueItem
+from echobot.lib.run_metrics import RunMetrics
+from echobot.lib.serializer import Serializer
+from echobot.parsers.feed_parser import FeedParser
+from echobot.parsers.keywords_filter import KeywordsFilter
+from echobot.parsers.telegram_parser import TelegramParser
+from echobot.runners.runner_protocol import RunnerProtocol
+from definitions import ROOT_DIR
+import tempfile
+import logging
+import sys
+import os
+
+
+class BenchParse(RunnerProtocol):
+    '''
+    Runner that benchmarks the parse pipeline stages with synthetic fixtures
+
+    Results are compared against a stored baseline so that regressions
+    can be spotted between commits. A stage that fails or regresses makes
+    the command exit with a non-zero status, so it can gate a CI job.
+    '''
+
+    DEFAULT_SIZES = [10, 1000, 10000]
+    DEFAULT_KEYWORDS_SIZES = [10, 100, 500]
+    DEFAULT_SEED = 42
+    DEFAULT_THRESHOLD = 1.25
+    DEFAULT_MIN_SECONDS = 0.01
+    DEFAULT_MIN_MEMORY_KB = 1024
+    DEFAULT_RESULTS_DIR = "storage/bench"
+    LARGE_HTML_ENTRIES = 100
+    LARGE_HTML_SIZE = 50000
+    TEXTS_TO_FILTER = 1000
+
+    def __init__(
+        self, config: Config = None, logger: logging = None, params: dict = None
+    ) -> None:
+        self._config = config
+        self._logger = logger
+        self._params = params if params is not None else {}
+        self._sizes = config.get("bench.sizes", self.DEFAULT_SIZES)
+        self._keywords_sizes = config.get("bench.keywords_sizes", self.DEFAULT_KEYWORDS_SIZES)
+        self._seed = config.get("bench.seed", self.DEFAULT_SEED)
+        self._threshold = config.get("bench.regression_threshold", self.DEFAULT_THRESHOLD)
+        self._min_seconds = config.get("bench.regression_min_seconds", self.DEFAULT_MIN_SECONDS)
+        self._min_bytes = config.get(
+            "bench.regression_min_memory_kb", self.DEFAULT_MIN_MEMORY_KB
+        ) * 1024
+        self._results_dir = os.path.join(
+            ROOT_DIR, config.get("bench.results_dir", self.DEFAULT_RESULTS_DIR)
+        )
+
+    def run(self):
+        failed = False
+        try:
+            self._logger.info(
+                f"{TerminalColor.MAGENTA}Benchmarking the parse pipeline{TerminalColor.END}"
+            )
+            results = BenchResults()
+            with tempfile.TemporaryDirectory() as workdir:
+                for size in self._sizes:
+                    results.append(self.bench_feed_parser(workdir, size, 500))
+                    results.append(self.bench_feed_parser(workdir, size, 500, incremental=True))
+                # The usual case: the feed was already read in a previous run
+                for incremental in [False, True]:
+                    results.append(
+                        self.bench_feed_parser(
+                            workdir, max(self._sizes), 500, incremental, already_seen=True
+                        )
+                    )
+                results.append(
+                    self.bench_feed_parser(
+                        workdir, self.LARGE_HTML_ENTRIES, self.LARGE_HTML_SIZE
+                    )
+                )
+                for size in self._keywords_sizes:
+                    results.append(self.bench_keywords_filter(workdir, size))
+                for size in self._sizes:
+                    results.append(self.bench_telegram_grouping(workdir, size))
+                    results.append(self.bench_queue(workdir, size))
+                for format in Serializer.get_available_formats():
+                    for size in self._sizes:
+                        for result in self.bench_serializer(workdir, size, format):
+                            results.append(result)
+
+            failed = self.report(results) > 0
+        except Exception as e:
+            self._logger.exception(e)
+            failed = True
+
+        if failed:
+            sys.exit(1)
+
+    def _get_stage_config(self, workdir: str, name: str, params: dict = None) -> Config:
+        """
+        A config isolated in the working directory, with a quiet logger
+        """
+        return Config(
+            params={
+                **{
+                    "logger": {
+                        "name": "echobot_bench"
+                    },
+                    "toots_queue_storage": {
+                        "file": os.path.join(workdir, f"{name}_queue.yaml")
+                    },
+                },
+                **(params if params is not None else {})
+            }
+        )
+
+    def bench_feed_parser(
+        self,
+        workdir: str,
+        num_entries: int,
+        summary_size: int,
+        incremental: bool = False,
+        already_seen: bool = False
+    ) -> dict:
+        name = f"feed_parser.entries_{num_entries}.summary_{summary_size}" +\
+            (".incremental" if incremental else "") + (".already_seen" if already_seen else "")
+        fixtures = FixtureGenerator(self._seed)
+        feed_file = os.path.join(workdir, f"{name}.xml")
+        feed = fixtures.feed(num_entries, summary_size)
+        keywords = fixtures.keywords(50)
+        measured = {}
+
+        def prepare():
+            # Start every pass with no seen URLs and an empty queue
+            self._remove_files(workdir, name)
+            config = self._get_stage_config(
+                workdir,
+                name,
+                {
+                    "feed_parser": {
+                        "storage_file": os.path.join(workdir, f"{name}_feeds.yaml"),
+                        "sites": [
+                            {
+                                "name": "Benchmark",
+                                "url": feed_file,
+                                "language_default": "ca_ES",
+                                "keywords_filter_profile": "bench",
+                                "show_name": True
+                            }
+                        ],
+                        "incremental": {
+                            "active": incremental
+                        }
+                    },
+                    "keywords_filter": {
+                        "profiles": {
+                            "bench": {
+                                "keywords": keywords
+                            }
+                        }
+                    }
+                }
+            )
+            if already_seen:
+                # The previous run saw all but the newest entry. The body changes
+                #   in between, so the seen URLs are checked instead of the digest
+                newest_entry_end = feed.index("</item>") + len("</item>")
+                self._write_file(
+                    feed_file, feed[:feed.index("<item>")] + feed[newest_entry_end:]
+                )
+                FeedParser(config).parse()
+            self._write_file(feed_file, feed)
+            measured["config"] = config
+            measured["metrics"] = RunMetrics(config)
+            return FeedParser(config, metrics=measured["metrics"]).parse
+
+        result = Measure.run(name, prepare, num_entries)
+        self._check_feed_parser(
+            name, measured["config"], measured["metrics"], feed_file, num_entries, already_seen
+        )
+        return result
+
+    def _check_feed_parser(
+        self,
+        name: str,
+        config: Config,
+        metrics: RunMetrics,
+        feed_file: str,
+        num_entries: int,
+        already_seen: bool
+    ) -> None:
+        """
+        Fails the bench when the measured pass did not do the work, as a
+            parser that breaks early would look faster than ever.
+        """
+        summary = metrics.to_dict()
+        if summary["counters"].get("source_failures", 0) > 0:
+            raise RuntimeError(f"Stage {name} failed: the parser could not read the feed")
+
+        storage_params = get_storage_params(config)
+        feeds_storage = get_storage(config.get("feed_parser.storage_file"), **storage_params)
+        site_data = feeds_storage.get_hashed(feed_file, None) or {}
+        urls_seen = len(site_data.get("urls_seen", None) or [])
+        if urls_seen != num_entries:
+            raise RuntimeError(
+                f"Stage {name} failed: {urls_seen} URLs seen of {num_entries} entries"
+            )
+
+        # A feed seen already queues at most its new entry, a new one what the filter allows
+        queued = sum([source["queued"] for source in summary["sources"]])
+        if already_seen:
+            if summary["counters"].get("feeds_unchanged", 0) > 0:
+                raise RuntimeError(
+                    f"Stage {name} failed: the changed feed was taken as unchanged"
+                )
+            if queued > 1:
+                raise RuntimeError(f"Stage {name} failed: {queued} items queued again")
+            return
+
+        queue_length = LockedQueue(
+            logger=self._logger,
+            storage_file=config.get("toots_queue_storage.file"),
+            queue_item_object=QueueItem,
+            **storage_params
+        ).length()
+        if queued == 0 or queue_length != queued:
+            raise RuntimeError(
+                f"Stage {name} failed: {queued} items reported as queued," +
+                f" {queue_length} in the queue"
+            )
+
+    def bench_keywords_filter(self, workdir: str, num_keywords: int) -> dict:
+        name = f"keywords_filter.keywords_{num_keywords}"
+        fixtures = FixtureGenerator(self._seed)
+        config = self._get_stage_config(
+            workdir,
+            name,
+            {
+                "keywords_filter": {
+                    "profiles": {
+                        "bench": {
+                            "keywords": fixtures.keywords(num_keywords)
+                        }
+                    }
+                }
+            }
+        )
+        texts = [fixtures.html(1000) for _ in range(self.TEXTS_TO_FILTER)]
+
+        def prepare():
+            keywords_filter = KeywordsFilter(config)
+
+            def filter_texts():
+                for text in texts:
+                    keywords_filter.profile_allows_text("bench", text)
+
+            return filter_texts
+
+        return Measure.run(name, prepare, len(texts))
+
+    def bench_telegram_grouping(self, workdir: str, num_messages: int) -> dict:
+        name = f"telegram_parser.group_messages_{num_messages}"
+        config = self._get_stage_config(
+            workdir,
+            name, {
+                "telegram_parser": {
+                    "storage_file": os.path.join(workdir, f"{name}_telegram.yaml")
+                }
+            }
+        )
+        telegram_parser = TelegramParser(config)
+        messages = FixtureGenerator(self._seed).telegram_messages(num_messages)
+
+        def prepare():
+            return lambda: telegram_parser.group_messages(messages=messages)
+
+        return Measure.run(name, prepare, num_messages)
+
+    def bench_queue(self, workdir: str, num_items: int) -> dict:
+        name = f"queue.load_sort_deduplicate_save_{num_items}"
+        queue_file = os.path.join(workdir, f"{name}.yaml")
+        items = FixtureGenerator(self._seed).queue_items(num_items)
+
+        def prepare():
+            queue = Queue(storage_file=queue_file)
+            queue.clean()
+            for item in items:
+                queue.append(SimpleQueueItem(item))
+            queue.save()
+
+            def queue_cycle():
+                cycled_queue = Queue(storage_file=queue_file)
+                cycled_queue.sort(param="published_at")
+                cycled_queue.deduplicate(param="status")
+                cycled_queue.save()
+
+            return queue_cycle
+
+        return Measure.run(name, prepare, num_items)
+
+    def bench_serializer(self, workdir: str, num_items: int, format: str) -> list:
+        name = f"serializer.{format}"
+        queue_file = os.path.join(workdir, f"{name}_queue_{num_items}")
+        content = {"queue": FixtureGenerator(self._seed).queue_items(num_items)}
+        serializer = Serializer(format)
+        serializer.write_file(queue_file, content)
+        self._logger.info(
+            f"A queue of {num_items} items is {os.path.getsize(queue_file)} bytes in {format}"
+        )
+
+        return [
+            Measure.run(
+                f"{name}.load_queue_{num_items}",
+                lambda: lambda: serializer.load_file(queue_file),
+                num_items
+            ),
+            Measure.run(
+                f"{name}.save_queue_{num_items}",
+                lambda: lambda: serializer.write_file(queue_file, content),
+                num_items
+            )
+        ]
+
+    def _write_file(self, filename: str, content: str) -> None:
+        with open(filename, "w") as handle:
+            handle.write(content)
+
+    def _remove_files(self, workdir: str, name: str) -> None:
+        for suffix in ["_feeds.yaml", "_queue.yaml"]:
+            filename = os.path.join(workdir, f"{name}{suffix}")
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def report(self, results: BenchResults) -> int:
+        """
+        Logs the results and compares them with the baseline.
+
+        Returns the amount of stages that regressed.
+        """
+        for result in results.results:
+            self._logger.info(
+                f"{result['name']:<60} {result['seconds']:>10.4f}s " +
+                f"{result['items_per_second'] or 0:>12.1f} items/s " +
+                f"{result['peak_memory_bytes'] / 1024 / 1024:>8.2f} MB peak"
+            )
+
+        results.save(os.path.join(self._results_dir, "last.json"))
+        baseline_file = os.path.join(self._results_dir, "baseline.json")
+        if self._params.get("save_baseline", False):
+            results.save(baseline_file)
+            self._logger.info(
+                f"{TerminalColor.GREEN}Baseline saved to {baseline_file}{TerminalColor.END}"
+            )
+            return 0
+
+        baseline = BenchResults.load(baseline_file)
+        if baseline is None:
+            self._logger.info("No baseline to compare with. Save one with --save-baseline")
+            return 0
+
+        self._logger.info(
+            f"Comparing with the baseline from commit {baseline.metadata['commit']}" +
+            f" at {baseline.metadata['date']}"
+        )
+        comparisons = results.compare(
+            baseline, self._threshold, self._min_seconds, self._min_bytes
+        )
+        regressions = 0
+        for comparison in comparisons:
+            color = TerminalColor.RED if comparison["is_regression"] else TerminalColor.END
+            regressions += 1 if comparison["is_regression"] else 0
+            self._logger.info(
+                f"{color}{comparison['name']:<60} time x{comparison['time_ratio'] or 0:.2f}" +
+                f" memory x{comparison['memory_ratio'] or 0:.2f}{TerminalColor.END}"
+            )
+        if regressions > 0:
+            self._logger.warning(
+                f"{TerminalColor.RED_BRIGHT}{regressions} stages regressed more than" +
+                f" x{self._threshold}{TerminalColor.END}"
+            )
+        return regressions
@@ -0,0 +1,132 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from echobot.bench.measure import Measure, BenchResults
+from echobot.runners.runner_protocol import RunnerProtocol
+from definitions import ROOT_DIR
+import subprocess
+import logging
+import time
+import sys
+import os
+
+
+class BenchStartup(RunnerProtocol):
+    '''
+    Runner that measures how long the CLI takes to start
+
+    Every case runs in a fresh interpreter, as cron does: the commands list
+    and the import of every runner as it is dispatched. The median time and
+    the peak memory are compared against a stored baseline, so a runner
+    that starts importing heavy dependencies at load shows up as a regression.
+    '''
+
+    DEFAULT_REPEAT = 5
+    DEFAULT_THRESHOLD = 1.25
+    DEFAULT_RESULTS_DIR = "storage/bench"
+    # Printed by the child to stderr, in KB in Linux and in bytes in macOS
+    PEAK_MEMORY_CODE = "import resource, sys\n" +\
+        "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, file=sys.stderr)\n"
+    COMMANDS_CODE = "import runner, sys\n" +\
+        "sys.argv = ['runner.py', 'commands']\n" +\
+        "try:\n" +\
+        "    runner.run()\n" +\
+        "except SystemExit:\n" +\
+        "    pass\n"
+
+    def __init__(
+        self, config: Config = None, logger: logging = None, params: dict = None
+    ) -> None:
+        self._config = config
+        self._logger = logger
+        self._params = params if params is not None else {}
+        self._repeat = config.get("bench.startup.repeat", self.DEFAULT_REPEAT)
+        self._threshold = config.get("bench.regression_threshold", self.DEFAULT_THRESHOLD)
+        self._results_dir = os.path.join(
+            ROOT_DIR, config.get("bench.results_dir", self.DEFAULT_RESULTS_DIR), "startup"
+        )
+
+    def run(self):
+        try:
+            # Not at load: runner.py is the CLI itself, already loaded when dispatching here
+            from runner import get_runner_paths
+
+            self._logger.info(
+                f"{TerminalColor.MAGENTA}Benchmarking the startup, {self._repeat} times" +
+                f" every case{TerminalColor.END}"
+            )
+            results = BenchResults()
+            results.append(self.bench_code("startup.commands", self.COMMANDS_CODE))
+            for command, import_path in get_runner_paths().items():
+                results.append(
+                    self.bench_code(
+                        f"startup.{command.replace(' ', '.')}",
+                        f"import runner\nrunner.load_runner({import_path!r})\n"
+                    )
+                )
+
+            self.report(results)
+        except Exception as e:
+            self._logger.exception(e)
+
+    def bench_code(self, name: str, code: str) -> dict:
+        times = []
+        peak = 0
+        for _ in range(self._repeat):
+            start = time.perf_counter()
+            process = subprocess.run(
+                [sys.executable, "-c", code + self.PEAK_MEMORY_CODE],
+                cwd=ROOT_DIR,
+                capture_output=True,
+                text=True
+            )
+            times.append(time.perf_counter() - start)
+            if process.returncode != 0:
+                raise RuntimeError(f"{name} failed to start: {process.stderr.strip()}")
+            peak = max(peak, int(process.stderr.strip().splitlines()[-1]))
+
+        return {
+            "name": name,
+            "items": 1,
+            "seconds": round(Measure.percentile(times, 50), 6),
+            "items_per_second": None,
+            "peak_memory_bytes": peak * (1 if sys.platform == "darwin" else 1024)
+        }
+
+    def report(self, results: BenchResults) -> None:
+        for result in results.results:
+            self._logger.info(
+                f"{result['name']:<40} {result['seconds']:>10.4f}s " +
+                f"{result['peak_memory_bytes'] / 1024 / 1024:>8.2f} MB peak"
+            )
+
+        results.save(os.path.join(self._results_dir, "last.json"))
+        baseline_file = os.path.join(self._results_dir, "baseline.json")
+        if self._params.get("save_baseline", False):
+            results.save(baseline_file)
+            self._logger.info(
+                f"{TerminalColor.GREEN}Baseline saved to {baseline_file}{TerminalColor.END}"
+            )
+            return
+
+        baseline = BenchResults.load(baseline_file)
+        if baseline is None:
+            self._logger.info("No baseline to compare with. Save one with --save-baseline")
+            return
+
+        self._logger.info(
+            f"Comparing with the baseline from commit {baseline.metadata['commit']}" +
+            f" at {baseline.metadata['date']}"
+        )
+        regressions = 0
+        for comparison in results.compare(baseline, self._threshold):
+            color = TerminalColor.RED if comparison["is_regression"] else TerminalColor.END
+            regressions += 1 if comparison["is_regression"] else 0
+            self._logger.info(
+                f"{color}{comparison['name']:<40} time x{comparison['time_ratio'] or 0:.2f}" +
+                f" memory x{comparison['memory_ratio'] or 0:.2f}{TerminalColor.END}"
+            )
+        if regressions > 0:
+            self._logger.warning(
+                f"{TerminalColor.RED_BRIGHT}{regressions} commands start more than" +
+                f" x{self._threshold} slower or bigger{TerminalColor.END}"
+            )
@@ -0,0 +1,162 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from pyxavi.queue_stack import Queue
+from echobot.lib.queue_item import QueueItem
+from echobot.lib.websub import WebSubSubscriber
+from echobot.lib.run_metrics import RunMetrics
+from echobot.bench.fake_websub_hub import FakeWebSubHub
+from echobot.bench.measure import Measure
+from echobot.parsers.feed_parser import FeedParser
+from echobot.runners.runner_protocol import RunnerProtocol
+from email.utils import format_datetime
+from datetime import datetime, timedelta
+import tempfile
+import logging
+import pytz
+import time
+import os
+
+
+class BenchWebSub(RunnerProtocol):
+    '''
+    Runner that subscribes the feeds to a local fake WebSub hub and pushes to them
+
+    Reports the verified subscriptions, the latency from a push to its entries
+    being in the queue, and checks that the pushed sites are not polled.
+    '''
+
+    DEFAULT_SITES = 5
+    DEFAULT_PUSHES_PER_SITE = 10
+    PERCENTILES = [50, 90, 99]
+
+    def __init__(
+        self, config: Config = None, logger: logging = None, params: dict = None
+    ) -> None:
+        self._config = config
+        self._logger = logger
+        self._num_sites = config.get("bench.websub.sites", self.DEFAULT_SITES)
+        self._pushes = config.get("bench.websub.pushes_per_site", self.DEFAULT_PUSHES_PER_SITE)
+        self._hub = FakeWebSubHub()
+
+    def run(self):
+        hub_url = self._hub.start()
+        subscriber = None
+        try:
+            self._logger.info(
+                f"{TerminalColor.MAGENTA}WebSub benchmark against a fake hub at {hub_url}" +
+                f"{TerminalColor.END}"
+            )
+            with tempfile.TemporaryDirectory() as workdir:
+                config = self._get_bench_config(workdir, hub_url)
+                for index in range(self._num_sites):
+                    self._write_feed(workdir, hub_url, index, 1)
+
+                subscriber = WebSubSubscriber(config)
+                subscriber.start()
+                requested = subscriber.subscribe_due()
+                verified = self._hub.wait_for_subscriptions(self._num_sites)
+                self._logger.info(
+                    f"Requested {requested} subscriptions, {verified} got verified"
+                )
+
+                latencies = []
+                failed_pushes = 0
+                for round_index in range(self._pushes):
+                    for index in range(self._num_sites):
+                        content = self._write_feed(workdir, hub_url, index, round_index + 2)
+                        start = time.perf_counter()
+                        status_codes = self._hub.publish(
+                            self._get_topic(hub_url, index), content
+                        )
+                        latencies.append(time.perf_counter() - start)
+                        failed_pushes += len([code for code in status_codes if code != 200])
+
+                # Now a regular run, which should not poll the pushed sites
+                metrics = RunMetrics(config)
+                FeedParser(config, metrics=metrics).parse()
+                skipped = metrics.counters.get("sources_not_due", 0)
+                queued = Queue(
+                    storage_file=config.get("toots_queue_storage.file"),
+                    queue_item_object=QueueItem
+                ).length()
+
+                self.report(latencies, failed_pushes, queued, skipped)
+        except Exception as e:
+            self._logger.exception(e)
+        finally:
+            if subscriber is not None:
+                subscriber.stop()
+            self._hub.stop()
+
+    def _get_bench_config(self, workdir: str, hub_url: str) -> Config:
+        return Config(
+            params={
+                "logger": self._config.get("logger"),
+                "toots_queue_storage": {
+                    "file": os.path.join(workdir, "queue.yaml")
+                },
+                "metrics": {
+                    "directory": os.path.join(workdir, "metrics")
+                },
+                "websub": {
+                    "active": True, "host": "127.0.0.1", "port": 0
+                },
+                "feed_parser": {
+                    "storage_file": os.path.join(workdir, "feeds.yaml"),
+                    "sites": [
+                        {
+                            "name": f"Site {index}",
+                            "url": os.path.join(workdir, f"feed{index}.xml"),
+                            "language_default": "en_US",
+                        } for index in range(self._num_sites)
+                    ]
+                },
+            }
+        )
+
+    def _get_topic(self, hub_url: str, index: int) -> str:
+        return f"{hub_url}/topics/feed{index}.xml"
+
+    def _write_feed(self, workdir: str, hub_url: str, index: int, entries: int) -> bytes:
+        now = datetime.now(tz=pytz.UTC)
+        items = "".join(
+            [
+                f"<item><title>Post {entry} of site {index}</title>" +
+                f"<link>https://site{index}.local/posts/{entry}</link>" +
+                f"<description>Content of the post {entry}</description>" +
+                f"<pubDate>{format_datetime(now - timedelta(minutes=entries - entry))}" +
+                "</pubDate></item>" for entry in range(entries, 0, -1)
+            ]
+        )
+        content = (
+            '<?xml version="1.0" encoding="UTF-8"?>' +
+            '<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom"><channel>' +
+            f'<title>Site {index}</title><link>https://site{index}.local/</link>' +
+            f'<atom:link rel="hub" href="{hub_url}/"/>' +
+            f'<atom:link rel="self" href="{self._get_topic(hub_url, index)}"/>' +
+            f'{items}</channel></rss>'
+        ).encode()
+        with open(os.path.join(workdir, f"feed{index}.xml"), "wb") as handle:
+            handle.write(content)
+        return content
+
+    def report(self, latencies: list, failed_pushes: int, queued: int, skipped: int) -> None:
+        expected = self._num_sites * (self._pushes + 1)
+        color = TerminalColor.GREEN if queued == expected and failed_pushes == 0\
+            else TerminalColor.RED
+        self._logger.info(
+            f"{color}Delivered {len(self._hub.deliveries)} pushes ({failed_pushes} failed)," +
+            f" {queued} of the {expected} expected posts are queued{TerminalColor.END}"
+        )
+        self._logger.info(
+            "Push to queue latency: " + ", ".join(
+                [
+                    f"p{percent}={(Measure.percentile(latencies, percent) or 0) * 1000:.1f}ms"
+                    for percent in self.PERCENTILES
+                ]
+            )
+        )
+        self._logger.info(
+            f"The following regular run skipped {skipped} of {self._num_sites}" +
+            " pushed sites instead of polling them"
+        )
@@ -0,0 +1,54 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from echobot.lib.dead_letter import DeadLetterQueue
+from echobot.runners.runner_protocol import RunnerProtocol
+from definitions import ROOT_DIR
+import logging
+
+
+class DeadLetterInspect(RunnerProtocol):
+    '''
+    Runner that lists the posts that could not be published, and why
+    '''
+
+    MAX_STATUS_LENGTH = 60
+
+    def __init__(
+        self, config: Config = None, logger: logging = None, params: dict = None
+    ) -> None:
+        self._config = config
+        self._logger = logger
+
+    def run(self):
+        try:
+            dead_letters = DeadLetterQueue(config=self._config, base_path=ROOT_DIR).get_all()
+            if not dead_letters:
+                self._logger.info("There are no dead letters")
+                return
+
+            self._logger.info(
+                f"{TerminalColor.MAGENTA}{len(dead_letters)} posts could not be published" +
+                f"{TerminalColor.END}"
+            )
+            for position, item in enumerate(dead_letters, start=1):
+                dead_letter = item.get("dead_letter", None) or {}
+                self._logger.info(
+                    f"{TerminalColor.CYAN}#{position}{TerminalColor.END} " +
+                    f"{item.get('action', None)} {self._describe(item)}, published at" +
+                    f" {item.get('published_at', None)}"
+                )
+                self._logger.info(
+                    f"    After {dead_letter.get('attempts', 0)} attempts, at" +
+                    f" {dead_letter.get('at', None)}: {dead_letter.get('error', None)}"
+                )
+            self._logger.info("Put them back in the queue with: dead_letter requeue [--item N]")
+        except Exception as e:
+            self._logger.exception(e)
+
+    def _describe(self, item: dict) -> str:
+        if item.get("action", None) == "reblog":
+            return f"of {item.get('id', None)}"
+        status = (item.get("status", None) or "").replace("\n", " ")
+        if len(status) > self.MAX_STATUS_LENGTH:
+            status = status[:self.MAX_STATUS_LENGTH] + "..."
+        return f"\"{status}\""
@@ -0,0 +1,55 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from echobot.lib.dead_letter import DeadLetterQueue
+from echobot.lib.publisher import Publisher
+from echobot.lib.queue_item import QueueItem
+from echobot.lib.locked_storage import LockedQueue, get_storage_params
+from echobot.runners.runner_protocol import RunnerProtocol
+from definitions import ROOT_DIR
+import logging
+import os
+
+
+class DeadLetterRequeue(RunnerProtocol):
+    '''
+    Runner that moves the dead letters back to the queue
+
+    All of them, or the one in the position given with --item,
+    as listed by dead_letter inspect. They start again from no attempts.
+    '''
+
+    def __init__(
+        self, config: Config = None, logger: logging = None, params: dict = None
+    ) -> None:
+        self._config = config
+        self._logger = logger
+        self._params = params if params is not None else {}
+
+    def run(self):
+        try:
+            dead_letter = DeadLetterQueue(config=self._config, base_path=ROOT_DIR)
+            if dead_letter.length() == 0:
+                self._logger.info("There are no dead letters")
+                return
+
+            queue_file = self._config.get(
+                "toots_queue_storage.file", Publisher.DEFAULT_QUEUE_FILE
+            )
+            if not os.path.isabs(queue_file):
+                queue_file = os.path.join(ROOT_DIR, queue_file)
+            queue = LockedQueue(
+                logger=self._logger,
+                storage_file=queue_file,
+                queue_item_object=QueueItem,
+                **get_storage_params(self._config)
+            )
+            position = self._params.get("item", None)
+            requeued = dead_letter.requeue(
+                queue, positions=[position] if position is not None else None
+            )
+            self._logger.info(
+                f"{TerminalColor.GREEN}Requeued {requeued} posts, {dead_letter.length()}" +
+                f" dead letters left{TerminalColor.END}"
+            )
+        except Exception as e:
+            self._logger.exception(e)
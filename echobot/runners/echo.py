@@ -6,6 +6,14 @@ from echobot.parsers.mastodon_parser import MastodonParser
 from echobot.parsers.feed_parser import FeedParser
 from echobot.parsers.telegram_parser import TelegramParser
 from echobot.lib.publisher import Publisher
+from echobot.lib.media_prefetcher import MediaPrefetcher
+from echobot.lib.media_cache import MediaCache
+from echobot.lib.run_metrics import RunMetrics
+from echobot.lib.fetch_cache import FetchCache
+from echobot.lib.file_lock import FileLock, LockTimeoutException
+from echobot.lib.shard import Shard
+from echobot.lib.run_pipeline import RunPipeline
+from echobot.lib.run_budget import RunBudget
 from echobot.runners.runner_protocol import RunnerProtocol
 from definitions import ROOT_DIR
 import logging
@@ -17,14 +25,26 @@ class Echo(RunnerProtocol):
     '''
 
     def __init__(
-        self, config: Config = None, logger: logging = None, params: dict = None
+        self,
+        config: Config = None,
+        logger: logging = None,
+        params: dict = None,
+        fetch_cache: FetchCache = None
     ) -> None:
         self._config = config
         self._logger = logger
+        self._fetch_cache = fetch_cache
+        self._params = params if params is not None else {}
+        self._budget = None
+        # Only the sources of this shard are parsed, given as --shard K/N
+        self._shard = Shard.from_config(config, params["shard"])\
+            if params and params.get("shard", None) else None
+        self._metrics = RunMetrics(config=self._config, base_path=ROOT_DIR, shard=self._shard)
         self._publisher = Publisher(
             config=self._config,
             base_path=ROOT_DIR,
-            only_oldest=self._config.get("publisher.only_older_toot")
+            only_oldest=self._config.get("publisher.only_older_toot"),
+            metrics=self._metrics
         )
 
     def run(self) -> None:
@@ -33,39 +53,84 @@ class Echo(RunnerProtocol):
         - Parses all registered mastodon accounts and RSS feeds
         - Adds al selected content to a queue to be published
         - Publishes the queue, one each run or all in one shot
+        - With pipeline.active, parses all at the same time and publishes meanwhile
 
         Set the behaviour in the config.yaml
         '''
+        # Overlapping runs would publish the same posts twice
+        run_lock = FileLock.for_run(self._config, base_path=ROOT_DIR, shard=self._shard)
         try:
-            self._logger.info(f"{TerminalColor.MAGENTA}Main EchoBot run{TerminalColor.END}")
-            # Parses the defined mastodon accounts
-            # and merges the toots to the already existing queue
+            run_lock.acquire()
+        except LockTimeoutException as e:
             self._logger.info(
-                f"{TerminalColor.YELLOW}Parsing Mastodon accounts{TerminalColor.END}"
+                f"{TerminalColor.YELLOW}Another run is in progress, exiting: {e}" +
+                f"{TerminalColor.END}"
             )
-            mastodon_parser = MastodonParser(self._config)
-            mastodon_parser.parse(self._publisher._mastodon)
+            return
 
-            # Parses the defined feeds
-            # and merges the toots to the already existing queue
-            self._logger.info(f"{TerminalColor.YELLOW}Parsing RSS sites{TerminalColor.END}")
-            feed_parser = FeedParser(self._config)
-            feed_parser.parse()
-
-            # Parses the defined Telegram channels
-            # and merges the toots to the already existing queue
+        success = False
+        try:
+            # Given with --budget SECONDS, to fit the run in the interval between runs
+            self._budget = RunBudget.from_params(
+                self._config,
+                self._params,
+                base_path=ROOT_DIR,
+                shard=self._shard,
+                metrics=self._metrics
+            )
             self._logger.info(
-                f"{TerminalColor.YELLOW}Parsing Telegram accounts{TerminalColor.END}"
+                f"{TerminalColor.MAGENTA}Main EchoBot run" +
+                (f" as shard {self._shard.name}" if self._shard is not None else "") +
+                f"{TerminalColor.END}"
             )
-            telegram_parser = TelegramParser(self._config)
-            telegram_parser.parse()
-
-            # Read from the queue the toots to publish
-            # and do so according to the config parameters
-            difference = self._publisher.reload_queue()
-            difference = f"+{str(difference)}" if difference > 0 else str(difference)
-            self._logger.info(f"The queue differs now as per {difference} elements")
-            self._publisher.publish_all_from_queue()
+            if self._budget is not None:
+                self._logger.info(
+                    f"Running within a budget of {self._params['budget']} seconds"
+                )
+            parsers = {
+                "mastodon": self.parse_mastodon,
+                "feeds": self.parse_feeds,
+                "telegram": self.parse_telegram
+            }
+            # The parser that ran out of budget last time goes first
+            if self._budget is not None:
+                parsers = {
+                    name: parsers[name]
+                    for name in self._budget.order_parsers(list(parsers.keys()))
+                }
+
+            if self._config.get("pipeline.active", False):
+                # The parsers run at the same time and the queue is published meanwhile
+                is_publisher = self._shard is None or self._shard.is_publisher
+                pipeline = RunPipeline(
+                    self._config, self._publisher, self._metrics, base_path=ROOT_DIR
+                )
+                pipeline.run(parsers, publish=is_publisher)
+            else:
+                for parse in parsers.values():
+                    parse()
+
+            # The queue is shared, only one shard publishes it
+            if self._shard is not None and not self._shard.is_publisher:
+                self._logger.info(
+                    f"The shard {self._shard.publisher}/{self._shard.count}" +
+                    " publishes the queue, done"
+                )
+                success = True
+                return
+
+            if not self._config.get("pipeline.active", False):
+                self.publish()
+
+            # Keep the media storage within its budget
+            if self._config.get("media_cache.auto_vacuum", False):
+                result = MediaCache(config=self._config, base_path=ROOT_DIR).vacuum()
+                self._logger.info(
+                    f"Media vacuum reclaimed {result['bytes_reclaimed']} bytes" +
+                    f" from {result['files_removed']} files"
+                )
+
+            success = True
 
         except Exception as e:
             if self._config.get("janitor.active", False):
@@ -79,6 +144,85 @@ class Echo(RunnerProtocol):
 
             self._logger.exception(e)
 
+        finally:
+            self.save_metrics(success)
+            run_lock.release()
+
+    def parse_mastodon(self) -> None:
+        # Parses the defined mastodon accounts
+        # and merges the toots to the already existing queue
+        self._logger.info(f"{TerminalColor.YELLOW}Parsing Mastodon accounts{TerminalColor.END}")
+        mastodon_parser = MastodonParser(
+            self._config,
+            metrics=self._metrics,
+            fetch_cache=self._fetch_cache,
+            shard=self._shard,
+            budget=self._budget
+        )
+        mastodon_parser.parse(self._publisher._mastodon)
+
+    def parse_feeds(self) -> None:
+        # Parses the defined feeds
+        # and merges the toots to the already existing queue
+        self._logger.info(f"{TerminalColor.YELLOW}Parsing RSS sites{TerminalColor.END}")
+        feed_parser = FeedParser(
+            self._config,
+            metrics=self._metrics,
+            fetch_cache=self._fetch_cache,
+            shard=self._shard,
+            budget=self._budget
+        )
+        feed_parser.parse()
+
+    def parse_telegram(self) -> None:
+        # Parses the defined Telegram channels
+        # and merges the toots to the already existing queue
+        self._logger.info(f"{TerminalColor.YELLOW}Parsing Telegram accounts{TerminalColor.END}")
+        telegram_parser = TelegramParser(
+            self._config,
+            metrics=self._metrics,
+            shard=self._shard,
+            publisher=self._publisher,
+            budget=self._budget
+        )
+        telegram_parser.parse()
+
+    def publish(self) -> None:
+        # Read from the queue the toots to publish
+        # and do so according to the config parameters
+        difference = self._publisher.reload_queue()
+        difference = f"+{str(difference)}" if difference > 0 else str(difference)
+        self._logger.info(f"The queue differs now as per {difference} elements")
+
+        # Prepare the media of the posts that will be published soon,
+        # so that the publishing does not wait for slow media servers
+        if self._config.get("publisher.media_prefetch.active", False):
+            self._logger.info(f"{TerminalColor.YELLOW}Prefetching media{TerminalColor.END}")
+            with self._metrics.stage("media.prefetch"):
+                MediaPrefetcher(
+                    self._config, self._publisher, self._metrics, base_path=ROOT_DIR
+                ).prefetch()
+
+        with self._metrics.stage("publish"):
+            self._publisher.publish_all_from_queue()
+
+    def save_metrics(self, success: bool) -> None:
+        open_circuits = self._metrics.get_open_circuits()
+        if open_circuits:
+            self._logger.warning(
+                f"{TerminalColor.RED}Sources skipped or failing with an open circuit: " +
+                f"{', '.join(open_circuits)}{TerminalColor.END}"
+            )
+        try:
+            self._metrics.set_queue_gauges(
+                [item.to_dict() for item in self._publisher._queue.get_all()]
+            )
+            self._metrics.finish(success=success)
+            self._metrics.save()
+        except Exception as e:
+            # Metrics must never break a run
+            self._logger.warning(f"Could not save the run metrics: {e}")
+
 
 if __name__ == '__main__':
     Echo().run()
@@ -0,0 +1,47 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from echobot.lib.media_cache import MediaCache
+from echobot.lib.file_lock import FileLock, LockTimeoutException
+from echobot.runners.runner_protocol import RunnerProtocol
+from definitions import ROOT_DIR
+import logging
+
+
+class MediaVacuum(RunnerProtocol):
+    '''
+    Runner that evicts media files from the storage, attending the cache budget
+    '''
+
+    def __init__(
+        self, config: Config = None, logger: logging = None, params: dict = None
+    ) -> None:
+        self._config = config
+        self._logger = logger
+
+    def run(self):
+        # A run in progress may be about to upload the files that are not queued anymore
+        run_lock = FileLock.for_run(self._config, base_path=ROOT_DIR)
+        try:
+            run_lock.acquire()
+        except LockTimeoutException as e:
+            self._logger.info(
+                f"{TerminalColor.YELLOW}Another run is in progress, exiting: {e}" +
+                f"{TerminalColor.END}"
+            )
+            return
+
+        try:
+            self._logger.info(f"{TerminalColor.MAGENTA}Vacuuming the media{TerminalColor.END}")
+            result = MediaCache(config=self._config, base_path=ROOT_DIR).vacuum()
+            self._logger.info(
+                f"{TerminalColor.GREEN}Removed {result['files_removed']} of" +
+                f" {result['files_before']} files, reclaiming" +
+                f" {result['bytes_reclaimed']} bytes ({result['bytes_before']}" +
+                f" -> {result['bytes_after']}). {result['files_kept_by_reference']}" +
+                " files are kept as they are still queued or dead lettered." +
+                f"{TerminalColor.END}"
+            )
+        except Exception as e:
+            self._logger.exception(e)
+        finally:
+            run_lock.release()
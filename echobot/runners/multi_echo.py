@@ -0,0 +1,70 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from echobot.lib.fetch_cache import FetchCache
+from echobot.lib.config_snapshot import ConfigSnapshot
+from echobot.runners.echo import Echo
+from echobot.runners.runner_protocol import RunnerProtocol
+from definitions import ROOT_DIR
+import logging
+import glob
+import os
+
+
+class MultiEcho(RunnerProtocol):
+    '''
+    Runner that runs several bots in one process, sharing what they fetch
+
+    Every bot keeps its own config directory, with its own filters, storage
+    and queue. The feeds and the Mastodon accounts that several bots watch are
+    fetched and parsed only once per run. Telegram is not shared, as every bot
+    logs in with its own session.
+    '''
+
+    def __init__(
+        self, config: Config = None, logger: logging = None, params: dict = None
+    ) -> None:
+        self._config = config
+        self._logger = logger
+
+    def run(self):
+        bots = self._config.get("multi_bot.bots", None)
+        if not bots:
+            self._logger.info("No bots registered to run, skipping,")
+            return
+
+        fetch_cache = FetchCache()
+        failed_bots = 0
+        for directory in bots:
+            self._logger.info(
+                f"{TerminalColor.MAGENTA}Running the bot in {directory}{TerminalColor.END}"
+            )
+            try:
+                config = self._load_bot_config(directory)
+            except Exception as e:
+                self._logger.error(f"Could not load the config of the bot in {directory}: {e}")
+                failed_bots += 1
+                continue
+
+            Echo(config=config, logger=self._logger, fetch_cache=fetch_cache).run()
+
+        stats = fetch_cache.get_stats()
+        self._logger.info(
+            f"{TerminalColor.GREEN}Ran {len(bots) - failed_bots} of {len(bots)} bots." +
+            f" Fetched {stats['misses']} times and reused {stats['hits']} times" +
+            f"{TerminalColor.END}"
+        )
+
+    def _load_bot_config(self, directory: str) -> Config:
+        """
+        Loads all configs in the bot's directory, as it is done for the main one
+        """
+        directory = os.path.join(ROOT_DIR, directory)
+        config = ConfigSnapshot(
+            [os.path.join(directory, "main.yaml")] +
+            sorted(glob.glob(os.path.join(directory, "*.yaml"))),
+            base_path=ROOT_DIR
+        ).load()
+
+        # All bots log into the same place
+        config.merge_from_dict(parameters={"logger": self._config.get("logger")})
+        return config
@@ -1,6 +1,7 @@
 from pyxavi.config import Config
 from pyxavi.terminal_color import TerminalColor
 from echobot.lib.publisher import Publisher
+from echobot.lib.file_lock import FileLock, LockTimeoutException
 from echobot.runners.runner_protocol import RunnerProtocol
 from definitions import ROOT_DIR
 import logging
@@ -22,6 +23,16 @@ class QueuePublisher(RunnerProtocol):
         '''
         Just publishes the queue
         '''
+        run_lock = FileLock.for_run(self._config, base_path=ROOT_DIR)
+        try:
+            run_lock.acquire()
+        except LockTimeoutException as e:
+            self._logger.info(
+                f"{TerminalColor.YELLOW}Another run is in progress, exiting: {e}" +
+                f"{TerminalColor.END}"
+            )
+            return
+
         try:
             self._logger.info(
                 f"{TerminalColor.MAGENTA}Publishing whole queue{TerminalColor.END}"
@@ -29,3 +40,5 @@ class QueuePublisher(RunnerProtocol):
             self._publisher.publish_all_from_queue()
         except Exception as e:
             self._logger.exception(e)
+        finally:
+            run_lock.release()
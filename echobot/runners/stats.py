@@ -0,0 +1,96 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from echobot.lib.run_metrics import RunMetrics
+from echobot.runners.runner_protocol import RunnerProtocol
+from definitions import ROOT_DIR
+import logging
+
+
+class Stats(RunnerProtocol):
+    '''
+    Runner that prints the metrics of the most recent runs
+    '''
+
+    DEFAULT_RUNS_TO_SHOW = 10
+
+    def __init__(
+        self, config: Config = None, logger: logging = None, params: dict = None
+    ) -> None:
+        self._config = config
+        self._logger = logger
+        self._runs_to_show = config.get("metrics.runs_to_show", self.DEFAULT_RUNS_TO_SHOW)
+
+    def run(self):
+        try:
+            history = RunMetrics(config=self._config, base_path=ROOT_DIR).load_history()
+            if not history:
+                self._logger.info("There are no runs recorded yet")
+                return
+
+            runs = history[-self._runs_to_show:]
+            self._logger.info(
+                f"{TerminalColor.MAGENTA}Last {len(runs)} of {len(history)}" +
+                f" recorded runs{TerminalColor.END}"
+            )
+            self._logger.info(
+                f"{'Started at':<26}{'Result':<8}{'Seconds':>9}{'Fetched':>9}" +
+                f"{'Queued':>8}{'Published':>11}{'Depth':>7}{'Oldest':>10}  Slowest stage"
+            )
+            for run in reversed(runs):
+                self._logger.info(self._format_run(run))
+
+            self._print_last_run_detail(runs[-1])
+        except Exception as e:
+            self._logger.exception(e)
+
+    def _format_run(self, run: dict) -> str:
+        sources = run.get("sources", [])
+        gauges = run.get("gauges", {})
+        stages = run.get("stages", {})
+        slowest = max(stages.items(), key=lambda stage: stage[1]["seconds"])\
+            if stages else None
+        result = f"{TerminalColor.GREEN}ok{TerminalColor.END}    " if run["success"]\
+            else f"{TerminalColor.RED}failed{TerminalColor.END}"
+
+        return f"{run['started_at']:<26}{result}  " +\
+            f"{run['duration_seconds'] or 0:>9.2f}" +\
+            f"{sum([source['fetched'] for source in sources]):>9}" +\
+            f"{sum([source['queued'] for source in sources]):>8}" +\
+            f"{run.get('counters', {}).get('published_items', 0):>11}" +\
+            f"{gauges.get('queue_depth', 0):>7}" +\
+            f"{self._format_age(gauges.get('queue_oldest_item_age_seconds', 0)):>10}  " +\
+            (f"{slowest[0]} ({slowest[1]['seconds']:.2f}s)" if slowest else "-")
+
+    def _print_last_run_detail(self, run: dict) -> None:
+        self._logger.info(f"{TerminalColor.YELLOW}Stages of the last run{TerminalColor.END}")
+        for name, stage in sorted(run.get("stages", {}).items(),
+                                  key=lambda stage: stage[1]["seconds"],
+                                  reverse=True):
+            self._logger.info(
+                f"  {name:<24}{stage['seconds']:>10.3f}s{stage['calls']:>8} calls"
+            )
+
+        self._logger.info(f"{TerminalColor.YELLOW}Sources of the last run{TerminalColor.END}")
+        for source in run.get("sources", []):
+            self._logger.info(
+                f"  {source['type'] + ':' + source['name']:<40}" +
+                f" fetched {source['fetched']:>5}, discarded {source['discarded']:>5}," +
+                f" queued {source['queued']:>5}"
+            )
+
+        open_circuits = [
+            circuit for circuit in run.get("circuits", []) if circuit["state"] != "closed"
+        ]
+        if open_circuits:
+            self._logger.info(f"{TerminalColor.YELLOW}Open circuit breakers{TerminalColor.END}")
+            for circuit in open_circuits:
+                self._logger.info(
+                    f"  {circuit['type'] + ':' + circuit['name']:<40} {circuit['state']}"
+                )
+
+    def _format_age(self, seconds: float) -> str:
+        if seconds >= 86400:
+            return f"{seconds / 86400:.1f}d"
+        if seconds >= 3600:
+            return f"{seconds / 3600:.1f}h"
+        return f"{seconds / 60:.0f}m"
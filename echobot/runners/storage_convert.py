@@ -0,0 +1,81 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from echobot.lib.file_lock import FileLock
+from echobot.lib.locked_storage import get_storage_files
+from echobot.lib.serializer import Serializer
+from echobot.parsers.feed_parser import FeedParser
+from echobot.parsers.mastodon_parser import MastodonParser
+from echobot.parsers.telegram_parser import TelegramParser
+from echobot.runners.runner_protocol import RunnerProtocol
+from definitions import ROOT_DIR
+import logging
+import time
+import os
+
+
+class StorageConvert(RunnerProtocol):
+    '''
+    Runner that rewrites the storage and queue files in another format
+
+    The format is the one given with --format, or the one in the config.
+    Files keep their names, the format is detected when they are read.
+    '''
+
+    STORAGE_FILES = [
+        ("feed_parser.storage_file", FeedParser.DEFAULT_STORAGE_FILE),
+        ("mastodon_parser.storage_file", MastodonParser.DEFAULT_STORAGE_FILE),
+        ("telegram_parser.storage_file", TelegramParser.DEFAULT_TELEGRAM_FILE),
+        ("toots_queue_storage.file", FeedParser.DEFAULT_QUEUE_FILE),
+    ]
+
+    def __init__(
+        self, config: Config = None, logger: logging = None, params: dict = None
+    ) -> None:
+        self._config = config
+        self._logger = logger
+        self._params = params if params is not None else {}
+
+    def run(self):
+        try:
+            serializer = Serializer(self._params.get("format", None))\
+                if self._params.get("format", None) else Serializer.from_config(self._config)
+            self._logger.info(
+                f"{TerminalColor.MAGENTA}Converting the storage to {serializer.format}" +
+                f"{TerminalColor.END}"
+            )
+            configured_format = self._config.get("serializer.format", Serializer.DEFAULT_FORMAT)
+            if serializer.format != configured_format:
+                self._logger.warning(
+                    f"The config still writes {configured_format}, the files will go back" +
+                    " to it when saved. Set serializer.format to keep them converted"
+                )
+
+            lock_params = FileLock.get_params(self._config)
+            for param_name, default_file in self.STORAGE_FILES:
+                filename = self._config.get(param_name, default_file)
+                if not os.path.isabs(filename):
+                    filename = os.path.join(ROOT_DIR, filename)
+                for storage_file in get_storage_files(filename):
+                    if os.path.exists(storage_file):
+                        with FileLock(f"{storage_file}.lock", **lock_params):
+                            self.convert(storage_file, serializer)
+        except Exception as e:
+            self._logger.exception(e)
+
+    def convert(self, filename: str, serializer: Serializer) -> None:
+        with open(filename, "rb") as stream:
+            data = stream.read()
+        start = time.perf_counter()
+        content = serializer.loads(data)
+        load_before = time.perf_counter() - start
+
+        serializer.write_file(filename, content)
+
+        start = time.perf_counter()
+        serializer.load_file(filename)
+        load_after = time.perf_counter() - start
+        self._logger.info(
+            f"{os.path.relpath(filename, ROOT_DIR)}: {Serializer.detect_format(data)} ->" +
+            f" {serializer.format}, {len(data)} -> {os.path.getsize(filename)} bytes," +
+            f" loads in {load_before * 1000:.1f}ms -> {load_after * 1000:.1f}ms"
+        )
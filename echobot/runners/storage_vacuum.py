@@ -0,0 +1,43 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from echobot.lib.storage_pruner import StoragePruner
+from echobot.runners.runner_protocol import RunnerProtocol
+from definitions import ROOT_DIR
+import logging
+import os
+
+
+class StorageVacuum(RunnerProtocol):
+    '''
+    Runner that prunes the state that the parsers don't need anymore
+    '''
+
+    def __init__(
+        self, config: Config = None, logger: logging = None, params: dict = None
+    ) -> None:
+        self._config = config
+        self._logger = logger
+
+    def run(self):
+        try:
+            self._logger.info(
+                f"{TerminalColor.MAGENTA}Vacuuming the storage{TerminalColor.END}"
+            )
+            results = StoragePruner(config=self._config, base_path=ROOT_DIR).vacuum()
+            for result in results:
+                if result["bytes_before"] == 0:
+                    continue
+                self._logger.info(
+                    f"{os.path.relpath(result['file'], ROOT_DIR)}: removed" +
+                    f" {result['sources_removed']} sources no longer configured and" +
+                    f" {result['entries_removed']} entries, {result['bytes_before']}" +
+                    f" -> {result['bytes_after']} bytes"
+                )
+            bytes_before = sum([result["bytes_before"] for result in results])
+            bytes_after = sum([result["bytes_after"] for result in results])
+            self._logger.info(
+                f"{TerminalColor.GREEN}Reclaimed {bytes_before - bytes_after} bytes" +
+                f" ({bytes_before} -> {bytes_after}){TerminalColor.END}"
+            )
+        except Exception as e:
+            self._logger.exception(e)
@@ -0,0 +1,52 @@
+from pyxavi.config import Config
+from pyxavi.terminal_color import TerminalColor
+from echobot.lib.websub import WebSubSubscriber
+from echobot.runners.runner_protocol import RunnerProtocol
+import logging
+import time
+
+
+class WebSubReceiver(RunnerProtocol):
+    '''
+    Runner that keeps the WebSub subscriptions and receives the pushed feeds
+
+    It runs until it is interrupted.
+    '''
+
+    DEFAULT_CHECK_INTERVAL = 300
+
+    def __init__(
+        self, config: Config = None, logger: logging = None, params: dict = None
+    ) -> None:
+        self._config = config
+        self._logger = logger
+        self._check_interval = config.get("websub.check_interval", self.DEFAULT_CHECK_INTERVAL)
+
+    def run(self):
+        if not self._config.get("websub.active", False):
+            self._logger.warning("WebSub is not active in the config, nothing to do")
+            return
+
+        try:
+            subscriber = WebSubSubscriber(config=self._config)
+            base_url = subscriber.start()
+        except Exception as e:
+            self._logger.exception(e)
+            return
+
+        self._logger.info(
+            f"{TerminalColor.MAGENTA}Receiving WebSub pushes at {base_url}," +
+            f" with callbacks under {subscriber.callback_base_url}{TerminalColor.END}"
+        )
+        try:
+            while True:
+                requested = subscriber.subscribe_due()
+                if requested > 0:
+                    self._logger.info(f"Sent {requested} subscription requests")
+                time.sleep(self._check_interval)
+        except KeyboardInterrupt:
+            self._logger.info("Stopping the WebSub receiver")
+        except Exception as e:
+            self._logger.exception(e)
+        finally:
+            subscriber.stop()
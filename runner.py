@@ -1,5 +1,6 @@
 from argparse import ArgumentParser, Namespace
-import pkg_resources
+from importlib import import_module
+from importlib.metadata import version, PackageNotFoundError
 from echobot.runners.runner_protocol import RunnerProtocol
 from pyxavi.terminal_color import TerminalColor
 from pyxavi.config import Config
@@ -11,29 +12,34 @@ from string import Template
 import glob
 import logging
 
-from echobot.runners.echo import Echo
-from echobot.runners.publish_queue import QueuePublisher
-from echobot.runners.publish_test import PublishTest
-from echobot.runners.telegram_login import TelegramLogin
-from echobot.runners.test_janitor import TestJanitor
-
 PROGRAM_NAME = "EchoBot"
 CLI_NAME = "echobot"
 PROGRAM_DESC = "CLI command to execute runners and tasks"
 PROGRAM_EPILOG = f"Use [{CLI_NAME} commands] to get a list of available commands."
-PROGRAM_VERSION = pkg_resources.get_distribution(PROGRAM_NAME).version
+# A checkout that was not installed has no package metadata to take the version from
+UNKNOWN_VERSION = "unknown"
 VERBOSE_LOGLEVEL = 10
 
 SUBCOMMAND_TOKEN = "#SUBCOMMAND#"
 HELP_TOKEN = "#HELP#"
 IMPLEMENTED_IN_BASH_TOKEN = "#BASH#"
+
+# Runners are given by their import path and imported only when dispatched,
+#   so a command does not pay for the dependencies of the rest (Telethon, Mastodon.py...)
 COMMAND_MAP = {
     "commands": (HELP_TOKEN, "Shows the list of available commands and subcommands"),
     "echo": (SUBCOMMAND_TOKEN, "Performs tasks related to the bot itself"),
     "mastodon": (SUBCOMMAND_TOKEN, "Performs tasks related to the Mastodon-like API"),
     "janitor": (SUBCOMMAND_TOKEN, "Performs tasks related to the Janitor API"),
+    "media": (SUBCOMMAND_TOKEN, "Performs tasks related to the downloaded media"),
+    "storage": (SUBCOMMAND_TOKEN, "Performs tasks related to the parsers' storage"),
+    "dead_letter": (SUBCOMMAND_TOKEN, "Performs tasks related to the posts that failed"),
+    "websub": (SUBCOMMAND_TOKEN, "Performs tasks related to the WebSub push subscriptions"),
+    "bench": (SUBCOMMAND_TOKEN, "Performs benchmarks over the bot's pipeline"),
+    "stats": ("echobot.runners.stats.Stats", "Shows the metrics of the most recent runs"),
     "telegram_login": (
-        TelegramLogin, "Logs in into Telegram and stores the session internally"
+        "echobot.runners.telegram_login.TelegramLogin",
+        "Logs in into Telegram and stores the session internally"
     ),
     "validate_config": (IMPLEMENTED_IN_BASH_TOKEN, "Validates the current configs"),
     "remove_scheme": (
@@ -43,24 +49,91 @@ COMMAND_MAP = {
 
 SUBCOMMAND_MAP = {
     "echo": {
-        "run": (Echo, "Runs the application"),
+        "run": ("echobot.runners.echo.Echo", "Runs the application"),
+        "multi": (
+            "echobot.runners.multi_echo.MultiEcho",
+            "Runs several bots at once, fetching the shared sources once"
+        ),
     },
     "mastodon": {
         "test": (
-            PublishTest,
+            "echobot.runners.publish_test.PublishTest",
             "Publishes a test message to the Mastodon-like API to ensure that all is set up ok."
         ),
         "publish_queue": (
-            QueuePublisher,
+            "echobot.runners.publish_queue.QueuePublisher",
             "Publishes the current queue to the Mastodon-like API, attending the config file."
         ),
     },
     "janitor": {
-        "test": (TestJanitor, "Tests the connection to the Janitor API")
+        "test": (
+            "echobot.runners.test_janitor.TestJanitor",
+            "Tests the connection to the Janitor API"
+        )
+    },
+    "media": {
+        "vacuum": (
+            "echobot.runners.media_vacuum.MediaVacuum",
+            "Removes old and least used media files to fit the budget in the config."
+        )
+    },
+    "storage": {
+        "vacuum": (
+            "echobot.runners.storage_vacuum.StorageVacuum",
+            "Prunes the seen state that is too old or of sources no longer configured."
+        ),
+        "convert": (
+            "echobot.runners.storage_convert.StorageConvert",
+            "Rewrites the storage and queue files in the format of the config or --format."
+        ),
+    },
+    "dead_letter": {
+        "inspect": (
+            "echobot.runners.dead_letter_inspect.DeadLetterInspect",
+            "Lists the posts that could not be published and why."
+        ),
+        "requeue": (
+            "echobot.runners.dead_letter_requeue.DeadLetterRequeue",
+            "Moves the dead letters back to the queue, all or the one given with --item."
+        ),
+    },
+    "websub": {
+        "serve": (
+            "echobot.runners.websub_receiver.WebSubReceiver",
+            "Keeps the subscriptions to the feeds' hubs and receives their pushes."
+        )
+    },
+    "bench": {
+        "parse": (
+            "echobot.runners.bench_parse.BenchParse",
+            "Benchmarks the parse pipeline with synthetic data and compares to the baseline."
+        ),
+        "e2e": (
+            "echobot.runners.bench_e2e.BenchE2E",
+            "Drives full runs against a local fake Mastodon API and reports the throughput."
+        ),
+        "websub": (
+            "echobot.runners.bench_websub.BenchWebSub",
+            "Subscribes the feeds to a local fake WebSub hub and measures the pushes."
+        ),
+        "startup": (
+            "echobot.runners.bench_startup.BenchStartup",
+            "Measures the startup time of the CLI and of every runner against the baseline."
+        ),
     },
 }
 
 
+def get_program_version() -> str:
+    try:
+        return version(PROGRAM_NAME)
+    except PackageNotFoundError:
+        return UNKNOWN_VERSION
+
+
+PROGRAM_VERSION = get_program_version()
+
+
 def print_command_list(with_colors: bool = True):
     main_template = "\n$title\n\nusage: $example_use\n\nCommand list:\n\n$command_list\n"
     title_template = "$name v$version"
@@ -105,6 +178,29 @@ def print_command_list(with_colors: bool = True):
     print(content)
 
 
+def load_runner(import_path: str) -> RunnerProtocol:
+    """
+    Imports the runner class given as "package.module.ClassName"
+    """
+    module_name, class_name = import_path.rsplit(".", 1)
+    return getattr(import_module(module_name), class_name)
+
+
+def get_runner_paths() -> dict:
+    """
+    The import path of every runner implemented in Python, by its command line
+    """
+    tokens = [SUBCOMMAND_TOKEN, HELP_TOKEN, IMPLEMENTED_IN_BASH_TOKEN]
+    paths = {}
+    for command, (action, _) in COMMAND_MAP.items():
+        if action not in tokens:
+            paths[command] = action
+        for subcommand, (subaction, _) in SUBCOMMAND_MAP.get(command, {}).items():
+            if subaction not in tokens:
+                paths[f"{command} {subcommand}"] = subaction
+    return paths
+
+
 def _get_runner_by_command(args: Namespace) -> RunnerProtocol:
     command_candidate = args.command
 
@@ -128,7 +224,9 @@ def _get_runner_by_command(args: Namespace) -> RunnerProtocol:
                     else:
                         # It is a direct Runner.
                         # DO NOT return the instance, let it be in the main.
-                        return SUBCOMMAND_MAP[command_candidate][subcommand_candidate][0]
+                        return load_runner(
+                            SUBCOMMAND_MAP[command_candidate][subcommand_candidate][0]
+                        )
                 elif subcommand_candidate is None:
                     # A subcommand is expected
                     raise RuntimeError(
@@ -164,7 +262,7 @@ def _get_runner_by_command(args: Namespace) -> RunnerProtocol:
             else:
                 # It is a direct Runner.
                 # DO NOT return the instance, let it be in the main.
-                return COMMAND_MAP[command_candidate][0]
+                return load_runner(COMMAND_MAP[command_candidate][0])
     else:
         # Oops! It's not here, return an error
         raise RuntimeError(f"The requested command '{command_candidate}' does not exist")
@@ -192,6 +290,25 @@ def setup_parser() -> ArgumentParser:
 
     # Shortcut to make the -l = 10, so it shows DEBUG (included) and higher.
     parser.add_argument("-d", "--debug", action="store_true")
+
+    # Benchmarks: store the results as the baseline to compare with in next runs.
+    parser.add_argument("--save-baseline", action="store_true")
+
+    # Profiling of the runner: cProfile stats and collapsed stacks, and allocations.
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--trace-malloc", action="store_true")
+
+    # Parse only a part of the sources, to split the load between processes. As K/N
+    parser.add_argument("--shard", action="store", default=None)
+
+    # Format to convert the storage to: yaml, json or msgpack
+    parser.add_argument("--format", action="store", default=None)
+
+    # Seconds the run has to fit in, the sources left out go first in the next run
+    parser.add_argument("--budget", action="store", type=float, default=None)
+
+    # The dead letter to requeue, by its position in dead_letter inspect
+    parser.add_argument("--item", action="store", type=int, default=None)
     return parser
 
 
@@ -202,14 +319,17 @@ def load_config_files() -> Config:
     This is a merge-all-to-one approach, so may be the case that later objects
         overwrite older ones
     """
-    config_files = glob.glob(os.path.join(CONFIG_DIR, "*.yaml"))
+    from echobot.lib.config_snapshot import ConfigSnapshot
 
-    # Yes, technically we're loading main.yaml twice
-    config = Config(filename=os.path.join(CONFIG_DIR, "main.yaml"))
-    for file in config_files:
-        config.merge_from_file(filename=os.path.join(CONFIG_DIR, file))
+    config_files = glob.glob(os.path.join(CONFIG_DIR, "*.yaml"))
 
-    return config
+    # Yes, technically we're loading main.yaml twice.
+    #   Only when the files changed, otherwise the merged snapshot is loaded
+    return ConfigSnapshot(
+        [os.path.join(CONFIG_DIR, "main.yaml")] +
+        [os.path.join(CONFIG_DIR, file) for file in config_files],
+        base_path=ROOT_DIR
+    ).load()
 
 
 def load_logger(config: Config, loglevel: int = None) -> logging:
@@ -246,20 +366,32 @@ def run():
             if args.debug:
                 loglevel = VERBOSE_LOGLEVEL
 
-        # Instantiating the config and logger
-        config = load_config_files()
-        logger = load_logger(config=config, loglevel=loglevel)
-
-        # This prints the list of available commands and leaves.
+        # This prints the list of available commands and leaves, it needs no config.
         if args.command == "commands":
             print_command_list()
             exit(0)
 
+        # Instantiating the config and logger
+        config = load_config_files()
+        logger = load_logger(config=config, loglevel=loglevel)
+
         # Find the command to execute. It is ready to be instantiated
-        runner = _get_runner_by_command(args=args)(config=config, logger=logger)
+        runner = _get_runner_by_command(args=args
+                                        )(config=config, logger=logger, params=vars(args))
 
         # Execute the runner
-        runner.run()
+        if args.profile or args.trace_malloc:
+            from echobot.lib.profiler import Profiler
+
+            Profiler(
+                config=config,
+                name="-".join(filter(bool, [args.command, args.subcommand])),
+                profile=args.profile,
+                trace_malloc=args.trace_malloc,
+                base_path=ROOT_DIR
+            ).run(runner.run)
+        else:
+            runner.run()
     except RuntimeError as e:
         print(TerminalColor.RED_BRIGHT + str(e) + TerminalColor.END)
     except Exception:
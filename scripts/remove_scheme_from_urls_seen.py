@@ -39,11 +39,13 @@ def run():
         # Now we walk through the URLs and clean them
         #   generating a new list of URLs
         new_urls = []
+        known_urls = set()
         for url in urls:
             new_url = Url.clean(url=url, remove_components=CLEANING_PARAMS)
             log(f"{url} => {new_url}")
-            if new_url not in new_urls:
+            if new_url not in known_urls:
                 new_urls.append(new_url)
+                known_urls.add(new_url)
 
         # Now we replace the parameter with the new URL list
         storage.set(storage_parameter, new_urls)
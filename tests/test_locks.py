@@ -0,0 +1,159 @@
+from definitions import ROOT_DIR
+from echobot.lib.file_lock import FileLock, LockTimeoutException
+from echobot.lib.locked_storage import LockedStorage, LockedQueue, ShardedStorage
+from echobot.lib.queue_item import QueueItem
+from echobot.lib.shard import Shard
+from pyxavi.config import Config
+from datetime import datetime
+import subprocess
+import logging
+import signal
+import sys
+import pytest
+import os
+
+HOLDER_CODE = "from echobot.lib.file_lock import FileLock\n" +\
+    "import sys, time\n" +\
+    "lock = FileLock(sys.argv[1], lease=0)\n" +\
+    "lock.acquire()\n" +\
+    "print('locked', flush=True)\n" +\
+    "time.sleep(60)\n"
+
+
+def _get_queue(storage_file: str) -> LockedQueue:
+    return LockedQueue(
+        logger=logging.getLogger("test"),
+        storage_file=storage_file,
+        queue_item_object=QueueItem
+    )
+
+
+def _get_item(status: str) -> QueueItem:
+    return QueueItem({"status": status, "published_at": datetime(2024, 1, 1), "action": "new"})
+
+
+def _get_statuses(queue: LockedQueue) -> list:
+    return sorted([item.item["status"] for item in queue._queue])
+
+
+def test_storage_writers_keep_each_other_keys(tmp_path):
+    filename = str(tmp_path / "feeds.yaml")
+    first = LockedStorage(filename)
+    second = LockedStorage(filename)
+
+    first.set("one", 1)
+    second.set("two", 2)
+    first.write_file()
+    second.write_file()
+
+    stored = LockedStorage(filename)
+    assert stored.get("one") == 1
+    assert stored.get("two") == 2
+
+
+def test_storage_locked_cycles_do_not_lose_updates(tmp_path):
+    filename = str(tmp_path / "feeds.yaml")
+    first = LockedStorage(filename)
+    second = LockedStorage(filename)
+
+    for storage in [first, second, first]:
+        with storage.locked():
+            storage.set("counter", storage.get("counter", 0) + 1)
+            storage.write_file()
+
+    assert LockedStorage(filename).get("counter") == 3
+
+
+def test_queue_writers_keep_each_other_items(tmp_path):
+    storage_file = str(tmp_path / "queue.yaml")
+    first = _get_queue(storage_file)
+    second = _get_queue(storage_file)
+
+    first.append(_get_item("first"))
+    second.append(_get_item("second"))
+    for queue in [first, second]:
+        with queue.locked():
+            queue.save()
+
+    assert _get_statuses(_get_queue(storage_file)) == ["first", "second"]
+
+
+def test_queue_publisher_save_keeps_the_items_queued_meanwhile(tmp_path):
+    storage_file = str(tmp_path / "queue.yaml")
+    parser = _get_queue(storage_file)
+    parser.append(_get_item("published"))
+    with parser.locked():
+        parser.save()
+
+    publisher = _get_queue(storage_file)
+    parser.append(_get_item("queued meanwhile"))
+    with parser.locked():
+        parser.save()
+    publisher.pop()
+    publisher.save()
+
+    assert _get_statuses(_get_queue(storage_file)) == ["queued meanwhile"]
+
+
+def test_lock_times_out_naming_the_holder(tmp_path):
+    path = str(tmp_path / "storage.lock")
+    holder = FileLock(path)
+    holder.acquire()
+    try:
+        with pytest.raises(LockTimeoutException, match=f"pid {os.getpid()}"):
+            FileLock(path, timeout=0).acquire()
+    finally:
+        holder.release()
+
+    with FileLock(path, timeout=0):
+        pass
+
+
+def test_stale_lease_is_taken_over(tmp_path):
+    path = str(tmp_path / "storage.lock")
+    process = subprocess.Popen(
+        [sys.executable, "-c", HOLDER_CODE, path],
+        cwd=ROOT_DIR,
+        stdout=subprocess.PIPE,
+        text=True
+    )
+    try:
+        assert process.stdout.readline().strip() == "locked"
+        with pytest.raises(LockTimeoutException, match="lease expired"):
+            FileLock(path, timeout=0).acquire()
+    finally:
+        # The holder dies without releasing, leaving its lease behind
+        process.send_signal(signal.SIGKILL)
+        process.wait()
+        process.stdout.close()
+
+    assert FileLock(path).get_holder()["pid"] == process.pid
+    with FileLock(path, timeout=1) as lock:
+        assert lock.get_holder()["pid"] == os.getpid()
+
+
+def test_run_lock_rejects_a_second_run(tmp_path):
+    config = Config(params={"locks": {"run_lock_file": str(tmp_path / "run.lock")}})
+    first_run = FileLock.for_run(config)
+    first_run.acquire()
+    try:
+        with pytest.raises(LockTimeoutException):
+            FileLock.for_run(config).acquire()
+    finally:
+        first_run.release()
+
+    with FileLock.for_run(config):
+        pass
+
+
+def test_sharded_storage_adopts_the_key_from_another_partition(tmp_path):
+    filename = str(tmp_path / "feeds.yaml")
+    previous = ShardedStorage(filename, Shard(1, 2))
+    previous.set("site", {"urls_seen": ["https://example.com/1"]})
+    previous.write_file()
+
+    current = ShardedStorage(filename, Shard(2, 2))
+
+    assert current.get("site") == {"urls_seen": ["https://example.com/1"]}
+    assert LockedStorage(Shard(2, 2).get_partition_file(filename)).get("site") is not None
+    assert LockedStorage(Shard(1, 2).get_partition_file(filename)).get("site") is None
@@ -0,0 +1,120 @@
+from definitions import ROOT_DIR
+import runner
+import subprocess
+import sys
+import pytest
+import json
+
+# The heavy dependencies, only the runners that use them may import them
+HEAVY_MODULES = ["mastodon", "telethon", "requests", "feedparser", "bs4", "PIL"]
+COMMANDS_CODE = "import runner, sys\n" +\
+    "sys.argv = ['runner.py', 'commands']\n" +\
+    "try:\n" +\
+    "    runner.run()\n" +\
+    "except SystemExit:\n" +\
+    "    pass\n"
+RUNNER_CODE = "import time\n" +\
+    "start = time.perf_counter()\n" +\
+    "import runner\n" +\
+    "runner.load_runner('{import_path}')\n" +\
+    "print(time.perf_counter() - start)\n"
+# Seconds, far above what any runner takes, it catches an import going astray
+RUNNER_IMPORT_TIME_LIMIT = 3
+# The heavy dependencies that every runner needs, the rest must not be loaded.
+#   The storage runners take the default files from the parsers
+RUNNER_HEAVY_MODULES = {
+    "echo run": HEAVY_MODULES,
+    "echo multi": HEAVY_MODULES,
+    "mastodon test": ["mastodon", "requests", "bs4", "PIL"],
+    "mastodon publish_queue": ["mastodon", "requests", "bs4", "PIL"],
+    "janitor test": ["requests"],
+    "media vacuum": [],
+    "storage vacuum": HEAVY_MODULES,
+    "storage convert": HEAVY_MODULES,
+    "dead_letter inspect": ["mastodon", "requests", "bs4"],
+    "dead_letter requeue": ["mastodon", "requests", "bs4", "PIL"],
+    "websub serve": ["requests", "feedparser", "bs4"],
+    "bench parse": HEAVY_MODULES,
+    "bench e2e": HEAVY_MODULES,
+    "bench websub": ["requests", "feedparser", "bs4"],
+    "bench startup": [],
+    "stats": [],
+    "telegram_login": ["telethon", "mastodon", "requests", "bs4", "PIL"],
+}
+
+
+def _run_code(code: str) -> list:
+    """
+    Runs the code in a fresh interpreter and returns the lines it printed
+    """
+    process = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT_DIR, capture_output=True, text=True
+    )
+    assert process.returncode == 0, process.stderr
+    return process.stdout.strip().splitlines()
+
+
+def _get_loaded_modules(code: str) -> list:
+    """
+    Runs the code in a fresh interpreter and returns the modules it ended with
+    """
+    output = _run_code(code + "import sys, json\nprint(json.dumps(sorted(sys.modules)))\n")
+    return json.loads(output[-1])
+
+
+def _get_heavy_modules(loaded: list) -> list:
+    return [module for module in loaded if module.split(".")[0] in HEAVY_MODULES]
+
+
+def test_import_does_not_load_heavy_modules():
+    loaded = _get_loaded_modules("import runner\n")
+
+    assert _get_heavy_modules(loaded) == []
+
+
+def test_commands_does_not_load_heavy_modules():
+    loaded = _get_loaded_modules(COMMANDS_CODE)
+
+    assert _get_heavy_modules(loaded) == []
+
+
+def test_commands_does_not_load_the_config():
+    loaded = _get_loaded_modules(COMMANDS_CODE)
+
+    assert "echobot.lib.config_snapshot" not in loaded
+    assert "echobot.lib.profiler" not in loaded
+
+
+def test_every_runner_has_its_heavy_modules_listed():
+    assert sorted(RUNNER_HEAVY_MODULES.keys()) == sorted(runner.get_runner_paths().keys())
+
+
+@pytest.mark.parametrize("command", sorted(runner.get_runner_paths().keys()))
+def test_runner_loads_only_its_heavy_modules(command):
+    code = RUNNER_CODE.format(import_path=runner.get_runner_paths()[command])
+    loaded = _get_loaded_modules(code)
+
+    unexpected = [
+        module for module in _get_heavy_modules(loaded)
+        if module.split(".")[0] not in RUNNER_HEAVY_MODULES[command]
+    ]
+    assert unexpected == []
+
+
+@pytest.mark.parametrize("command", sorted(runner.get_runner_paths().keys()))
+def test_runner_imports_in_time(command):
+    code = RUNNER_CODE.format(import_path=runner.get_runner_paths()[command])
+    seconds = float(_run_code(code)[-1])
+
+    assert seconds < RUNNER_IMPORT_TIME_LIMIT
+
+
+def test_version_falls_back_when_not_installed():
+    code = "import importlib.metadata\n" +\
+        "def version(name):\n" +\
+        "    raise importlib.metadata.PackageNotFoundError(name)\n" +\
+        "importlib.metadata.version = version\n" +\
+        "import runner\n" +\
+        "print(runner.PROGRAM_VERSION)\n"
+
+    assert _run_code(code)[-1] == runner.UNKNOWN_VERSION